@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# dcm2csv_raw.py・dti2csv_raw.py・t1w2csv_raw.py の3つの CSV を1回の走査でまとめて作るスクリプト
+# 被験者ディレクトリを引数として指定します
+# 各シリーズの代表ファイルは1回だけ読み、DTI と T1強調像の判定はそれぞれのスクリプトと同じキーワードで行う
+# 出力は results.csv（SE000ではじまるディレクトリの全シリーズ）、dti_results.csv、t1_results.csv
+# --targets で出力するものを選べる（既定は3つすべて）
+
+import os
+import fnmatch
+import argparse
+from contextlib import ExitStack
+from dcmutils import (TagPlan, SUBJECT_TAGS, SERIES_TAGS, GEOMETRY_TAGS, find_subjects,
+                      index_subject, index_subject_by_uid, output_path, add_common_arguments,
+                      ScanRun, split_series_dir, extract_axis, extract_shells)
+
+# 出力ごとの CSV のヘッダー（それぞれ dcm2csv_raw.py・dti2csv_raw.py・t1w2csv_raw.py と同じ項目）
+HEADERS = {
+    "results": [
+        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+        "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes"
+    ],
+    "dti": [
+        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+        "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes",
+        "PixelSpacing", "SliceThickness"
+    ],
+    "t1": [
+        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+        "PixelSpacing", "SliceThickness"
+    ],
+}
+OUTPUTS = {"results": "results.csv", "dti": "dti_results.csv", "t1": "t1_results.csv"}
+SUBJECT_PLAN = TagPlan(SUBJECT_TAGS)
+SERIES_PLAN = TagPlan({**SUBJECT_TAGS, **SERIES_TAGS, **GEOMETRY_TAGS})
+
+def in_results(series_dir):
+    """
+    results.csv に含めるシリーズかどうかを返す
+    （dcm2csv_raw.py と同じく "SE000*" で始まるシリーズだけ。--group-by-uid のときは全シリーズ）
+    """
+    return (fnmatch.fnmatch(os.path.basename(os.path.normpath(series_dir)), "SE000*")
+            or split_series_dir(series_dir)[1] is not None)
+
+def process_series(task):
+    """
+    1シリーズ分の各出力の行を {出力名: 行} で返す（その出力に含めないシリーズは None）
+    --jobs を指定した場合はワーカープロセスで実行される
+    """
+    subject_dir_short, subj_dcm, targets, series_dir, rep_dcm = task
+    series_dir_short = os.path.basename(os.path.normpath(series_dir))
+    # 代表ファイルは1回だけ読み、全ての出力の列をまとめて抽出
+    row = SERIES_PLAN.extract(rep_dcm)
+    row["SubjectDir"] = subject_dir_short
+    row["SeriesDir"] = series_dir_short
+
+    # DTI 判定（dti2csv_raw.py と同じキーワード）
+    dti_keywords = ["dti", "diff", "ep2d", "dki","dwi"]
+    # T1強調像判定（t1w2csv_raw.py と同じキーワード）
+    t1_keywords = ["mprage", "t1", "3d", "fspgr", "sag"]
+    desc_lower = row["SeriesDescription"].lower()
+    proto_lower = row["ProtocolName"].lower()
+    is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in dti_keywords)
+    is_t1 = any(keyword in desc_lower or keyword in proto_lower for keyword in t1_keywords)
+    for_results = "results" in targets and in_results(series_dir)
+
+    # DTI 固有の情報は results.csv と dti_results.csv で共通なので、DTI のシリーズで1回だけ求める
+    row["DTI_Axis"] = row["DTI_bvalues"] = row["DTI_ShellSizes"] = ""
+    if is_dti and (for_results or "dti" in targets):
+        row["DTI_Axis"] = extract_axis(series_dir)
+        row["DTI_bvalues"], row["DTI_ShellSizes"] = extract_shells(series_dir)
+
+    rows = {}
+    if for_results:
+        # results.csv の被験者情報は被験者ディレクトリの最初のファイルから取る（dcm2csv_raw.py と同じ）
+        results_row = {**row, **SUBJECT_PLAN.extract_cached(subj_dcm)}
+        rows["results"] = [results_row[column] for column in HEADERS["results"]]
+    if "dti" in targets and is_dti:
+        rows["dti"] = [row[column] for column in HEADERS["dti"]]
+    if "t1" in targets and is_t1:
+        rows["t1"] = [row[column] for column in HEADERS["t1"]]
+    return rows
+
+def find_series(base_dir, targets, done_subjects=(), group_by_uid=False, shard=None, sampler=None):
+    """
+    base_dir 以下の各シリーズについて (被験者名, 被験者のファイル, 出力名, シリーズディレクトリ, 代表ファイル) を順に返す
+    done_subjects に含まれる被験者（再開時に処理済みのもの）は飛ばす
+    group_by_uid が真なら、SE* のディレクトリ名ではなく SeriesInstanceUID でシリーズを分ける
+    shard に (i, N) を指定した場合は、i 番目のシャードに入る被験者だけを処理する
+    sampler（Sampler）を指定した場合は、標本に入る被験者・シリーズだけを処理する
+    """
+    # base_dir 直下の各サブディレクトリと zip / tar ファイルを被験者ディレクトリとする（アーカイブは展開せずに読む）
+    for subject_dir_short, subj_dir in find_subjects(base_dir, shard, sampler):
+        if subject_dir_short in done_subjects:
+            continue
+        print(f"処理中の被験者: {subj_dir}")
+
+        # 被験者ディレクトリ以下を1回だけ走査して、被験者レベルの DICOM ファイルと
+        # "SE*" で始まるシリーズディレクトリ（とその代表ファイル）を取得
+        # （"SE000*" のシリーズも並び順を保ったままこの中に含まれる）
+        if group_by_uid:
+            # --group-by-uid のときはディレクトリ名によらず、ヘッダの SeriesInstanceUID でシリーズに分ける
+            subj_dcm, series = index_subject_by_uid(subj_dir)
+        else:
+            subj_dcm, series = index_subject(subj_dir, "SE*")
+        if not subj_dcm:
+            continue
+
+        if sampler:
+            series = sampler.series(subject_dir_short, series)
+        for series_dir, rep_dcm in series:
+            yield subject_dir_short, subj_dcm, targets, series_dir, rep_dcm
+
+def main():
+    parser = argparse.ArgumentParser(description="全シリーズ・DTI・T1強調像の DICOM ファイル情報を1回の走査でCSVにまとめるスクリプト")
+    parser.add_argument("base_dir", help="被験者ディレクトリが存在するトップディレクトリ")
+    parser.add_argument("-t", "--targets", nargs="+", choices=list(OUTPUTS), default=list(OUTPUTS),
+                        help="出力する CSV（results: results.csv, dti: dti_results.csv, t1: t1_results.csv。既定は全て）")
+    add_common_arguments(parser, "results.csv")
+    args = parser.parse_args()
+    if not args.base_dir:
+        parser.print_usage()
+        exit(1)
+    run = ScanRun(parser, args, __file__)
+
+    # 出力の順序は OUTPUTS の順にそろえる（キャッシュのキーにも使うため）
+    targets = tuple(target for target in OUTPUTS if target in args.targets)
+    outputs = {target: output_path(OUTPUTS[target], args.format, args.shard) for target in targets}
+
+    # シリーズごとに処理が終わりしだい各 CSV に追記する（順序は並列数によらず glob の順序のまま）
+    # --cache を指定した場合、変更のないシリーズはキャッシュの結果を使う
+    with run, ExitStack() as stack:
+        # --sample-* の推定には最初の出力（results を出力するなら results.csv）の行を使う
+        writers = {}
+        for target in targets:
+            writers[target] = stack.enter_context(run.open_output(
+                outputs[target], HEADERS[target], target=target == targets[0],
+                series_filter=in_results if target == "results" else None))
+        # 再開時は、全ての出力で処理済みの被験者・シリーズだけを飛ばす
+        done_subjects = set.intersection(*(writer.done_subjects for writer in writers.values()))
+        done_series = set.intersection(*(writer.done_series for writer in writers.values()))
+        tasks = (task for task in find_series(args.base_dir, targets, done_subjects, args.group_by_uid,
+                                              args.shard, run.sampler)
+                 if task[-2] not in done_series)
+        for task, rows in run.series(process_series, tasks):
+            for target, writer in writers.items():
+                # 一部の出力にだけ書き込んだところで中断していた場合は、書き込み済みの出力を飛ばす
+                if task[-2] not in writer.done_series:
+                    writer.add(task[0], task[-2], rows.get(target))
+    for target in targets:
+        print(f"CSV出力完了: {outputs[target]}")
+    run.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+# dicom2csv の各スクリプトの処理速度を測るベンチマーク
+# 合成した 被験者/SE* のディレクトリツリーに対して各スクリプトを実行し、
+# シリーズ/秒・stat したファイル数・起動したサブプロセス数・最大メモリ使用量を JSON に保存する
+# 保存した JSON 同士を --compare で比べれば、バージョン間の速度低下を確認できる
+#
+# 例: ./benchmark.py --subjects 50 --series 8 --files 40 -o bench.json
+#     ./benchmark.py --baseline old.json -o new.json   （計測して old.json と比較）
+#     ./benchmark.py --compare old.json new.json       （保存済みの結果を比較するだけ）
+
+import os
+import sys
+import json
+import time
+import struct
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 既定で計測するスクリプト（org_data が不要なもの）
+DEFAULT_SCRIPTS = ["dcm2csv_raw.py", "dti2csv_raw.py", "t1w2csv_raw.py", "all2csv_raw.py"]
+
+# 計測用の子プロセスで数えるもの
+COUNTERS = ["stat_calls", "dir_entries", "files_opened", "subprocesses"]
+
+# 子プロセスに計測用のカウンタを仕込むための環境変数（カウンタの書き出し先ディレクトリ）
+COUNTS_ENV = "DICOM2CSV_BENCH_COUNTS"
+
+# 合成するシリーズの種類（SeriesDescription, ProtocolName）を順番に割り当てる
+SERIES_KINDS = [
+    ("t1_mprage_sag", "t1_mprage_sag"),
+    ("ep2d_diff_mddw_64", "ep2d_diff_mddw_64"),
+    ("resting_state_fmri", "ep2d_bold_rest"),
+    ("t2_tse_tra", "t2_tse_tra"),
+]
+
+EXPLICIT_VR_LE = "1.2.840.10008.1.2.1"
+LONG_VRS = {"OB", "OW", "SQ", "UN", "UT"}
+
+
+def element(tag, vr, value):
+    """
+    明示的 VR リトルエンディアンの要素を1つ作る（文字列は偶数長になるように埋める）
+    """
+    if isinstance(value, str):
+        value = value.encode("ascii")
+        if len(value) % 2:
+            value += b"\0" if vr == "UI" else b" "
+    group, elem = tag
+    if vr in LONG_VRS:
+        return struct.pack("<HH2s2xI", group, elem, vr.encode(), len(value)) + value
+    return struct.pack("<HH2sH", group, elem, vr.encode(), len(value)) + value
+
+def write_dicom(path, elements, pixel_bytes):
+    """
+    要素のリスト [(タグ, VR, 値), ...] と pixel_bytes バイトの Pixel Data で DICOM ファイルを書く
+    """
+    meta = element((0x0002, 0x0010), "UI", EXPLICIT_VR_LE)
+    meta = element((0x0002, 0x0000), "UL", struct.pack("<I", len(meta))) + meta
+    body = b"".join(element(*e) for e in sorted(elements))
+    body += element((0x7FE0, 0x0010), "OW", bytes(pixel_bytes))
+    with open(path, "wb") as f:
+        f.write(b"\0" * 128 + b"DICM" + meta + body)
+
+def series_elements(subject, series, kind, index):
+    """
+    1ファイル分の要素を作る（DTI のシリーズには b 値とスライス位置も入れる）
+    """
+    description, protocol = SERIES_KINDS[kind]
+    elements = [
+        ((0x0008, 0x0020), "DA", "20250101"),
+        ((0x0008, 0x0060), "CS", "MR"),
+        ((0x0008, 0x0070), "LO", "SIEMENS"),
+        ((0x0008, 0x0080), "LO", "BENCH HOSPITAL"),
+        ((0x0008, 0x103E), "LO", description),
+        ((0x0008, 0x1090), "LO", "Prisma"),
+        ((0x0010, 0x0010), "PN", f"SUBJ{subject:05d}"),
+        ((0x0010, 0x0040), "CS", "O"),
+        ((0x0010, 0x1010), "AS", "040Y"),
+        ((0x0018, 0x0050), "DS", "1"),
+        ((0x0018, 0x0080), "DS", "2300"),
+        ((0x0018, 0x0081), "DS", "2.98"),
+        ((0x0018, 0x0087), "DS", "3"),
+        ((0x0018, 0x0095), "DS", "240"),
+        ((0x0018, 0x1030), "LO", protocol),
+        ((0x0018, 0x1312), "CS", "ROW"),
+        ((0x0018, 0x1314), "DS", "9"),
+        ((0x0020, 0x000E), "UI", f"1.2.826.0.1.3680043.2.1125.{subject}.{series}"),
+        ((0x0028, 0x0030), "DS", "1\\1"),
+    ]
+    if "diff" in description:
+        # 最初の1ファイルを b=0、残りを b=1000 とする（1ファイル = 1ボリューム）
+        bvalue = 0.0 if index == 0 else 1000.0
+        elements.append(((0x0018, 0x9087), "FD", struct.pack("<d", bvalue)))
+        elements.append(((0x0020, 0x0032), "DS", "0\\0\\0"))
+    return elements
+
+def generate_tree(base_dir, subjects, series, files, pixel_bytes, org_data=False):
+    """
+    base_dir/subNNNNN/[org_data/]SE0001/IM00001.dcm ... の合成ツリーを作る
+    """
+    for subject in range(subjects):
+        subj_dir = os.path.join(base_dir, f"sub{subject:05d}")
+        if org_data:
+            subj_dir = os.path.join(subj_dir, "org_data")
+        for se in range(series):
+            kind = se % len(SERIES_KINDS)
+            series_dir = os.path.join(subj_dir, f"SE{se + 1:04d}")
+            os.makedirs(series_dir, exist_ok=True)
+            for index in range(files):
+                write_dicom(os.path.join(series_dir, f"IM{index + 1:05d}.dcm"),
+                            series_elements(subject, se, kind, index), pixel_bytes)
+
+def install_counters():
+    """
+    計測用の子プロセスの中で os.stat・os.scandir・open・subprocess.Popen の呼び出し回数を数え、
+    プロセス終了時に "<COUNTS_ENV>/<pid>.json" に書き出す（sitecustomize から呼ばれる）
+    --jobs で起動されるワーカープロセスの分も、それぞれのプロセスが書き出す
+    """
+    out_dir = os.environ.get(COUNTS_ENV)
+    if not out_dir:
+        return
+    import atexit
+    import builtins
+    import multiprocessing.util
+
+    counts = dict.fromkeys(COUNTERS, 0)
+    real_open = builtins.open
+
+    def counting(func, name):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    class CountingScandir:
+        def __init__(self, it):
+            self.it = it
+
+        def __iter__(self):
+            for entry in self.it:
+                counts["dir_entries"] += 1
+                yield entry
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.it.close()
+
+        def close(self):
+            self.it.close()
+
+    real_scandir = os.scandir
+    os.scandir = lambda *args, **kwargs: CountingScandir(real_scandir(*args, **kwargs))
+    os.stat = counting(os.stat, "stat_calls")
+    os.lstat = counting(os.lstat, "stat_calls")
+    builtins.open = counting(builtins.open, "files_opened")
+
+    class CountingPopen(subprocess.Popen):
+        def __init__(self, *args, **kwargs):
+            counts["subprocesses"] += 1
+            super().__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+
+    def dump():
+        with real_open(os.path.join(out_dir, f"{os.getpid()}.json"), "w") as f:
+            json.dump(counts, f)
+
+    def reset():
+        # fork したワーカーは親の値を引き継ぐので 0 から数え直す
+        for name in COUNTERS:
+            counts[name] = 0
+
+    atexit.register(dump)
+    os.register_at_fork(after_in_child=reset)
+    # multiprocessing のワーカーは atexit を通らずに終了するので、終了処理（Finalize）で書き出す
+    multiprocessing.util.register_after_fork(
+        install_counters, lambda _: multiprocessing.util.Finalize(None, dump, exitpriority=0))
+
+def collect_counts(counts_dir):
+    """
+    各プロセスが書き出したカウンタを合計する
+    """
+    total = dict.fromkeys(COUNTERS, 0)
+    for name in os.listdir(counts_dir):
+        with open(os.path.join(counts_dir, name)) as f:
+            for key, value in json.load(f).items():
+                total[key] += value
+    return total
+
+def count_rows(work_dir):
+    """
+    作業ディレクトリに出力された CSV のデータ行数（ヘッダーを除く）を合計する
+    """
+    rows = 0
+    for name in os.listdir(work_dir):
+        if name.endswith(".csv"):
+            with open(os.path.join(work_dir, name), encoding="utf-8") as f:
+                rows += max(sum(1 for _ in f) - 1, 0)
+    return rows
+
+def run_script(script, base_dir, extra_args):
+    """
+    スクリプトを1回実行し、(経過時間, カウンタ, 出力行数, rusage) を返す
+    出力 CSV は一時ディレクトリに書かせて、終わったら消す
+    """
+    work_dir = tempfile.mkdtemp(prefix="dicom2csv_bench_run_")
+    counts_dir = os.path.join(work_dir, ".counts")
+    site_dir = os.path.join(work_dir, ".site")
+    os.makedirs(counts_dir)
+    os.makedirs(site_dir)
+    with open(os.path.join(site_dir, "sitecustomize.py"), "w") as f:
+        f.write("import benchmark\nbenchmark.install_counters()\n")
+    env = dict(os.environ)
+    env[COUNTS_ENV] = counts_dir
+    env["PYTHONPATH"] = os.pathsep.join([site_dir, SCRIPT_DIR] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, script), base_dir] + extra_args
+    try:
+        with open(os.path.join(work_dir, ".stderr"), "w+") as err:
+            start = time.perf_counter()
+            proc = subprocess.Popen(cmd, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=err)
+            # wait4 でこのプロセス（と子孫）の最大 RSS と CPU 時間を取る
+            _, status, usage = os.wait4(proc.pid, 0)
+            elapsed = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            if proc.returncode != 0:
+                err.seek(0)
+                raise RuntimeError(f"{script} が終了コード {proc.returncode} で失敗しました:\n{err.read()}")
+        return elapsed, collect_counts(counts_dir), count_rows(work_dir), usage
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def benchmark_script(script, base_dir, extra_args, repeat, n_series, n_files):
+    """
+    スクリプトを repeat 回実行し、経過時間の中央値で1件分の結果を作る
+    """
+    runs = []
+    for _ in range(repeat):
+        elapsed, counts, rows, usage = run_script(script, base_dir, extra_args)
+        runs.append(elapsed)
+    wall = statistics.median(runs)
+    result = {
+        "script": script,
+        "runs": [round(t, 4) for t in runs],
+        "wall_s": round(wall, 4),
+        "series_per_s": round(n_series / wall, 2),
+        "files_per_s": round(n_files / wall, 2),
+        "rows": rows,
+    }
+    result.update(counts)
+    result["peak_rss_kb"] = usage.ru_maxrss
+    result["user_s"] = round(usage.ru_utime, 4)
+    result["sys_s"] = round(usage.ru_stime, 4)
+    return result
+
+def git_revision():
+    try:
+        out = subprocess.check_output(["git", "-C", SCRIPT_DIR, "describe", "--always", "--dirty"],
+                                      stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except Exception:
+        return ""
+
+def compare(old, new, threshold):
+    """
+    2つの結果を比べて表を表示し、series/s が threshold（割合）以上下がったスクリプトの数を返す
+    """
+    old_results = {r["script"]: r for r in old["results"]}
+    print(f"{'script':<18} {'old series/s':>13} {'new series/s':>13} {'change':>8} "
+          f"{'stat':>8} {'subproc':>8} {'rss(KB)':>9}")
+    regressions = 0
+    for r in new["results"]:
+        o = old_results.get(r["script"])
+        if o is None:
+            continue
+        change = r["series_per_s"] / o["series_per_s"] - 1 if o["series_per_s"] else 0.0
+        mark = ""
+        if change < -threshold:
+            regressions += 1
+            mark = "  <- 低下"
+        print(f"{r['script']:<18} {o['series_per_s']:>13.2f} {r['series_per_s']:>13.2f} {change:>+8.1%} "
+              f"{r['stat_calls'] - o['stat_calls']:>+8} {r['subprocesses'] - o['subprocesses']:>+8} "
+              f"{r['peak_rss_kb'] - o['peak_rss_kb']:>+9}{mark}")
+    if old.get("config") != new.get("config"):
+        print("注意: ツリーの設定が異なるので、単純には比較できません")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="合成した DICOM ツリーで dicom2csv の各スクリプトの速度を計測するベンチマーク")
+    parser.add_argument("--subjects", type=int, default=20, help="被験者数（既定は 20）")
+    parser.add_argument("--series", type=int, default=8, help="被験者あたりのシリーズ数（既定は 8）")
+    parser.add_argument("--files", type=int, default=20, help="シリーズあたりのファイル数（既定は 20）")
+    parser.add_argument("--full-size", action="store_true",
+                        help="256x256 の 16bit 画像データを入れる（省略時はヘッダのみの小さなファイル）")
+    parser.add_argument("--org-data", action="store_true",
+                        help="被験者ディレクトリの下に org_data を作る（dcm2csv.py・dti2csv.py を計測する場合）")
+    parser.add_argument("--tree", metavar="DIR",
+                        help="合成ツリーをこのディレクトリに作って残す（同じ設定のツリーがあれば作り直さない）")
+    parser.add_argument("--scripts", nargs="+", default=DEFAULT_SCRIPTS,
+                        help=f"計測するスクリプト（既定は {' '.join(DEFAULT_SCRIPTS)}）")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="各スクリプトに渡す --jobs（既定は 1）")
+    parser.add_argument("--repeat", type=int, default=3, help="各スクリプトの実行回数（中央値を使う。既定は 3）")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="結果の JSON（既定は benchmark.json）")
+    parser.add_argument("--baseline", metavar="JSON", help="計測後にこの結果と比較する")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="計測せずに2つの結果を比較する")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="series/s がこの割合以上下がったら低下とみなし終了コード 1 を返す（既定は 0.1）")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        exit(1 if compare(old, new, args.threshold) else 0)
+
+    config = {
+        "subjects": args.subjects, "series": args.series, "files": args.files,
+        "full_size": args.full_size, "org_data": args.org_data, "jobs": args.jobs,
+    }
+    pixel_bytes = 256 * 256 * 2 if args.full_size else 0
+    tree = os.path.abspath(args.tree) if args.tree else tempfile.mkdtemp(prefix="dicom2csv_bench_tree_")
+    tree_config = {k: v for k, v in config.items() if k != "jobs"}
+    marker = os.path.join(tree, ".bench_tree.json")
+    try:
+        existing = None
+        if os.path.isfile(marker):
+            with open(marker) as f:
+                existing = json.load(f)
+        if existing != tree_config:
+            if os.path.isdir(tree) and args.tree and os.listdir(tree):
+                if existing is None:
+                    raise SystemExit(f"{tree} は合成ツリーではありません（空のディレクトリか新しいパスを指定してください）")
+                shutil.rmtree(tree)
+            os.makedirs(tree, exist_ok=True)
+            print(f"合成ツリーを作成中: {tree}")
+            start = time.perf_counter()
+            generate_tree(tree, args.subjects, args.series, args.files, pixel_bytes, args.org_data)
+            with open(marker, "w") as f:
+                json.dump(tree_config, f)
+            print(f"作成完了: {time.perf_counter() - start:.1f} 秒")
+
+        n_series = args.subjects * args.series
+        n_files = n_series * args.files
+        results = []
+        for script in args.scripts:
+            print(f"計測中: {script}")
+            result = benchmark_script(script, tree, ["-j", str(args.jobs)], args.repeat, n_series, n_files)
+            print(f"  {result['wall_s']:.3f} 秒, {result['series_per_s']:.1f} series/s, "
+                  f"stat {result['stat_calls']}, subprocess {result['subprocesses']}, "
+                  f"peak RSS {result['peak_rss_kb']} KB")
+            results.append(result)
+    finally:
+        if not args.tree:
+            shutil.rmtree(tree, ignore_errors=True)
+
+    report = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"結果を保存しました: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)
+        exit(1 if compare(old, report, args.threshold) else 0)
+
+if __name__ == "__main__":
+    main()
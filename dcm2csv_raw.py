@@ -6,153 +6,105 @@
 
 # 20250203　Kikuko Kaneko
 import os
-import glob
-import csv
-import subprocess
-import re
-
-def get_tag_value(dcmdump_text, tag):
-    """
-    dcmdump の出力から指定タグ（例："0010,0010"）の角括弧内の値を抽出する
-    """
-    pattern = re.compile(r'\(' + re.escape(tag) + r'\).*?\[(.*?)\]', re.IGNORECASE)
-    m = pattern.search(dcmdump_text)
-    return m.group(1).strip() if m else ""
-
-def run_command(cmd):
-    """
-    コマンドを実行し、出力文字列を返す
-    """
-    try:
-        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
-        return out.decode("utf-8")
-    except Exception:
-        return ""
-
-def get_first_file(directory):
-    """
-    ディレクトリ内を再帰的に検索し、最初に見つかったファイルのパスを返す
-    """
-    files = [f for f in glob.glob(os.path.join(directory, "**"), recursive=True)
-             if os.path.isfile(f)]
-    return files[0] if files else ""
-
-def extract_mrinfo_axis(series_dir):
+import argparse
+from dcmutils import (TagPlan, SUBJECT_TAGS, SERIES_TAGS, find_subjects, index_subject,
+                      index_subject_by_uid, output_path, add_common_arguments, ScanRun,
+                      extract_axis, extract_shells)
+
+# 出力する CSV のヘッダー（results.csv と同じ項目）
+HEADER = [
+    "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+    "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+    "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+    "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+    "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes"
+]
+SUBJECT_PLAN = TagPlan(SUBJECT_TAGS)
+SERIES_PLAN = TagPlan(SERIES_TAGS)
+
+def process_series(task):
     """
-    mrinfo <series_dir> の出力から "Dimensions:" 行の最後の数値（軸数）を抽出する
-    例: "Dimensions: 128 x 128 x 33 x 100" → "100"
+    1シリーズ分の CSV の行を作る（--jobs を指定した場合はワーカープロセスで実行される）
     """
-    mrinfo_text = run_command(["mrinfo", series_dir])
-    axis = ""
-    for line in mrinfo_text.splitlines():
-        if "Dimensions:" in line:
-            parts = line.split(":")[-1].strip().split("x")
-            if parts:
-                axis = re.sub(r'\D', '', parts[-1])
-            break
-    return axis
-
-def extract_mrinfo_shells(series_dir):
+    subject_dir_short, subj_dcm, series_dir, rep_dcm = task
+    # 各シリーズのディレクトリ名のみを取得
+    series_dir_short = os.path.basename(os.path.normpath(series_dir))
+    # 各タグを1回の走査でまとめて抽出
+    row = SERIES_PLAN.extract(rep_dcm)
+    # 被験者情報は被験者ディレクトリの最初のファイルから取る（同じ被験者のシリーズが続く間は読み直さない）
+    row.update(SUBJECT_PLAN.extract_cached(subj_dcm))
+    row["SubjectDir"] = subject_dir_short
+    row["SeriesDir"] = series_dir_short
+
+    # DTI 判定：Series Description または Protocol Name に "DTI"（大文字小文字を区別せず）が含まれていなければスキップ
+    #is_dti = ("dti" in series_description.lower()) or ("dti" in protocol_name.lower())
+    #if not is_dti:
+    #    continue
+    keywords = ["dti", "diff", "ep2d", "dki","dwi"]
+    desc_lower = row["SeriesDescription"].lower()
+    proto_lower = row["ProtocolName"].lower()
+    is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
+
+    # DTI 固有の情報を取得（b 値・シェル・軸数は DICOM ヘッダから求め、求められない場合だけ mrinfo を使う）
+    # シリーズの全ファイルのヘッダを読むので DTI と判定されたシリーズだけで求め、それ以外は空欄にする
+    row["DTI_Axis"] = row["DTI_bvalues"] = row["DTI_ShellSizes"] = ""
+    if is_dti:
+        row["DTI_Axis"] = extract_axis(series_dir)
+        row["DTI_bvalues"], row["DTI_ShellSizes"] = extract_shells(series_dir)
+
+    return [row[column] for column in HEADER]
+
+def find_series(base_dir, done_subjects=(), group_by_uid=False, shard=None, sampler=None):
     """
-    mrinfo <series_dir> -shell_sizes -shell_bvalues の出力から、各シェルの b 値とボリューム数を抽出する
-    出力例:
-      0 1200 
-      1 64 
-    ※ 1行目：各シェルの b 値（例：シェル 0 の b 値は 0、シェル 1 の b 値は 1200）
-       2行目：各シェルのボリューム数（例：シェル 0 は 1 枚、シェル 1 は 64 枚）
+    base_dir 以下の各シリーズについて (被験者名, 被験者のファイル, シリーズディレクトリ, 代表ファイル) を順に返す
+    done_subjects に含まれる被験者（再開時に処理済みのもの）は飛ばす
+    group_by_uid が真なら、SE* のディレクトリ名ではなく SeriesInstanceUID でシリーズを分ける
+    shard に (i, N) を指定した場合は、i 番目のシャードに入る被験者だけを処理する
+    sampler（Sampler）を指定した場合は、標本に入る被験者・シリーズだけを処理する
     """
-    shell_text = run_command(["mrinfo", series_dir, "-shell_sizes", "-shell_bvalues"])
-    lines = [line.strip() for line in shell_text.splitlines() if re.match(r'^[0-9]', line)]
-    if len(lines) >= 2:
-        b_values    = ", ".join(lines[0].split())
-        shell_sizes = ", ".join(lines[1].split())
-        return b_values, shell_sizes
-    else:
-        return "", ""
-
-def main():
-    BASE_DIR = "."  # 被験者ディレクトリが存在するトップディレクトリ
-    # 出力する CSV のヘッダー（results.csv と同じ項目）
-    header = [
-        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
-        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
-        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
-        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
-        "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes"
-    ]
-    out_rows = []
-
-    # BASE_DIR 直下の各サブディレクトリを被験者ディレクトリとする
-    for subj_dir in glob.glob(os.path.join(BASE_DIR, "*/")):
+    # base_dir 直下の各サブディレクトリと zip / tar ファイルを被験者ディレクトリとする（アーカイブは展開せずに読む）
+    for subject_dir_short, subj_dir in find_subjects(base_dir, shard, sampler):
+        if subject_dir_short in done_subjects:
+            continue
         print(f"処理中の被験者: {subj_dir}")
 
-        # 被験者レベルの DICOM ファイルを被験者ディレクトリ全体から再帰検索
-        subj_dcm = get_first_file(subj_dir)
+        # 被験者ディレクトリを1回だけ走査して、被験者レベルの DICOM ファイルと
+        # "SE000*" で始まるシリーズディレクトリ（とその代表ファイル）を取得
+        if group_by_uid:
+            # --group-by-uid のときはディレクトリ名によらず、ヘッダの SeriesInstanceUID でシリーズに分ける
+            subj_dcm, series = index_subject_by_uid(subj_dir)
+        else:
+            subj_dcm, series = index_subject(subj_dir, "SE000*")
         if not subj_dcm:
             continue
-        dcmdump_text = run_command(["dcmdump", subj_dcm])
-        patient_name = get_tag_value(dcmdump_text, "0010,0010")
-        patient_age  = get_tag_value(dcmdump_text, "0010,1010")
-        patient_sex  = get_tag_value(dcmdump_text, "0010,0040")
-        study_date   = get_tag_value(dcmdump_text, "0008,0020")
 
-        # SubjectDir はパスの最後のディレクトリ名のみ（例："1675428"）
-        subject_dir_short = os.path.basename(os.path.normpath(subj_dir))
+        if sampler:
+            series = sampler.series(subject_dir_short, series)
+        for series_dir, rep_dcm in series:
+            yield subject_dir_short, subj_dcm, series_dir, rep_dcm
 
-        # 被験者ディレクトリを再帰検索して "SE000*" で始まるシリーズディレクトリを取得
-        series_dirs = glob.glob(os.path.join(subj_dir, "**", "SE000*"), recursive=True)
-
-        for series_dir in series_dirs:
-            # 各シリーズのディレクトリ名のみを取得
-            series_dir_short = os.path.basename(os.path.normpath(series_dir))
-            rep_dcm = get_first_file(series_dir)
-            if not rep_dcm:
-                continue
-            rep_dump = run_command(["dcmdump", rep_dcm])
-            # 各タグを抽出
-            manufacturer      = get_tag_value(rep_dump, "0008,0070")
-            institution       = get_tag_value(rep_dump, "0008,0080")
-            series_description= get_tag_value(rep_dump, "0008,103E")
-            model_name        = get_tag_value(rep_dump, "0008,1090")
-            ethnic_group      = get_tag_value(rep_dump, "0010,2160")
-            repetition_time   = get_tag_value(rep_dump, "0018,0080")
-            echo_time         = get_tag_value(rep_dump, "0018,0081")
-            magnetic_field    = get_tag_value(rep_dump, "0018,0087")
-            pixel_bandwidth   = get_tag_value(rep_dump, "0018,0095")
-            protocol_name     = get_tag_value(rep_dump, "0018,1030")
-            phase_encoding    = get_tag_value(rep_dump, "0018,1312")
-            flip_angle        = get_tag_value(rep_dump, "0018,1314")
-
-            # DTI 判定：Series Description または Protocol Name に "DTI"（大文字小文字を区別せず）が含まれていなければスキップ
-            #is_dti = ("dti" in series_description.lower()) or ("dti" in protocol_name.lower())
-            #if not is_dti:
-            #    continue
-            keywords = ["dti", "diff", "ep2d", "dki","dwi"]
-            desc_lower = series_description.lower()
-            proto_lower = protocol_name.lower()
-            is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
-
-            # mrinfo を用いて DTI 固有の情報を取得
-            dti_axis = extract_mrinfo_axis(series_dir)
-            dti_bvalues, dti_shellsizes = extract_mrinfo_shells(series_dir)
+def main():
+    parser = argparse.ArgumentParser(description="DICOMファイル情報をシリーズごとにCSVにまとめるスクリプト")
+    parser.add_argument("base_dir", nargs="?", default=".",
+                        help="被験者ディレクトリが存在するトップディレクトリ（省略時はカレントディレクトリ）")
+    add_common_arguments(parser, "results.csv")
+    args = parser.parse_args()
 
-            row = [
-                subject_dir_short, patient_name, patient_age, patient_sex, study_date,
-                series_dir_short, manufacturer, institution, series_description,
-                model_name, ethnic_group, repetition_time, echo_time, magnetic_field,
-                pixel_bandwidth, protocol_name, phase_encoding, flip_angle,
-                dti_axis, dti_bvalues, dti_shellsizes
-            ]
-            out_rows.append(row)
+    BASE_DIR = args.base_dir  # 被験者ディレクトリが存在するトップディレクトリ
+    run = ScanRun(parser, args, __file__)
 
     # DICOM情報をまとめた CSV を "results.csv" として出力
-    output_csv = "results.csv"
-    with open(output_csv, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        writer.writerows(out_rows)
+    output_csv = output_path("results.csv", args.format, args.shard)
+    # シリーズごとに処理が終わりしだい CSV に追記する（順序は並列数によらず glob の順序のまま）
+    # --cache を指定した場合、変更のないシリーズはキャッシュの結果を使う
+    with run, run.open_output(output_csv, HEADER) as writer:
+        tasks = (task for task in find_series(BASE_DIR, writer.done_subjects, args.group_by_uid,
+                                              args.shard, run.sampler)
+                 if task[-2] not in writer.done_series)
+        for task, row in run.series(process_series, tasks):
+            writer.add(task[0], task[-2], row)
     print(f"CSV出力完了: {output_csv}")
+    run.report()
 
 if __name__ == "__main__":
     main()
-
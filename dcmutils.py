@@ -0,0 +1,3124 @@
+#!/usr/bin/env python3
+
+# dicom2csv の各スクリプトで共通に使う関数をまとめたモジュール
+# 各スクリプトと同じディレクトリに置いておけば import できる
+import os
+import sys
+import glob
+import csv
+import fnmatch
+import subprocess
+import re
+import struct
+import json
+import time
+import datetime
+import sqlite3
+import tempfile
+import shutil
+import tarfile
+import zipfile
+import zlib
+import hashlib
+import heapq
+import math
+import argparse
+import importlib.util
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+
+try:
+    import numpy as np
+except ImportError:  # NumPy がなければ純 Python で計算する
+    np = None
+
+try:
+    import pydicom
+    import pydicom.errors
+except ImportError:  # pydicom がなければ --backend pydicom は使えない
+    pydicom = None
+
+try:
+    from lzma import LZMAError
+except ImportError:  # lzma のない Python では .tar.xz を読めないので、その例外も送出されない
+    LZMAError = zlib.error
+
+# 明示的 VR で値長フィールドが 4 バイトになる VR
+LONG_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "SQ", "SV", "UC", "UN", "UR", "UT", "UV"}
+
+# 文字列として値を取り出す VR（dcmdump が角括弧付きで表示するもの）
+TEXT_VRS = {"AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "PN",
+            "SH", "ST", "TM", "UC", "UI", "UR", "UT"}
+
+# 数値として値を取り出す VR と struct のフォーマット
+NUMBER_VRS = {"US": "H", "SS": "h", "UL": "I", "SL": "i", "FL": "f", "FD": "d"}
+
+# 暗黙的 VR のファイルで値を取り出すタグの VR（スクリプトで使うものだけ）
+IMPLICIT_VRS = {
+    "0002,0010": "UI", "0008,0005": "CS", "0008,0020": "DA", "0008,0060": "CS",
+    "0008,0070": "LO", "0008,0080": "LO", "0008,103E": "LO", "0008,1090": "LO",
+    "0010,0010": "PN", "0010,0040": "CS", "0010,1010": "AS", "0010,2160": "SH",
+    "0018,0050": "DS", "0018,0080": "DS", "0018,0081": "DS", "0018,0087": "DS",
+    "0018,0095": "DS", "0018,1030": "LO", "0018,1312": "CS", "0018,1314": "DS",
+    "0020,000D": "UI", "0020,000E": "UI", "0028,0030": "DS",
+    "0018,9087": "FD", "0019,100C": "IS", "0020,0032": "DS", "0029,1010": "OB", "0029,1020": "OB",
+    "0043,1039": "IS", "2001,1003": "FL",
+    "0002,0002": "UI", "0008,0016": "UI", "0020,0105": "US", "0028,0008": "IS",
+    "0018,9082": "FD", "5200,9229": "SQ", "5200,9230": "SQ",
+    "0018,9006": "SQ", "0018,9112": "SQ", "0018,9114": "SQ", "0018,9117": "SQ",
+    "0018,9125": "SQ", "0020,9113": "SQ", "0028,9110": "SQ",
+}
+
+# 値をバイト列のまま返すタグ（Siemens CSA Image / Series Header）
+BINARY_TAGS = {"0029,1010", "0029,1020"}
+
+# Specific Character Set (0008,0005) と Python のコーデックの対応
+CHARSETS = {
+    "ISO_IR 6": "ascii", "ISO_IR 100": "latin_1", "ISO_IR 101": "iso8859_2",
+    "ISO_IR 109": "iso8859_3", "ISO_IR 110": "iso8859_4", "ISO_IR 144": "iso8859_5",
+    "ISO_IR 127": "iso8859_6", "ISO_IR 126": "iso8859_7", "ISO_IR 138": "iso8859_8",
+    "ISO_IR 148": "iso8859_9", "ISO_IR 166": "tis_620", "ISO_IR 13": "shift_jis",
+    "ISO_IR 192": "utf_8", "GB18030": "gb18030", "GBK": "gbk",
+    "ISO 2022 IR 87": "iso2022_jp", "ISO 2022 IR 159": "iso2022_jp_2",
+    "ISO 2022 IR 149": "euc_kr",
+}
+
+# 被験者ごとに取得するタグ（CSV の列名: タグ）
+SUBJECT_TAGS = {
+    "PatientName": "0010,0010",
+    "PatientAge":  "0010,1010",
+    "PatientSex":  "0010,0040",
+    "StudyDate":   "0008,0020",
+}
+
+# シリーズごとに取得するタグ（CSV の列名: タグ）
+SERIES_TAGS = {
+    "Manufacturer":          "0008,0070",
+    "InstitutionName":       "0008,0080",
+    "SeriesDescription":     "0008,103E",
+    "ModelName":             "0008,1090",
+    "EthnicGroup":           "0010,2160",
+    "RepetitionTime":        "0018,0080",
+    "EchoTime":              "0018,0081",
+    "MagneticFieldStrength": "0018,0087",
+    "PixelBandwidth":        "0018,0095",
+    "ProtocolName":          "0018,1030",
+    "PhaseEncoding":         "0018,1312",
+    "FlipAngle":             "0018,1314",
+}
+
+# 空間分解能のタグ（dti2csv_raw.py / t1w2csv_raw.py で使用）
+GEOMETRY_TAGS = {
+    "PixelSpacing":   "0028,0030",
+    "SliceThickness": "0018,0050",
+}
+
+# --backend で選べるタグの値の読み方（auto は起動時に計測して選ぶ）
+HEADER_BACKENDS = ["auto", "native", "dcmdump", "gdcmdump", "pydicom"]
+
+# 出力形式（parquet と arrow は pyarrow が必要）
+OUTPUT_FORMATS = ["csv", "parquet", "arrow", "sqlite"]
+
+# --format sqlite で索引を作る列
+SQLITE_INDEXES = ["SubjectDir", "Manufacturer", "ModelName", "ProtocolName", "MagneticFieldStrength"]
+
+# --format parquet / arrow で型を付ける列（ここにない列は文字列）
+COLUMN_TYPES = {
+    "StudyDate":             "date",
+    "RepetitionTime":        "float",
+    "EchoTime":              "float",
+    "MagneticFieldStrength": "float",
+    "PixelBandwidth":        "float",
+    "FlipAngle":             "float",
+    "SliceThickness":        "float",
+    "DTI_Axis":              "int",
+    "DTI_bvalues":           "float_list",
+    "DTI_ShellSizes":        "int_list",
+    "PixelSpacing":          "float_list",
+    "SampleWeight":          "float",
+}
+
+# キャッシュの既定の保存先と形式のバージョン（抽出内容を変えたら上げる）
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "dicom2csv", "scan_cache.sqlite")
+CACHE_VERSION = 7
+
+# b 値をシェルに分ける閾値（MRtrix3 の BZeroThreshold / BValueEpsilon の既定値と同じ）
+BZERO_THRESHOLD = 10
+BVALUE_EPSILON = 80
+
+# 拡散の b 値とボリューム数を取り出すのに読むタグ
+# (0018,9087) は標準の Diffusion b-value、それ以外はベンダー固有のタグ
+DIFFUSION_TAGS = (
+    "0008,0070",  # Manufacturer
+    "0018,9087",  # Diffusion b-value
+    "0019,100C",  # Siemens B_value
+    "0020,0032",  # Image Position (Patient)
+    "0020,0105",  # Number of Temporal Positions
+    "0028,0008",  # Number of Frames
+    "0029,1010",  # Siemens CSA Image Header（B_value, NumberOfImagesInMosaic）
+    "0043,1039",  # GE Slop_int_6..9（先頭が b 値）
+    "2001,1003",  # Philips Diffusion B-Factor
+)
+
+# マルチフレーム（Enhanced MR）の Per-Frame Functional Groups からフレームごとに取り出すタグ（b 値とスライス位置）
+FRAME_TAGS = ("0018,9087", "0020,0032")
+
+# 撮像パラメータを最上位ではなく機能グループ（Shared / Per-Frame Functional Groups）に持つ SOP クラス
+FUNCTIONAL_GROUP_SOP_CLASSES = {
+    "1.2.840.10008.5.1.4.1.1.4.1",    # Enhanced MR Image Storage
+    "1.2.840.10008.5.1.4.1.1.4.3",    # Enhanced MR Color Image Storage
+    "1.2.840.10008.5.1.4.1.1.4.4",    # Legacy Converted Enhanced MR Image Storage
+    "1.2.840.10008.5.1.4.1.1.2.1",    # Enhanced CT Image Storage
+    "1.2.840.10008.5.1.4.1.1.2.2",    # Legacy Converted Enhanced CT Image Storage
+    "1.2.840.10008.5.1.4.1.1.128.1",  # Legacy Converted Enhanced PET Image Storage
+    "1.2.840.10008.5.1.4.1.1.130",    # Enhanced PET Image Storage
+}
+
+# 機能グループの中で、最上位とは別のタグに入っている値（機能グループのタグ: 最上位のタグ）
+FUNCTIONAL_GROUP_ALIASES = {
+    "0018,9082": "0018,0081",  # Effective Echo Time → Echo Time
+}
+
+# --group-by-uid でシリーズを分けるのに読むタグ（StudyInstanceUID, SeriesInstanceUID）
+UID_TAGS = ("0020,000D", "0020,000E")
+
+# --group-by-uid のシリーズは "<ファイルのあるディレクトリ>/UID=<SeriesInstanceUID>" で表す
+UID_SERIES_PREFIX = "UID="
+
+# 被験者ディレクトリとして展開せずに読むアーカイブの拡張子
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_PATTERN = re.compile("(?:" + "|".join(re.escape(s) for s in ARCHIVE_SUFFIXES) + r")(?=[/\\]|$)",
+                             re.IGNORECASE)
+
+# 壊れたアーカイブやそのメンバーを読んだときに zipfile / tarfile と展開のモジュールが送出する例外
+# （暗号化されたメンバーは RuntimeError、対応していない圧縮方式は NotImplementedError）
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, zlib.error, LZMAError, EOFError,
+                  NotImplementedError, RuntimeError)
+
+# 同じスライスとみなす Image Position (Patient) の丸め桁数（mm の小数点以下）
+POSITION_DECIMALS = 2
+
+# 1つのプロセスで同時に開いておくアーカイブの数
+ARCHIVE_CACHE_SIZE = 4
+
+# --shard で分けた出力の名前（"results.csv" → "results.shard-3-of-16.csv"）
+SHARD_SUFFIX = ".shard-{}-of-{}"
+SHARD_PATTERN = re.compile(r"\.shard-(\d+)-of-(\d+)(?=\.[^.]*$)")
+
+# 内蔵のリーダーで読めないファイルを1回の dcmdump でまとめて読む数
+DCMDUMP_BATCH = 256
+
+# 1つのタスクで dcmdump を後回しにしてまとめて読むファイルの数（被験者のファイルと代表ファイル）
+# シリーズの全ファイルを読む処理（DTI の b 値など）で往復が増えすぎないように、それより後のファイルはその場で dcmdump を起動する
+DCMDUMP_DEFER_FILES = 2
+
+# --backend auto で計測に使うファイルの数と、1つの被験者から取る数
+BACKEND_SAMPLE = 16
+BACKEND_SAMPLE_PER_SUBJECT = 4
+
+# --sample-* の要約で構成比を推定する列の組（撮像装置とプロトコル）、表示する区分の数と信頼区間（95%）の z 値
+SAMPLE_GROUPS = [("Manufacturer", "ModelName"), ("ProtocolName",)]
+SAMPLE_TOP = 10
+SAMPLE_Z = 1.96
+
+# --sample-time の単位
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+# merge_shards.py で一度にメモリ上で並べ替える行数
+MERGE_CHUNK_ROWS = 100000
+
+# --profile のパーセンタイルを求めるビンの幅（隣のビンとの比。誤差は 1% 程度）
+SKETCH_GAMMA = 1.02
+
+# ヘッダを読むときに最初に読むバイト数（足りなければ倍々に広げる）
+HEADER_WINDOW = 16 * 1024
+
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+EXPLICIT_VR_BE = "1.2.840.10008.1.2.2"
+
+ITEM = (0xFFFE, 0xE000)
+ITEM_END = (0xFFFE, 0xE00D)
+SEQUENCE_END = (0xFFFE, 0xE0DD)
+UNDEFINED = 0xFFFFFFFF
+FILE_META_END = 0x00030000
+SHARED_GROUPS = 0x52009229
+PER_FRAME_GROUPS = 0x52009230
+PIXEL_DATA = 0x7FE00000
+
+
+class Stage:
+    """
+    StageTimer.stage() が返すコンテキストマネージャ（1回分のステージの時間を測る）
+    """
+
+    __slots__ = ("timer", "name", "start", "children")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.timer.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        stack = self.timer.stack
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self.timer.events.append((self.name, self.start, elapsed, elapsed - self.children))
+
+class StageTimer:
+    """
+    --profile のときだけ、処理のステージ（走査・ヘッダの読み込み・mrinfo など）ごとの時間を記録する
+    with TIMER.stage("header"): ... のように使い、無効のときはほとんど何もしない
+    ステージは入れ子にでき、子ステージの時間を除いた正味の時間も記録する
+    """
+
+    NO_STAGE = nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []  # (ステージ名, 開始時刻, 経過時間, 正味の時間)
+        self.stack = []
+
+    def stage(self, name):
+        return Stage(self, name) if self.enabled else self.NO_STAGE
+
+# プロセスごとのステージの記録（ワーカープロセスでも timed_call() が有効にする）
+TIMER = StageTimer()
+
+# このプロセスで開いているアーカイブ（パス -> (プロセス ID, Archive)）
+ARCHIVES = {}
+
+# このプロセスで run_command() が起動したサブプロセスの数と合計時間（進捗表示用）
+SUBPROCESS_STATS = [0, 0.0]
+
+# このプロセスで内蔵のリーダー（read_dicom_header()）が読んだファイルの数と、ファイルから読んだバイト数（--profile 用）
+HEADER_STATS = [0, 0]
+
+# run_series() が run_dcmdump_batch() でまとめて読んだ dcmdump の出力（パス -> 出力）と、
+# read_header() が dcmdump を起動せずに DcmdumpDeferred を送出するかどうか（call_deferrable() が切り替える）
+DCMDUMP_DUMPS = {}
+DCMDUMP_DEFER = [False]
+
+def timed_call(func, profile, task):
+    """
+    --profile や進捗表示のために func(task) を実行し、(結果, 計測値) を返す
+    計測値は (ステージの記録, プロセス ID, 起動したサブプロセスの数, その合計時間,
+    内蔵のリーダーで読んだファイルの数, そのバイト数)
+    ステージは profile が真のときだけ記録する
+    """
+    TIMER.enabled = profile
+    mark = len(TIMER.events)
+    count, seconds = SUBPROCESS_STATS
+    files, nbytes = HEADER_STATS
+    try:
+        with TIMER.stage("series"):
+            result = func(task)
+    except DcmdumpDeferred:
+        del TIMER.events[mark:]
+        raise
+    events = TIMER.events[mark:]
+    del TIMER.events[mark:]
+    return result, (events, os.getpid(), SUBPROCESS_STATS[0] - count, SUBPROCESS_STATS[1] - seconds,
+                    HEADER_STATS[0] - files, HEADER_STATS[1] - nbytes)
+
+class StageStats:
+    """
+    1つのステージの正味の時間の集計（Profiler が使う）
+    回数・合計・最大と、幅が SKETCH_GAMMA 倍ずつの対数のビンごとの回数だけを持つので、
+    シリーズ数が増えてもメモリは増えない（パーセンタイルはビンから近似する）
+    """
+
+    __slots__ = ("count", "total", "max", "bins")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bins = {}  # ビンの番号（0 秒は None）-> 回数
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        key = math.ceil(math.log(value, SKETCH_GAMMA)) if value > 0 else None
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def percentile(self, p):
+        """
+        p パーセンタイル（最近傍順位法）の近似値を返す（そのビンの中央の値で、最大値は超えない）
+        """
+        rank = max(-(-self.count * p // 100), 1)
+        seen = 0
+        for key in sorted(self.bins, key=lambda key: -math.inf if key is None else key):
+            seen += self.bins[key]
+            if seen >= rank:
+                break
+        if key is None:
+            return 0.0
+        return min(2 * SKETCH_GAMMA ** key / (1 + SKETCH_GAMMA), self.max)
+
+class Profiler:
+    """
+    --profile の集計を行う
+    ステージごとの正味の時間の合計・パーセンタイル（StageStats）と、処理に時間のかかった上位 slowest 個のシリーズ（ヒープ）
+    だけを持つので、シリーズ数が増えてもメモリは増えない
+    内蔵のリーダーがヘッダを読むのにファイルから読んだバイト数（HeaderWindow.bytes_read）も、全体とシリーズごとに報告する
+    trace_path を指定した場合だけ、全ステージの記録を残して Chrome のトレース形式
+    （chrome://tracing や Perfetto で開ける）の JSON に書き出す
+    """
+
+    def __init__(self, trace_path=None, slowest=10):
+        self.trace_path = trace_path
+        self.slowest = slowest
+        self.stages = {}  # ステージ名 -> StageStats
+        self.heap = []    # (経過時間, 番号, シリーズディレクトリ, {ステージ名: 正味の時間}, 読んだバイト数) の最小ヒープ
+        self.events = []  # trace_path を指定した場合の (ステージ名, 開始時刻, 経過時間, 正味の時間, プロセス ID, シリーズディレクトリ)
+        self.series = 0
+        self.cached = 0
+        self.header_files = 0  # ワーカープロセスで内蔵のリーダーが読んだファイルの数とバイト数
+        self.header_bytes = 0
+        self.local = tuple(HEADER_STATS)  # このプロセスの開始時点の値
+        self.start = time.perf_counter()
+        TIMER.enabled = True
+
+    def add_events(self, events, pid, series_dir):
+        for event in events:
+            stats = self.stages.get(event[0])
+            if stats is None:
+                stats = self.stages[event[0]] = StageStats()
+            stats.add(event[3])
+        if self.trace_path:
+            self.events.extend(event + (pid, series_dir) for event in events)
+
+    def add_series(self, series_dir, events, pid, files=0, nbytes=0):
+        self.add_events(events, pid, series_dir)
+        # このプロセスの分は HEADER_STATS から直接数える
+        if pid != os.getpid():
+            self.header_files += files
+            self.header_bytes += nbytes
+        stages = {}
+        for name, _, _, own in events:
+            stages[name] = stages.get(name, 0.0) + own
+        self.series += 1
+        # 最後に記録されるのが一番外側の "series" ステージ
+        entry = (events[-1][2], self.series, series_dir, stages, nbytes)
+        if len(self.heap) < self.slowest:
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heappushpop(self.heap, entry)
+        # メインプロセスで記録したステージ（走査・書き込みなど）も、ためずにその都度取り込む
+        self.add_events(TIMER.events, os.getpid(), "")
+        TIMER.events.clear()
+
+    def summary(self):
+        """
+        集計結果を辞書で返す（メインプロセスで記録したステージもここで取り込む）
+        """
+        self.add_events(TIMER.events, os.getpid(), "")
+        TIMER.events.clear()
+        grand_total = sum(stats.total for stats in self.stages.values()) or 1.0
+        stages = {}
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].total):
+            stages[name] = {
+                "total_s": stats.total, "share": stats.total / grand_total, "count": stats.count,
+                "p50_ms": stats.percentile(50) * 1000, "p90_ms": stats.percentile(90) * 1000,
+                "p99_ms": stats.percentile(99) * 1000, "max_ms": stats.max * 1000,
+            }
+        slowest = sorted(self.heap, key=lambda item: -item[0])
+        return {
+            "wall_s": time.perf_counter() - self.start,
+            "series": self.series + self.cached,
+            "cached": self.cached,
+            "header_files": self.header_files + HEADER_STATS[0] - self.local[0],
+            "header_bytes": self.header_bytes + HEADER_STATS[1] - self.local[1],
+            "stages": stages,
+            "slowest": [{"series_dir": series_dir, "elapsed_s": elapsed, "stages": own, "header_bytes": nbytes}
+                        for elapsed, _, series_dir, own, nbytes in slowest],
+        }
+
+    def report(self):
+        """
+        集計結果を表にした文字列を返す（trace_path を指定した場合はトレースも書き出す）
+        """
+        summary = self.summary()
+        lines = [f"--- profile: {summary['series']} series ({summary['cached']} cached) "
+                 f"in {summary['wall_s']:.2f} s ---",
+                 f"{'stage':<16}{'total_s':>10}{'share':>8}{'count':>8}"
+                 f"{'p50_ms':>10}{'p90_ms':>10}{'p99_ms':>10}{'max_ms':>10}"]
+        for name, st in summary["stages"].items():
+            lines.append(f"{name:<16}{st['total_s']:>10.3f}{st['share']:>8.1%}{st['count']:>8}"
+                         f"{st['p50_ms']:>10.2f}{st['p90_ms']:>10.2f}{st['p99_ms']:>10.2f}{st['max_ms']:>10.2f}")
+        files, nbytes = summary["header_files"], summary["header_bytes"]
+        if files:
+            per_series = f", {nbytes / self.series / 1024:.1f} KiB/series" if self.series else ""
+            lines.append(f"header bytes read: {nbytes / 1024:.1f} KiB from {files} files "
+                         f"({nbytes / files / 1024:.1f} KiB/file{per_series})")
+        if summary["slowest"]:
+            lines.append("slowest series:")
+        for item in summary["slowest"]:
+            top = sorted(item["stages"].items(), key=lambda stage: -stage[1])[:3]
+            detail = ", ".join(f"{name} {own:.3f}" for name, own in top)
+            lines.append(f"{item['elapsed_s']:>9.3f} s  {item['series_dir']}  ({detail}; "
+                         f"{item['header_bytes'] / 1024:.1f} KiB read)")
+        if self.trace_path:
+            self.write_trace(summary)
+            lines.append(f"trace: {self.trace_path}")
+        return "\n".join(lines)
+
+    def write_trace(self, summary):
+        trace = [{"name": name, "cat": "dicom2csv", "ph": "X", "pid": pid, "tid": pid,
+                  "ts": round((start - self.start) * 1e6, 1), "dur": round(elapsed * 1e6, 1),
+                  "args": {"series": series_dir} if series_dir else {}}
+                 for name, start, elapsed, _, pid, series_dir in self.events]
+        with open(self.trace_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms", "summary": summary}, f, ensure_ascii=False)
+
+
+def run_command(cmd, partial_output=False):
+    """
+    コマンドを実行し、出力文字列を返す
+    partial_output が真なら、終了コードが 0 以外でもそれまでの出力を返す
+    """
+    start = time.perf_counter()
+    try:
+        with TIMER.stage(os.path.basename(cmd[0])):
+            out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        return out.decode("utf-8")
+    except subprocess.CalledProcessError as e:
+        return e.output.decode("utf-8", "replace") if partial_output else ""
+    except Exception:
+        return ""
+    finally:
+        SUBPROCESS_STATS[0] += 1
+        SUBPROCESS_STATS[1] += time.perf_counter() - start
+
+class ArchiveEntry:
+    """
+    Archive.scandir() が返すエントリ（os.DirEntry の name・path・is_dir()・is_file() と同じように使える）
+    """
+
+    def __init__(self, name, path, is_dir):
+        self.name = name
+        self.path = path
+        self.directory = is_dir
+
+    def is_dir(self):
+        return self.directory
+
+    def is_file(self):
+        return not self.directory
+
+
+class ArchiveMember:
+    """
+    Archive.open() が返すメンバーのファイル（read・seek・tell と with 文が使える）
+    壊れたメンバーを読んだときの例外（ARCHIVE_ERRORS）は、読めないファイルと同じく OSError にして送出する
+    """
+
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+
+    def call(self, method, *args):
+        try:
+            return method(*args)
+        except ARCHIVE_ERRORS as e:
+            raise OSError(f"cannot read archive member: {self.path}") from e
+
+    def read(self, n=-1):
+        return self.call(self.f.read, n)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.call(self.f.seek, offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Archive:
+    """
+    zip / tar ファイルを展開せずに読むクラス
+    メンバーの一覧（zip は中央ディレクトリ、tar は各メンバーのヘッダ）だけを読んでディレクトリの構造を作り、
+    ファイルの中身は open() したメンバーから必要な分だけ読む
+    中身がアーカイブ名（拡張子を除く）と同じ名前の1つのディレクトリにまとまっている場合は、そのディレクトリを最上位とする
+    gzip などで圧縮された tar は先頭から順にしか読めないので、メンバーはアーカイブ内の順に読むと速い
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.children = {"": []}  # ディレクトリ -> [(名前, ディレクトリか), ...]（アーカイブ内の順）
+        self.files = {}           # ファイルのメンバー名 -> ZipInfo / TarInfo
+        self.zip = self.tar = None
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            for info in self.zip.infolist():
+                self.add(info.filename, info.is_dir(), info)
+        else:
+            self.tar = tarfile.open(path)
+            for info in self.tar:
+                if info.isdir() or info.isfile():
+                    self.add(info.name, info.isdir(), info)
+        stem = os.path.basename(path)[:ARCHIVE_PATTERN.search(os.path.basename(path)).start()]
+        self.root = stem if self.children[""] == [(stem, True)] else ""
+
+    def add(self, name, is_dir, info):
+        parts = [part for part in name.split("/") if part and part != "."]
+        if not parts or parts[0] == "__MACOSX":
+            return
+        parent = ""
+        for i, part in enumerate(parts):
+            child = "/".join(parts[:i + 1])
+            child_is_dir = is_dir or i < len(parts) - 1
+            if child not in self.children and child not in self.files:
+                self.children[parent].append((part, child_is_dir))
+                if child_is_dir:
+                    self.children[child] = []
+            parent = child
+        if not is_dir:
+            self.files[parent] = info
+
+    def member(self, name):
+        return "/".join(part for part in (self.root, name.strip("/")) if part)
+
+    def isdir(self, name):
+        return self.member(name) in self.children
+
+    def scandir(self, name):
+        """
+        アーカイブ内のディレクトリ name のエントリを返す（パスは "<アーカイブ>/<メンバー>"）
+        """
+        children = self.children.get(self.member(name))
+        if children is None:
+            raise NotADirectoryError(os.path.join(self.path, name))
+        return [ArchiveEntry(child, os.path.join(self.path, name, child), is_dir)
+                for child, is_dir in children]
+
+    def open(self, name):
+        """
+        メンバー name を開いて ArchiveMember を返す（壊れたメンバーは OSError を送出する）
+        """
+        path = os.path.join(self.path, name)
+        info = self.files.get(self.member(name))
+        if info is None:
+            raise FileNotFoundError(path)
+        try:
+            f = self.zip.open(info) if self.zip else self.tar.extractfile(info)
+        except ARCHIVE_ERRORS as e:
+            raise OSError(f"cannot read archive member: {path}") from e
+        return ArchiveMember(f, path)
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+def get_archive(path):
+    """
+    アーカイブを開いて Archive を返す（同じプロセスでは開いたものを使い回す）
+    fork したワーカープロセスは親と同じファイルを共有しないように開き直す
+    読めないアーカイブは OSError を送出する
+    """
+    entry = ARCHIVES.get(path)
+    if entry is None or entry[0] != os.getpid():
+        if entry is None and len(ARCHIVES) >= ARCHIVE_CACHE_SIZE:
+            pid, oldest = ARCHIVES.pop(next(iter(ARCHIVES)))
+            if pid == os.getpid():
+                oldest.close()
+        try:
+            with TIMER.stage("archive"):
+                entry = ARCHIVES[path] = (os.getpid(), Archive(path))
+        except ARCHIVE_ERRORS as e:
+            raise OSError(f"cannot read archive: {path}") from e
+    return entry[1]
+
+def split_archive(path):
+    """
+    アーカイブ内のパス（"<アーカイブ>/<メンバー>"）なら (アーカイブのパス, メンバー名)、
+    それ以外は (None, path) を返す
+    """
+    for match in ARCHIVE_PATTERN.finditer(path):
+        archive = path[:match.end()]
+        if archive in ARCHIVES or os.path.isfile(archive):
+            return archive, path[match.end():].replace(os.sep, "/").strip("/")
+    return None, path
+
+def scan_dir(path):
+    """
+    os.scandir() と同じく with 文でディレクトリのエントリを返す（アーカイブ内のディレクトリにも使える）
+    """
+    archive, member = split_archive(path)
+    if archive is None:
+        return os.scandir(path)
+    return nullcontext(get_archive(archive).scandir(member))
+
+def open_file(path):
+    """
+    ファイルをバイナリで開く（アーカイブ内のファイルはそのメンバーを展開せずに開き、壊れたメンバーは OSError を送出する）
+    """
+    archive, member = split_archive(path)
+    if archive is None:
+        return open(path, "rb", buffering=0)
+    return get_archive(archive).open(member)
+
+def is_dir(path):
+    """
+    os.path.isdir() と同じ（アーカイブ内のディレクトリにも使える）
+    """
+    archive, member = split_archive(path)
+    if archive is None:
+        return os.path.isdir(path)
+    try:
+        return get_archive(archive).isdir(member)
+    except OSError:
+        return False
+
+def parse_shard(text):
+    """
+    --shard の値 "i/N" を (i, N) にする（i は 0 から N-1、argparse の type に使う）
+    """
+    try:
+        index, count = (int(value) for value in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N: {text!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"expected 0 <= i < N: {text!r}")
+    return index, count
+
+def parse_fraction(text):
+    """
+    --sample-subjects の値（0 より大きく 1 以下の割合。"5%" のような百分率も可）を float にする
+    """
+    try:
+        value = float(text[:-1]) / 100 if text.endswith("%") else float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a fraction such as 0.05 or 5%: {text!r}")
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError(f"expected 0 < fraction <= 1: {text!r}")
+    return value
+
+def parse_count(text):
+    """
+    --sample-series の値（1 以上の整数）を int にする
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer: {text!r}")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected 1 or more: {text!r}")
+    return value
+
+def parse_seconds(text):
+    """
+    --sample-time の値（秒数。"30m"・"2h" のように単位 s / m / h も付けられる）を秒数にする
+    """
+    unit = TIME_UNITS.get(text[-1:].lower())
+    try:
+        value = float(text[:-1] if unit else text) * (unit or 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected seconds such as 600, 10m or 2h: {text!r}")
+    if value <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive time: {text!r}")
+    return value
+
+def in_shard(subject, shard):
+    """
+    被験者名のハッシュ（CRC32）で被験者を N 個に分けたとき、i 番目に入るかを返す
+    Python の hash() と違って実行ごとに変わらないので、どのノードで実行しても同じ分け方になる
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(subject.encode("utf-8")) % count == index
+
+def find_subjects(base_dir, shard=None, sampler=None):
+    """
+    base_dir 直下の被験者ディレクトリを (被験者名, パス) で glob の順に返す
+    zip / tar ファイル（ARCHIVE_SUFFIXES）は、拡張子を除いた名前の被験者ディレクトリとして展開せずに扱う
+    shard に (i, N) を指定した場合は、in_shard() で i 番目に入る被験者だけを返す
+    sampler（Sampler）を指定した場合は、標本に入る被験者だけを順に返すイテレータになる
+    """
+    subjects = []
+    for path in glob.glob(os.path.join(base_dir, "*")):
+        name = os.path.basename(path)
+        match = ARCHIVE_PATTERN.search(name)
+        if os.path.isdir(path):
+            subjects.append((name, os.path.join(path, "")))
+        elif match and match.end() == len(name) and os.path.isfile(path):
+            subjects.append((name[:match.start()], os.path.join(path, "")))
+    subjects = [(name, path) for name, path in subjects if in_shard(name, shard)]
+    return subjects if sampler is None else sampler.subjects(subjects)
+
+
+class Sampler:
+    """
+    --sample-subjects / --sample-series / --sample-time による標本抽出と、標本からの推定
+    被験者とシリーズは seed と名前のハッシュで選ぶので、同じ seed なら何度実行しても（どのノードでも）同じ標本になる
+    --sample-time では被験者を seed で決まる順序に並べ、時間切れになるまで先頭から処理する（単純無作為抽出になる）
+    各行の重み（weight()）は、その行が代表するシリーズ数
+    （全被験者数 / 標本の被験者数 × 被験者のシリーズ数 / 選んだシリーズ数）
+    推定には target() で登録した1つの出力の行だけを数える。その出力の対象のシリーズを判定する関数も登録した場合は、
+    --sample-series のシリーズを対象の内と外で別々に選び、重みのシリーズ数もそれぞれの中で数える
+    """
+
+    def __init__(self, fraction=None, per_subject=None, budget=None, seed=0):
+        self.fraction = fraction
+        self.per_subject = per_subject
+        self.budget = budget
+        self.seed = seed
+        self.population = 0  # shard 内の全被験者数
+        self.sampled = 0  # 標本の被験者数
+        self.series_weights = {}  # {被験者名: {層: 層のシリーズ数 / 選んだシリーズ数}}（層は stratum() の値）
+        self.stats = {}  # {被験者名: {None: シリーズ数, (SAMPLE_GROUPS の番号, 値): シリーズ数}}（重み付き）
+        self.series_filter = None  # 推定に使う出力の対象のシリーズの判定（None なら全シリーズ）
+        self.columns = []  # 推定に使う出力の [(SAMPLE_GROUPS の番号, [列番号, ...]), ...]
+
+    def key(self, *names):
+        """
+        seed と名前から 0 以上 1 未満の値を返す（標本の選択と順序に使う）
+        """
+        digest = hashlib.blake2b("\0".join((str(self.seed), *names)).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64
+
+    def subjects(self, subjects):
+        """
+        find_subjects() の被験者のうち、標本に入るものを順に返す
+        """
+        self.population = len(subjects)
+        selected = [subject for subject in subjects if self.fraction is None or self.key(subject[0]) < self.fraction]
+        if self.budget is None:
+            self.sampled = len(selected)
+            yield from selected
+            return
+        selected.sort(key=lambda subject: self.key(subject[0]))
+        start = time.monotonic()
+        for subject in selected:
+            if time.monotonic() - start >= self.budget:
+                return
+            self.sampled += 1
+            yield subject
+
+    def target(self, header, series_filter=None):
+        """
+        推定に使う出力を登録する（その出力の列 header から SAMPLE_GROUPS の列を探す）
+        series_filter(シリーズディレクトリ) はその出力に行を書くシリーズかどうかを返す関数（None なら全シリーズ）
+        """
+        self.series_filter = series_filter
+        self.columns = [(number, [header.index(name) for name in names])
+                        for number, names in enumerate(SAMPLE_GROUPS)
+                        if all(name in header for name in names)]
+
+    def stratum(self, series_dir):
+        """
+        --sample-series でシリーズを選ぶ層（推定に使う出力の対象のシリーズなら True）を返す
+        """
+        return self.series_filter is None or bool(self.series_filter(series_dir))
+
+    def series(self, subject, series):
+        """
+        被験者のシリーズ [(シリーズディレクトリ, 代表ファイル), ...] から、層ごとに --sample-series の数だけ選んで返す
+        （順序は保つ）
+        """
+        series = list(series)
+        if self.per_subject is None:
+            return series
+        strata = {}
+        for series_dir, _ in series:
+            strata.setdefault(self.stratum(series_dir), []).append(series_dir)
+        chosen = set()
+        weights = {}
+        for stratum, series_dirs in strata.items():
+            if len(series_dirs) > self.per_subject:
+                keys = {series_dir: self.key(subject, os.path.basename(os.path.normpath(series_dir)))
+                        for series_dir in series_dirs}
+                series_dirs = sorted(series_dirs, key=keys.get)[:self.per_subject]
+                weights[stratum] = len(keys) / len(series_dirs)
+            chosen.update(series_dirs)
+        if weights:
+            self.series_weights[subject] = weights
+        return [entry for entry in series if entry[0] in chosen]
+
+    def series_weight(self, subject, series_dir):
+        """
+        被験者 subject のシリーズ series_dir が代表する、被験者の中のシリーズ数を返す（--sample-series の分）
+        """
+        weights = self.series_weights.get(subject)
+        return weights.get(self.stratum(series_dir), 1.0) if weights else 1.0
+
+    def subject_weight(self):
+        """
+        標本の被験者1人が代表する被験者数を返す（--sample-time では最後まで決まらない）
+        """
+        return self.population / max(self.sampled, 1)
+
+    def weight(self, subject, series_dir):
+        """
+        被験者 subject のシリーズ series_dir の1行が代表するシリーズ数を返す
+        """
+        return self.subject_weight() * self.series_weight(subject, series_dir)
+
+    def observe(self, subject, series_dir, row):
+        """
+        推定に使う出力（target()）に書かれた行を、推定のために数える
+        """
+        weight = self.series_weight(subject, series_dir)
+        stats = self.stats.setdefault(subject, {})
+        stats[None] = stats.get(None, 0.0) + weight
+        for number, indexes in self.columns:
+            key = (number, " / ".join(str(row[i]) or "-" for i in indexes))
+            stats[key] = stats.get(key, 0.0) + weight
+
+    def estimate(self, key):
+        """
+        key の区分のシリーズ数を標本から推定し、(推定値, 信頼区間の半幅) を返す（key が None なら全シリーズ）
+        被験者をクラスタとみなした分散を使い、--sample-series がなければ有限母集団修正をかける
+        標本の被験者が 2 人未満なら半幅は None
+        """
+        n, population = self.sampled, self.population
+        values = [stats.get(key, 0.0) for stats in self.stats.values()]
+        mean = sum(values) / max(n, 1)
+        if n < 2:
+            return population * mean, None
+        # 行のない被験者は 0 として数える
+        variance = (sum(v * v for v in values) - n * mean * mean) / (n - 1)
+        fpc = 1 - n / population if self.per_subject is None else 1.0
+        return population * mean, SAMPLE_Z * population * (max(fpc * variance, 0.0) / n) ** 0.5
+
+    def share(self, key, total):
+        """
+        key の区分の構成比を比推定し、(構成比, 信頼区間の半幅) を返す（total は全シリーズの標本上の重み付き合計）
+        """
+        n = self.sampled
+        part = sum(stats.get(key, 0.0) for stats in self.stats.values())
+        ratio = part / total
+        if n < 2:
+            return ratio, None
+        residuals = sum((stats.get(key, 0.0) - ratio * stats.get(None, 0.0)) ** 2 for stats in self.stats.values())
+        fpc = 1 - n / self.population if self.per_subject is None else 1.0
+        mean = total / n
+        return ratio, SAMPLE_Z * (max(fpc, 0.0) * residuals / (n * (n - 1))) ** 0.5 / mean
+
+    def report(self):
+        """
+        標本から推定した全シリーズ数と SAMPLE_GROUPS の構成比（95% 信頼区間付き）を表にした文字列を返す
+        """
+        design = [f"{self.sampled} of {self.population} subjects"]
+        if self.fraction is not None:
+            design.append(f"fraction {self.fraction:g}")
+        if self.per_subject is not None:
+            design.append(f"up to {self.per_subject} series per subject")
+        if self.budget is not None:
+            design.append(f"time budget {self.budget:g} s")
+        design.append(f"seed {self.seed}")
+        lines = [f"--- sample: {', '.join(design)} ---"]
+        total, half = self.estimate(None)
+        interval = "n/a" if half is None else f"{max(total - half, 0):.0f} - {total + half:.0f}"
+        lines.append(f"estimated series: {total:.0f}  (95% CI {interval})")
+        observed = sum(stats.get(None, 0.0) for stats in self.stats.values())
+        if not observed:
+            return "\n".join(lines)
+        for number, _ in self.columns:
+            keys = {key for stats in self.stats.values() for key in stats if key is not None and key[0] == number}
+            shares = sorted(((key[1], *self.share(key, observed)) for key in keys), key=lambda item: -item[1])
+            lines.append(f"{' / '.join(SAMPLE_GROUPS[number]):<40}{'share':>8}  {'95% CI':<17}{'series':>10}")
+            for label, ratio, half in shares[:SAMPLE_TOP]:
+                interval = "n/a" if half is None else f"{max(ratio - half, 0):.1%} - {min(ratio + half, 1):.1%}"
+                lines.append(f"{label[:39]:<40}{ratio:>8.1%}  {interval:<17}{ratio * total:>10.0f}")
+            if len(shares) > SAMPLE_TOP:
+                lines.append(f"({len(shares) - SAMPLE_TOP} more)")
+        return "\n".join(lines)
+
+
+def make_sampler(args):
+    """
+    --sample-subjects / --sample-series / --sample-time / --seed から Sampler を作る（どれも指定がなければ None）
+    """
+    if args.sample_subjects is None and args.sample_series is None and args.sample_time is None:
+        return None
+    return Sampler(args.sample_subjects, args.sample_series, args.sample_time, args.seed)
+
+def index_subject(subj_dir, pattern):
+    """
+    被験者ディレクトリを os.scandir（アーカイブ内は scan_dir()）で1回だけ走査し、
+    (被験者ディレクトリ内の最初のファイル, [(シリーズディレクトリ, 代表ファイル), ...]) を返す
+    シリーズディレクトリは名前が pattern（例："SE000*"）に一致するディレクトリで、
+    並び順は glob("**/pattern") と同じで、代表ファイルは各シリーズディレクトリ以下を再帰的に探して最初に見つかったファイル
+    ファイルは d_type で判定するので、ファイルごとに stat はしない
+    """
+    series = []
+
+    def walk(path):
+        # path 以下の最初のファイルを返しつつ、一致したシリーズディレクトリを series に追加する
+        try:
+            with scan_dir(path) as it:
+                entries = [e for e in it if not e.name.startswith(".")]
+        except OSError:
+            return ""
+        found = {}
+        for entry in entries:
+            if fnmatch.fnmatch(entry.name, pattern) and entry.is_dir():
+                found[entry.path] = len(series)
+                series.append([entry.path, ""])
+        first = ""
+        for entry in entries:
+            if entry.is_dir():
+                sub_first = walk(entry.path)
+                if entry.path in found:
+                    series[found[entry.path]][1] = sub_first
+                if not first:
+                    first = sub_first
+            elif not first and entry.is_file():
+                first = entry.path
+        return first
+
+    with TIMER.stage("walk"):
+        first_file = walk(subj_dir)
+    return first_file, [(series_dir, rep) for series_dir, rep in series if rep]
+
+class UidSeriesDir(str):
+    """
+    --group-by-uid のシリーズを表すパス（uid_series_dir() が作る）
+    count に index_subject_by_uid() で数えたシリーズのファイル数を持ち、タスクと一緒にワーカープロセスにも渡る
+    （series_headers() はその数のファイルが見つかった時点で走査を止める。None なら数えていない）
+    """
+    count = None
+
+def uid_series_dir(directory, uid, count=None):
+    """
+    --group-by-uid のシリーズを表すパス（"<ディレクトリ>/UID=<SeriesInstanceUID>"）を作る
+    count にはそのシリーズのファイル数を渡せる（index_subject_by_uid() で数えたもの）
+    """
+    path = UidSeriesDir(os.path.join(directory, UID_SERIES_PREFIX + uid))
+    path.count = count
+    return path
+
+def split_series_dir(series_dir):
+    """
+    uid_series_dir() で作ったパスなら (ディレクトリ, SeriesInstanceUID)、
+    通常のシリーズディレクトリなら (series_dir, None) を返す
+    """
+    head, tail = os.path.split(os.path.normpath(series_dir))
+    if tail.startswith(UID_SERIES_PREFIX) and not is_dir(series_dir):
+        return head, tail[len(UID_SERIES_PREFIX):]
+    return series_dir, None
+
+def index_subject_by_uid(subj_dir):
+    """
+    被験者ディレクトリ以下の全ファイルを1回だけ走査し、各ファイルのヘッダを SeriesInstanceUID まで読んで
+    (StudyInstanceUID, SeriesInstanceUID) ごとにまとめる
+    (被験者ディレクトリ内の最初の DICOM ファイル, [(uid_series_dir(), 代表ファイル), ...]) を
+    index_subject() と同じ形で返す
+    シリーズは最初に見つかった順で、代表ファイルはそのシリーズで最初に見つかったファイル
+    保持するのはシリーズごとのディレクトリ・代表ファイル・ファイル数だけなので、ファイル数が多くてもメモリ使用量は増えない
+    シリーズのファイルが必要な処理（DTI の b 値・軸数、mrinfo）は、そのシリーズだけ series_headers() で探し直す
+    内蔵のリーダーで読めないファイル（DICOM 以外や deflate 圧縮）は飛ばす
+    """
+    buckets = {}  # (StudyInstanceUID, SeriesInstanceUID) -> [ディレクトリ, 代表ファイル, ファイル数]
+    first_file = ""
+    stack = [subj_dir]
+    with TIMER.stage("walk"):
+        while stack:
+            path = stack.pop()
+            subdirs = []
+            try:
+                # 1つのディレクトリに大量のファイルがあってもエントリをためずに1つずつ処理する
+                with scan_dir(path) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        try:
+                            header = read_dicom_header(entry.path, UID_TAGS)
+                        except (ValueError, EOFError, struct.error, OSError):
+                            continue
+                        if not first_file:
+                            first_file = entry.path
+                        uid = header.get("0020,000E")
+                        if not uid:
+                            continue
+                        key = (header.get("0020,000D", ""), uid)
+                        bucket = buckets.get(key)
+                        if bucket is None:
+                            buckets[key] = [path, entry.path, 1]
+                            continue
+                        bucket[2] += 1
+                        if bucket[0] != path:
+                            # シリーズのファイルが複数のディレクトリにあれば、共通の親ディレクトリを使う
+                            bucket[0] = os.path.commonpath([bucket[0], path])
+            except OSError:
+                continue
+            # 深さ優先で、サブディレクトリは見つかった順に処理する
+            stack.extend(reversed(subdirs))
+    return first_file, [(uid_series_dir(directory, uid, count), rep)
+                        for (_, uid), (directory, rep, count) in buckets.items()]
+
+def series_headers(series_dir, tags, frame_tags=None):
+    """
+    シリーズの各ファイルのヘッダを read_dicom_header() で読み、(パス, ヘッダ) を順に返す（読めないファイルは飛ばす）
+    uid_series_dir() のシリーズは、ディレクトリ以下のファイルのうち SeriesInstanceUID が一致するものだけを返し
+    （UID も同じ1回の読み込みで読む）、index_subject_by_uid() で数えたファイル数に達したらそれ以上は読まない
+    """
+    directory, uid = split_series_dir(series_dir)
+    remaining = None
+    if uid is not None:
+        tags = (*tags, *UID_TAGS[1:])
+        remaining = getattr(series_dir, "count", None)
+    for path in list_series_files(directory):
+        try:
+            header = read_dicom_header(path, tags, frame_tags)
+        except (ValueError, EOFError, struct.error, OSError):
+            continue
+        if uid is not None and header.get("0020,000E") != uid:
+            continue
+        yield path, header
+        if remaining is not None:
+            remaining -= 1
+            if not remaining:
+                return
+
+def series_files(series_dir):
+    """
+    シリーズのファイルを返す（uid_series_dir() のシリーズならディレクトリ以下からその UID のファイルだけを選ぶ）
+    """
+    if split_series_dir(series_dir)[1] is None:
+        return list_series_files(series_dir)
+    return [path for path, _ in series_headers(series_dir, ())]
+
+@contextmanager
+def series_input(series_dir):
+    """
+    mrinfo に渡すディレクトリを返すコンテキストマネージャ
+    uid_series_dir() のシリーズは、そのシリーズのファイルへのシンボリックリンクだけを置いた一時ディレクトリを渡す
+    アーカイブ内のシリーズは mrinfo が直接読めないので、そのシリーズのファイルだけを一時ディレクトリに書き出して渡す
+    """
+    directory, uid = split_series_dir(series_dir)
+    archive = split_archive(directory)[0]
+    if uid is None and archive is None:
+        yield series_dir
+        return
+    with tempfile.TemporaryDirectory(prefix="dicom2csv_") as tmp:
+        for i, path in enumerate(series_files(series_dir)):
+            target = os.path.join(tmp, f"{i:06d}_{os.path.basename(path)}")
+            if archive is None:
+                os.symlink(os.path.abspath(path), target)
+                continue
+            with open_file(path) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        yield tmp
+
+def get_jobs(jobs):
+    """
+    --jobs の値から実際のワーカー数を返す（0 以下なら CPU 数）
+    """
+    return jobs if jobs > 0 else (os.cpu_count() or 1)
+
+def series_fingerprint(series_dir, rep_dcm):
+    """
+    代表ファイルのパス・サイズ・更新時刻と、シリーズディレクトリの更新時刻から指紋を作る
+    ディレクトリの更新時刻はファイルの追加・削除で変わるので、シリーズの増減も検出できる
+    アーカイブ内のシリーズは、代表ファイルのパスとアーカイブのサイズ・更新時刻から作る
+    """
+    archive = split_archive(rep_dcm)[0]
+    try:
+        if archive is not None:
+            stat = os.stat(archive)
+            return f"{rep_dcm}|{stat.st_size}|{stat.st_mtime_ns}"
+        rep = os.stat(rep_dcm)
+        directory = os.stat(split_series_dir(series_dir)[0])
+    except OSError:
+        return None
+    return f"{rep_dcm}|{rep.st_size}|{rep.st_mtime_ns}|{directory.st_mtime_ns}"
+
+
+class ScanCache:
+    """
+    シリーズごとの処理結果（CSV の行）を SQLite に保存するキャッシュ
+    キーはスクリプト名・タグの読み方（--backend）・mrinfo を使えるか（probe_mode()）と
+    タスク（被験者情報・シリーズディレクトリ・代表ファイル）で、指紋（series_fingerprint）が一致したときだけ保存済みの結果を使う
+    （読み方や mrinfo の有無で値が変わりうるので、別の読み方で保存した結果は使わない）
+    --shard の並列ジョブなど複数の実行で共有できるように、WAL で開き、結果は BATCH_SIZE 個ずつ
+    短いトランザクションでまとめて書き込む（書き込みのロックを持つのはその間だけ）
+    """
+
+    MISS = object()
+    BATCH_SIZE = 100
+
+    def __init__(self, path, name):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS series ("
+                        "name TEXT, task TEXT, fingerprint TEXT, row TEXT, PRIMARY KEY (name, task))")
+        self.name = f"{name}:{CACHE_VERSION}:{HEADER_BACKEND[0].name}:{probe_mode()}"
+        self.pending = []
+        set_probe_cache(os.path.splitext(path)[0] + "_mrinfo.sqlite")
+
+    def key(self, task):
+        return json.dumps(list(task), ensure_ascii=False, sort_keys=True)
+
+    def get(self, task, fingerprint):
+        """
+        保存済みの結果を返す（ないか指紋が変わっていれば ScanCache.MISS）
+        """
+        if fingerprint is None:
+            return self.MISS
+        found = self.db.execute("SELECT fingerprint, row FROM series WHERE name = ? AND task = ?",
+                                (self.name, self.key(task))).fetchone()
+        if found is None or found[0] != fingerprint:
+            return self.MISS
+        return json.loads(found[1])
+
+    def put(self, task, fingerprint, row):
+        if fingerprint is None:
+            return
+        self.pending.append((self.name, self.key(task), fingerprint, json.dumps(row, ensure_ascii=False)))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        たまった結果を1つのトランザクションで書き込む
+        """
+        if not self.pending:
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?)", self.pending)
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class Progress:
+    """
+    進捗（処理済みシリーズ数・シリーズ/秒・サブプロセスの平均時間・残り時間の見込み）を interval 秒ごとに
+    標準エラーに表示し、metrics_path を指定した場合は Prometheus の textfile 形式
+    （node exporter の textfile collector 用）でも書き出す
+    残り時間は、base_dir 直下の被験者ディレクトリ（find_subjects() の順）のどこまで進んだかから見積もる
+    """
+
+    METRICS_INTERVAL = 5.0
+
+    def __init__(self, base_dir, name, interval=None, metrics_path=None, shard=None):
+        self.order = {subject: i for i, (subject, _) in enumerate(find_subjects(base_dir, shard))}
+        self.name = name
+        self.interval = interval
+        self.metrics_path = metrics_path
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.series = 0
+        self.cached = 0
+        self.subprocesses = 0      # ワーカープロセスで起動したサブプロセスの数と合計時間
+        self.subprocess_seconds = 0.0
+        self.local = tuple(SUBPROCESS_STATS)  # このプロセスの開始時点の値
+        self.first = None          # 最初に処理した被験者の位置
+        self.position = 0          # 処理中の被験者の位置
+        self.next_report = self.start + (interval or 0)
+        self.next_metrics = self.start
+
+    def add_subprocesses(self, pid, count, seconds):
+        # このプロセスの分は SUBPROCESS_STATS から直接数える
+        if pid != os.getpid():
+            self.subprocesses += count
+            self.subprocess_seconds += seconds
+
+    def update(self, task, cached=False):
+        """
+        1シリーズ分の処理が終わるたびに呼ぶ（表示と書き出しは間隔を空けて行う）
+        """
+        self.series += 1
+        self.cached += cached
+        position = self.order.get(task[0])
+        if position is not None:
+            if self.first is None:
+                self.first = position
+            self.position = position
+        now = time.perf_counter()
+        if self.interval and now >= self.next_report:
+            self.next_report = now + self.interval
+            print(self.status(now), file=sys.stderr, flush=True)
+        if self.metrics_path and now >= self.next_metrics:
+            self.next_metrics = now + self.METRICS_INTERVAL
+            self.write_metrics(now, running=True)
+
+    def stats(self, now):
+        elapsed = now - self.start
+        subprocesses = self.subprocesses + SUBPROCESS_STATS[0] - self.local[0]
+        subprocess_seconds = self.subprocess_seconds + SUBPROCESS_STATS[1] - self.local[1]
+        done = self.position - self.first if self.first is not None else 0
+        remaining = len(self.order) - self.position
+        eta = elapsed / done * remaining if done > 0 else None
+        return elapsed, subprocesses, subprocess_seconds, eta
+
+    def status(self, now):
+        elapsed, subprocesses, subprocess_seconds, eta = self.stats(now)
+        rate = self.series / elapsed if elapsed > 0 else 0.0
+        latency = f"{subprocess_seconds / subprocesses * 1000:.1f} ms" if subprocesses else "-"
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "-"
+        if eta is not None and eta >= 86400:
+            eta_text = f"{int(eta // 86400)}d " + eta_text
+        return (f"[progress] {self.series} series ({self.cached} cached), subject {self.position + 1}/{len(self.order)}, "
+                f"{rate:.1f} series/s, subprocess {subprocesses} (avg {latency}), ETA {eta_text}")
+
+    def write_metrics(self, now, running):
+        elapsed, subprocesses, subprocess_seconds, eta = self.stats(now)
+        label = '{script="' + self.name + '"}'
+        metrics = [
+            ("series_total", "counter", "Series processed so far.", self.series),
+            ("series_cached_total", "counter", "Series taken from the scan cache.", self.cached),
+            ("subjects_total", "gauge", "Subject directories under the base directory.", len(self.order)),
+            ("subject_position", "gauge", "Index of the subject being processed.", self.position),
+            ("series_per_second", "gauge", "Average series throughput since the start.",
+             self.series / elapsed if elapsed > 0 else 0.0),
+            ("subprocess_total", "counter", "External commands (mrinfo, dcmdump) run.", subprocesses),
+            ("subprocess_seconds_total", "counter", "Time spent in external commands.", subprocess_seconds),
+            ("eta_seconds", "gauge", "Estimated seconds until the run finishes (-1 if unknown).",
+             eta if eta is not None else -1),
+            ("start_time_seconds", "gauge", "Unix time the run started.", self.started),
+            ("last_update_time_seconds", "gauge", "Unix time of this update.", time.time()),
+            ("running", "gauge", "1 while the run is in progress, 0 when it has stopped.", int(running)),
+        ]
+        lines = []
+        for metric, kind, help_text, value in metrics:
+            lines.append(f"# HELP dicom2csv_{metric} {help_text}")
+            lines.append(f"# TYPE dicom2csv_{metric} {kind}")
+            lines.append(f"dicom2csv_{metric}{label} {value}")
+        # node exporter が書きかけのファイルを読まないように、一時ファイルに書いてから rename する
+        tmp = self.metrics_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.metrics_path)
+
+    def finish(self):
+        """
+        最後の進捗を表示し、メトリクスを running=0 で書き出す
+        """
+        now = time.perf_counter()
+        if self.interval:
+            print(self.status(now), file=sys.stderr, flush=True)
+        if self.metrics_path:
+            self.write_metrics(now, running=False)
+
+class InlineExecutor:
+    """
+    jobs が 1 のときに ProcessPoolExecutor の代わりに使う、submit されたタスクをその場で実行するエグゼキュータ
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def run_series(func, tasks, jobs=1, cache=None, profiler=None, progress=None):
+    """
+    各シリーズのタスクに func を適用し、(タスク, 結果) を tasks と同じ順序で返すイテレータ
+    tasks はジェネレータでもよく、先読みは jobs の数倍までに抑えるのでメモリ使用量は一定
+    jobs が 2 以上ならプロセスプールで並列に実行する（func はモジュールのトップレベルに定義すること）
+    タスクは (..., シリーズディレクトリ, 代表ファイル) の形で、cache を指定した場合は
+    変更のないシリーズの結果をキャッシュから返し、残りだけを func で処理する
+    profiler（Profiler）を指定した場合は各シリーズのステージごとの時間を記録し、
+    progress（Progress）を指定した場合は各シリーズが終わるたびに進捗を更新する
+    内蔵のリーダーで読めず dcmdump が必要になったシリーズは後回しにし、最大 DCMDUMP_BATCH 個先まで
+    読み進めてから、それらのファイルを1回の dcmdump でまとめて読んで実行し直す
+    （1つのタスクにつき DCMDUMP_DEFER_FILES 個のファイルまで、読んだ出力をためながら繰り返す）
+    """
+    instrumented = profiler is not None or progress is not None
+    call = partial(call_deferrable, partial(timed_call, func, profiler is not None) if instrumented else func)
+    lookahead = jobs * 4
+    limit = lookahead + DCMDUMP_BATCH
+
+    def lookup(task):
+        if cache is None:
+            return None, ScanCache.MISS
+        with TIMER.stage("cache"):
+            fingerprint = series_fingerprint(task[-2], task[-1])
+            hit = cache.get(task, fingerprint)
+        if profiler is not None and hit is not ScanCache.MISS:
+            profiler.cached += 1
+        return fingerprint, hit
+
+    def finish(task, fingerprint, result):
+        if instrumented:
+            result, (events, pid, count, seconds, files, nbytes) = result
+            if profiler is not None:
+                profiler.add_series(task[-2], events, pid, files, nbytes)
+            if progress is not None:
+                progress.add_subprocesses(pid, count, seconds)
+        if cache is not None and fingerprint is not None:
+            with TIMER.stage("cache"):
+                cache.put(task, fingerprint, result)
+        if progress is not None:
+            progress.update(task)
+        return result
+
+    def cached(task, hit):
+        if progress is not None:
+            progress.update(task, cached=True)
+        return hit
+
+    def take(entry):
+        task, fingerprint, hit, future = entry[:4]
+        return task, (cached(task, hit) if future is None else finish(task, fingerprint, future.result()))
+
+    def deferred(entry):
+        # 終わったタスクが dcmdump 待ちなら、読むファイルを entry[4] に記録して真を返す
+        future = entry[3]
+        if entry[4] is None and future is not None and future.done() and future.exception() is None:
+            result = future.result()
+            if isinstance(result, DcmdumpDeferred):
+                entry[4] = result.path
+        return entry[4] is not None
+
+    def flush(executor, window):
+        # dcmdump 待ちのタスクのファイルをまとめて読み、それまでの出力と合わせて渡して実行し直す
+        waiting = [entry for entry in window if deferred(entry)]
+        dumps = run_dcmdump_batch(list(dict.fromkeys(entry[4] for entry in waiting)))
+        for entry in waiting:
+            entry[5] = {**entry[5], entry[4]: dumps[entry[4]]}
+            entry[3] = executor.submit(call, entry[0], entry[5])
+            entry[4] = None
+
+    def drain(executor, window, lookahead, limit):
+        # 先頭のタスクから順に結果を返す（順序は逐次実行と同じ）
+        while window:
+            head = window[0]
+            if head[3] is not None and not head[3].done():
+                if len(window) <= lookahead:
+                    return
+                wait([head[3]])
+            if deferred(head):
+                if len(window) <= limit:
+                    return
+                flush(executor, window)
+                continue
+            yield take(window.popleft())
+
+    pool = partial(ProcessPoolExecutor, max_workers=jobs, initializer=init_worker,
+                   initargs=(MRINFO_PROBES.path, HEADER_BACKEND[0].name))
+    with pool() if jobs > 1 else InlineExecutor() as executor:
+        window = deque()  # [タスク, 指紋, キャッシュの結果, Future, dcmdump 待ちのファイル, 読んだ dcmdump の出力]
+        for task in tasks:
+            fingerprint, hit = lookup(task)
+            future = executor.submit(call, task) if hit is ScanCache.MISS else None
+            window.append([task, fingerprint, hit, future, None, {}])
+            yield from drain(executor, window, lookahead, limit)
+        yield from drain(executor, window, -1, -1)
+
+class CsvStream:
+    """
+    CSV を1行ずつ書き出すライター（行をメモリにためない）
+    書き込み中は "<出力名>.part" に1行ごとに flush しながら追記するので途中経過も読める
+    正常に終了したときだけ出力名に rename する（途中で止まった場合は .part が残る）
+    処理済みのシリーズと被験者は "<出力名>.journal" に記録し、resume=True なら
+    前回の .part と .journal を引き継いで、処理済みのものを飛ばして追記できる
+    scale に (列番号, 倍率) を設定しておくと、rename する前にその列の値に倍率をかける（SampledOutput が使う）
+    """
+
+    def __init__(self, path, header, resume=False):
+        self.path = path
+        self.part = path + ".part"
+        self.journal_path = path + ".journal"
+        self.done_series = set()
+        self.done_subjects = set()
+        self.subject = None
+        self.scale = None
+        offset = self.load_journal() if resume else None
+        if offset is None:
+            self.f = open(self.part, "w", newline="", encoding="utf-8")
+            self.journal = open(self.journal_path, "w", encoding="utf-8")
+            self.writer = csv.writer(self.f)
+            self.writerow(header)
+            self.log("header", "")
+        else:
+            # ジャーナルに記録されていない書きかけの行は捨ててから追記する
+            os.truncate(self.part, offset)
+            self.f = open(self.part, "a", newline="", encoding="utf-8")
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+            self.writer = csv.writer(self.f)
+
+    def load_journal(self):
+        """
+        前回のジャーナルを読み、最後に記録された .part のサイズを返す（引き継げなければ None）
+        """
+        if not (os.path.isfile(self.part) and os.path.isfile(self.journal_path)):
+            return None
+        offset = None
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    kind, size, name = json.loads(line)
+                except ValueError:
+                    break  # 書きかけの最終行
+                offset = size
+                if kind == "series":
+                    self.done_series.add(name)
+                elif kind == "subject":
+                    self.done_subjects.add(name)
+        if offset is None or os.path.getsize(self.part) < offset:
+            self.done_series.clear()
+            self.done_subjects.clear()
+            return None
+        return offset
+
+    def log(self, kind, name):
+        self.journal.write(json.dumps([kind, os.fstat(self.f.fileno()).st_size, name],
+                                      ensure_ascii=False) + "\n")
+        self.journal.flush()
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        self.f.flush()
+
+    def add(self, subject, series_dir, row):
+        """
+        1シリーズ分の結果を書き込み、ジャーナルに処理済みとして記録する（row が None なら記録だけ）
+        被験者が変わった時点で、前の被験者も処理済みとして記録する
+        """
+        with TIMER.stage("csv_write"):
+            if self.subject is not None and subject != self.subject:
+                self.log("subject", self.subject)
+            self.subject = subject
+            if row:
+                self.writerow(row)
+            self.log("series", series_dir)
+
+    def close(self):
+        self.f.close()
+        self.journal.close()
+        if self.scale:
+            scale_csv_column(self.part, *self.scale)
+        os.replace(self.part, self.path)
+        os.remove(self.journal_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.journal.close()
+
+def scale_csv_column(path, column, factor):
+    """
+    CSV の column 列目の値（ヘッダーを除く）に factor をかけて書き直す（1行ずつ読み書きするので行をメモリにためない）
+    """
+    with open(path, newline="", encoding="utf-8") as src, \
+            open(path + ".tmp", "w", newline="", encoding="utf-8") as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst)
+        writer.writerow(next(reader))
+        for row in reader:
+            row[column] = round(float(row[column]) * factor, 6)
+            writer.writerow(row)
+    os.replace(path + ".tmp", path)
+
+def convert_value(value, kind):
+    """
+    CSV に書く文字列の値を COLUMN_TYPES の型に変換する（空の値や変換できない値は None）
+    数値の列に複数の値（"\\" 区切り）があれば最初の値を使い、リストの列は "," と "\\" で区切る
+    """
+    if value is None or value == "":
+        return None
+    value = str(value)
+    try:
+        if kind == "str":
+            return value
+        if kind == "date":
+            return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+        if kind in ("float", "int"):
+            first = value.split("\\")[0]
+            return float(first) if kind == "float" else int(float(first))
+        items = [item for item in re.split(r"[,\\]", value) if item.strip()]
+        return [float(item) if kind == "float_list" else int(float(item)) for item in items]
+    except ValueError:
+        return None
+
+class ArrowStream:
+    """
+    --format parquet / arrow 用のライター（CsvStream と同じように使える）
+    数値の列は数値型、b 値などは list 型にして、ROW_GROUP_SIZE 行ごとに
+    Parquet の row group（Arrow IPC ではレコードバッチ）として書き出すので、行をメモリにためない
+    書き込み中は "<出力名>.part" に書き、正常に終了したときだけ rename する（--resume には対応しない）
+    scale は CsvStream と同じ（rename する前に .part をレコードバッチごとに読んで書き直す）
+    """
+
+    ROW_GROUP_SIZE = 10000
+
+    def __init__(self, path, header, fmt):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(f"--format {fmt} には pyarrow が必要です（pip install pyarrow）") from None
+        types = {
+            "str": pa.string(), "date": pa.date32(), "float": pa.float64(), "int": pa.int64(),
+            "float_list": pa.list_(pa.float64()), "int_list": pa.list_(pa.int64()),
+        }
+        self.pa = pa
+        self.pq = pq
+        self.fmt = fmt
+        self.path = path
+        self.part = path + ".part"
+        self.stage = f"{fmt}_write"
+        self.done_series = set()
+        self.done_subjects = set()
+        self.scale = None
+        self.kinds = [COLUMN_TYPES.get(column, "str") for column in header]
+        self.schema = pa.schema([(column, types[kind]) for column, kind in zip(header, self.kinds)])
+        self.rows = []
+        self.writer, self.sink = self.open_writer(self.part)
+
+    def open_writer(self, path):
+        """
+        path に書き出すライターと、その出力先（Arrow IPC のとき。Parquet では None）を返す
+        """
+        if self.fmt == "parquet":
+            return self.pq.ParquetWriter(path, self.schema), None
+        sink = self.pa.OSFile(path, "wb")
+        return self.pa.ipc.new_file(sink, self.schema), sink
+
+    def read_batches(self, path):
+        """
+        書き出したファイルをレコードバッチ（Parquet では ROW_GROUP_SIZE 行）ごとに読む
+        """
+        if self.fmt == "parquet":
+            yield from self.pq.ParquetFile(path).iter_batches(batch_size=self.ROW_GROUP_SIZE)
+            return
+        with self.pa.memory_map(path) as source:
+            reader = self.pa.ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                yield reader.get_batch(index)
+
+    def rescale(self):
+        """
+        書き終えた .part の scale の列に倍率をかけて書き直す
+        """
+        import pyarrow.compute as pc
+        column, factor = self.scale
+        writer, sink = self.open_writer(self.part + ".tmp")
+        for batch in self.read_batches(self.part):
+            arrays = batch.columns
+            arrays[column] = pc.round(pc.multiply(arrays[column], factor), 6)
+            writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        writer.close()
+        if sink is not None:
+            sink.close()
+        os.replace(self.part + ".tmp", self.part)
+
+    def flush(self):
+        """
+        たまった行を1つの row group（レコードバッチ）として書き出す
+        """
+        if not self.rows:
+            return
+        columns = zip(*self.rows)
+        arrays = [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)]
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def add(self, subject, series_dir, row):
+        """
+        1シリーズ分の結果を追加する（row が None なら何もしない）
+        """
+        with TIMER.stage(self.stage):
+            if row:
+                self.rows.append([convert_value(value, kind) for value, kind in zip(row, self.kinds)])
+                if len(self.rows) >= self.ROW_GROUP_SIZE:
+                    self.flush()
+
+    def close(self, rename=True):
+        self.flush()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        if rename:
+            if self.scale:
+                self.rescale()
+            os.replace(self.part, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 途中で止まった場合も、それまでの行は読める形で .part に残す
+        self.close(rename=exc_type is None)
+
+class SqliteStream:
+    """
+    --format sqlite 用のライター（CsvStream と同じように使える）
+    series テーブルに1シリーズ1行で、数値の列は REAL / INTEGER、日付は "YYYY-MM-DD"、list の列は JSON で入れる
+    DTI のシリーズは shells テーブル（series_id, bvalue, volumes）にもシェルごとに1行入れるので、
+    "b > 1000 のシェルを持つシリーズ" のような検索も索引で引ける
+    挿入は BATCH_SIZE 行ごとにまとめて1トランザクションで行い、索引は最後にまとめて作る
+    書き込み中は "<出力名>.part" に書き、正常に終了したときだけ rename する（--resume には対応しない）
+    scale は CsvStream と同じ（rename する前に UPDATE する）
+    """
+
+    BATCH_SIZE = 5000
+    SQL_TYPES = {"str": "TEXT", "date": "TEXT", "float": "REAL", "int": "INTEGER",
+                 "float_list": "TEXT", "int_list": "TEXT"}
+
+    def __init__(self, path, header):
+        self.path = path
+        self.part = path + ".part"
+        self.done_series = set()
+        self.done_subjects = set()
+        self.header = header
+        self.kinds = [COLUMN_TYPES.get(column, "str") for column in header]
+        self.shell_columns = None
+        if "DTI_bvalues" in header and "DTI_ShellSizes" in header:
+            self.shell_columns = (header.index("DTI_bvalues"), header.index("DTI_ShellSizes"))
+        if os.path.exists(self.part):
+            os.remove(self.part)
+        self.db = sqlite3.connect(self.part)
+        # 完成するまでは .part なので、ジャーナルと同期は省いて書き込みを速くする
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        columns = ", ".join(f'"{column}" {self.SQL_TYPES[kind]}' for column, kind in zip(header, self.kinds))
+        self.db.execute(f"CREATE TABLE series (series_id INTEGER PRIMARY KEY, {columns})")
+        self.db.execute("CREATE TABLE shells (series_id INTEGER REFERENCES series(series_id), "
+                        "bvalue REAL, volumes INTEGER)")
+        self.insert_series = f"INSERT INTO series VALUES ({', '.join('?' * (len(header) + 1))})"
+        self.series_id = 0
+        self.rows = []
+        self.shells = []
+        self.scale = None
+
+    def convert(self, value, kind):
+        value = convert_value(value, kind)
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        if isinstance(value, list):
+            return json.dumps(value)
+        return value
+
+    def flush(self):
+        """
+        たまった行を1トランザクションでまとめて挿入する
+        """
+        if not self.rows:
+            return
+        with self.db:
+            self.db.executemany(self.insert_series, self.rows)
+            self.db.executemany("INSERT INTO shells VALUES (?, ?, ?)", self.shells)
+        self.rows = []
+        self.shells = []
+
+    def add(self, subject, series_dir, row):
+        """
+        1シリーズ分の結果を追加する（row が None なら何もしない）
+        """
+        with TIMER.stage("sqlite_write"):
+            if not row:
+                return
+            self.series_id += 1
+            values = [self.convert(value, kind) for value, kind in zip(row, self.kinds)]
+            self.rows.append([self.series_id] + values)
+            if self.shell_columns:
+                bvalues = convert_value(row[self.shell_columns[0]], "float_list") or []
+                sizes = convert_value(row[self.shell_columns[1]], "int_list") or []
+                self.shells.extend((self.series_id, b, n) for b, n in zip(bvalues, sizes))
+            if len(self.rows) >= self.BATCH_SIZE:
+                self.flush()
+
+    def close(self, rename=True):
+        self.flush()
+        if rename:
+            with self.db:
+                if self.scale:
+                    index, factor = self.scale
+                    name = self.header[index]
+                    self.db.execute(f'UPDATE series SET "{name}" = round("{name}" * ?, 6)', (factor,))
+                for column in SQLITE_INDEXES:
+                    if column in self.header:
+                        self.db.execute(f'CREATE INDEX "idx_series_{column}" ON series ("{column}")')
+                self.db.execute("CREATE INDEX idx_shells_bvalue ON shells (bvalue, series_id)")
+        self.db.close()
+        if rename:
+            os.replace(self.part, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 途中で止まった場合も、それまでの行は .part に残す
+        self.close(rename=exc_type is None)
+
+class SampledOutput:
+    """
+    標本抽出したときの出力（open_output() の sampler を指定した場合）
+    各行の末尾に重み（SampleWeight）を付けて書き出し、target が真なら推定のために行を Sampler に渡す
+    --sample-time では標本の被験者数が最後まで決まらないので、行はすぐに被験者の中の重み（--sample-series の分）で
+    書き出し、正常に終了したときに被験者の重みをかける（途中で止まった .part の重みは被験者の中の重みのまま）
+    """
+
+    def __init__(self, stream, header, sampler, target=False, series_filter=None):
+        self.stream = stream
+        self.header = header
+        self.sampler = sampler
+        self.target = target
+        self.done_subjects = stream.done_subjects
+        self.done_series = stream.done_series
+        if target:
+            sampler.target(header, series_filter)
+
+    def add(self, subject, series_dir, row):
+        if row:
+            if self.target:
+                self.sampler.observe(subject, series_dir, row)
+            if self.sampler.budget is None:
+                row = row + [round(self.sampler.weight(subject, series_dir), 6)]
+            else:
+                row = row + [self.sampler.series_weight(subject, series_dir)]
+        self.stream.add(subject, series_dir, row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self.sampler.budget is not None:
+            self.stream.scale = (len(self.header), self.sampler.subject_weight())
+        return self.stream.__exit__(exc_type, exc, tb)
+
+def output_path(path, fmt, shard=None):
+    """
+    出力形式に合わせて出力名の拡張子を変える（例："results.csv" → "results.parquet"、"results.sqlite"）
+    shard に (i, N) を指定した場合はシャードごとの名前にする（例："results.shard-3-of-16.csv"）
+    """
+    base, ext = os.path.splitext(path)
+    if shard is not None:
+        base += SHARD_SUFFIX.format(*shard)
+    return base + (ext if fmt == "csv" else "." + fmt)
+
+def merged_path(path):
+    """
+    シャードの出力名からまとめた出力の名前を返す（例："out/results.shard-3-of-16.csv" → "out/results.csv"）
+    """
+    return os.path.join(os.path.dirname(path), SHARD_PATTERN.sub("", os.path.basename(path)))
+
+def write_sorted_run(chunk, directory, number):
+    """
+    (並べ替えのキー, 行) のリストをキーの順に並べ替えて一時ファイルに書き、そのパスを返す（merge_csv() で使う）
+    """
+    chunk.sort()
+    path = os.path.join(directory, f"run{number:06d}.csv")
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows(row for _, row in chunk)
+    return path
+
+def read_run(path, key):
+    """
+    write_sorted_run() で書いた一時ファイルから (並べ替えのキー, 行) を順に返す
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            yield key(row), row
+
+def merge_csv(inputs, output, chunk_rows=MERGE_CHUNK_ROWS):
+    """
+    複数の CSV（--shard の出力）を SubjectDir・SeriesDir の順に並べ替えて1つにまとめ、書き出した行数を返す
+    各 CSV を chunk_rows 行ずつ並べ替えて一時ファイルに書き、heapq.merge で順に読みながらまとめるので、
+    メモリに置くのは chunk_rows 行まで
+    全く同じ行が複数ある場合（同じシャードを2回渡した場合など）は1行だけ残す
+    ヘッダーが一致しない CSV がある場合は ValueError を送出する
+    """
+    header = None
+    with tempfile.TemporaryDirectory(prefix="dicom2csv_merge_") as tmp:
+        runs = []
+        for path in inputs:
+            with open(path, newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                file_header = next(reader, None)
+                if file_header is None:
+                    continue
+                if header is None:
+                    header, first = file_header, path
+                    columns = [header.index(c) for c in ("SubjectDir", "SeriesDir") if c in header]
+                    key = lambda row: ([row[i] for i in columns], row)
+                elif file_header != header:
+                    raise ValueError(f"header of {path} does not match {first}")
+                chunk = []
+                for row in reader:
+                    chunk.append(key(row))
+                    if len(chunk) >= chunk_rows:
+                        runs.append(write_sorted_run(chunk, tmp, len(runs)))
+                        chunk = []
+                if chunk:
+                    runs.append(write_sorted_run(chunk, tmp, len(runs)))
+        if header is None:
+            raise ValueError("no CSV header found in the inputs")
+        count = 0
+        previous = None
+        with open(output + ".part", "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for _, row in heapq.merge(*(read_run(run, key) for run in runs)):
+                if row != previous:
+                    writer.writerow(row)
+                    count += 1
+                previous = row
+        os.replace(output + ".part", output)
+    return count
+
+def open_output(path, header, fmt="csv", resume=False, sampler=None, target=True, series_filter=None):
+    """
+    出力形式に応じたライター（CsvStream・ArrowStream・SqliteStream）を返す
+    sampler（Sampler）を指定した場合は、header に SampleWeight の列を加えて SampledOutput で包み、
+    target が真なら標本からの推定にこの出力の行を使う（series_filter は Sampler.target() を参照）
+    """
+    if sampler is not None:
+        return SampledOutput(open_output(path, header + ["SampleWeight"], fmt, resume), header, sampler,
+                             target, series_filter)
+    if fmt == "csv":
+        return CsvStream(path, header, resume=resume)
+    if fmt == "sqlite":
+        return SqliteStream(path, header)
+    return ArrowStream(path, header, fmt)
+
+def add_common_arguments(parser, output_name="results.csv", english=False):
+    """
+    各スクリプトに共通のオプション（--jobs から --seed まで）を parser に加える
+    output_name は --shard の説明に例として出す出力名、english=True なら説明を英語にする（*_en.py 用）
+    """
+    def text(ja, en):
+        return en if english else ja
+
+    shard_name = output_path(output_name, "csv", (3, 16))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=text("シリーズを並列に処理するプロセス数（0 で CPU 数、既定は 1）",
+                                  "Number of processes used to handle series in parallel "
+                                  "(0 = number of CPUs, default: 1)"))
+    parser.add_argument("--cache", nargs="?", const=DEFAULT_CACHE, metavar="PATH",
+                        help=text("抽出結果を SQLite にキャッシュし、次回以降は変更のないシリーズを処理しない"
+                                  "（PATH 省略時は ~/.cache/dicom2csv/scan_cache.sqlite）",
+                                  "Cache results in SQLite and skip unchanged series on later runs "
+                                  "(default PATH: ~/.cache/dicom2csv/scan_cache.sqlite)"))
+    parser.add_argument("--resume", action="store_true",
+                        help=text("中断した処理を再開する（ジャーナルに記録済みの被験者・シリーズを飛ばし、途中までの出力に追記）",
+                                  "Resume an interrupted run: skip subjects/series recorded in the journal "
+                                  "and append to the partial output"))
+    parser.add_argument("--profile", action="store_true",
+                        help=text("ステージ（走査・ヘッダ読み込み・dcmdump・mrinfo・CSV 書き込みなど）ごとの処理時間を集計し、"
+                                  "遅いシリーズとともに最後に表示する",
+                                  "Time each stage (walk, header read, dcmdump, mrinfo, CSV write, ...) and print "
+                                  "totals, percentiles and the slowest series at the end"))
+    parser.add_argument("--profile-trace", metavar="PATH",
+                        help=text("--profile の記録を Chrome のトレース形式の JSON（chrome://tracing や Perfetto で開ける）"
+                                  "に書き出す（--profile も有効になる）",
+                                  "Also write the --profile timings as a Chrome trace JSON file "
+                                  "(open in chrome://tracing or Perfetto; implies --profile)"))
+    parser.add_argument("--progress", nargs="?", type=float, const=10.0, metavar="SEC",
+                        help=text("SEC 秒ごと（省略時は 10 秒）に処理済みシリーズ数・シリーズ/秒・サブプロセスの平均時間・"
+                                  "残り時間の見込みを標準エラーに表示する",
+                                  "Every SEC seconds (10 if omitted), print series done, series/sec, average "
+                                  "subprocess latency and ETA to stderr"))
+    parser.add_argument("--metrics", metavar="PATH",
+                        help=text("進捗を Prometheus の textfile 形式で PATH に書き出す（node exporter の textfile collector 用）",
+                                  "Write progress metrics to PATH in Prometheus textfile format "
+                                  "(for the node exporter textfile collector)"))
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="csv",
+                        help=text("出力形式（既定は csv）。parquet・arrow は数値の列を数値型、b 値などを list 型にして"
+                                  "拡張子 .parquet / .arrow で書き出す（pyarrow が必要）。sqlite は索引付きの SQLite データベース"
+                                  "（.sqlite）に書き出す（csv 以外では --resume は使えない）",
+                                  "Output format (default csv). parquet and arrow store numeric columns as numbers "
+                                  "and b-values etc. as lists, with a .parquet/.arrow extension (requires pyarrow); "
+                                  "sqlite writes an indexed SQLite database (.sqlite). --resume is csv-only"))
+    parser.add_argument("--group-by-uid", action="store_true",
+                        help=text("SE* のディレクトリ名ではなく、各ファイルのヘッダの StudyInstanceUID / SeriesInstanceUID で"
+                                  "シリーズを分ける（フラットなエクスポートや PACS のダンプ用。SeriesDir 列は UID=<SeriesInstanceUID>）",
+                                  "Group files into series by the StudyInstanceUID/SeriesInstanceUID in their headers "
+                                  "instead of SE* directory names (for flat exports and PACS dumps; SeriesDir becomes "
+                                  "UID=<SeriesInstanceUID>)"))
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help=text("被験者を名前のハッシュで N 個に分け、i 番目（0 から N-1）だけを処理する（SLURM のアレイジョブ用）。"
+                                  f"出力は {shard_name} のようにシャードごとに分かれるので、merge_shards.py で1つにまとめる",
+                                  "Split the subjects into N shards by a hash of their names and process only shard i "
+                                  "(0 to N-1), e.g. from a SLURM array job. Each shard writes its own output such as "
+                                  f"{shard_name}; combine them with merge_shards.py"))
+    parser.add_argument("--backend", choices=HEADER_BACKENDS, default="native",
+                        help=text("タグの値を読む方法（既定は native：内蔵のリーダー）。dcmdump・gdcmdump・pydicom も選べる。"
+                                  "auto なら起動時に使えるものを数ファイルで計測し、native と同じ値を返すものの中で最も速いものを使う",
+                                  "How to read tag values (default native: the built-in reader). dcmdump, gdcmdump and "
+                                  "pydicom can also be chosen. auto times the available ones on a few files at startup "
+                                  "and uses the fastest one that returns the same values as native"))
+    parser.add_argument("--sample-subjects", type=parse_fraction, metavar="FRACTION",
+                        help=text("被験者のうち FRACTION（例：0.05 または 5%%）の割合だけを選んで処理する（撮像装置やプロトコルの構成を"
+                                  "手早く調べる用）。--sample-* を付けると各行に重み SampleWeight（その行が代表するシリーズ数）を付け、"
+                                  "最後に推定したシリーズ数と構成比を 95%% 信頼区間付きで表示する（--resume とは一緒に使えない）",
+                                  "Process only a FRACTION of the subjects (e.g. 0.05 or 5%%) for a quick look at the "
+                                  "scanner/protocol mix. With any --sample-* option, each row gets a SampleWeight column "
+                                  "(the number of series it stands for), and the estimated series count and mix are "
+                                  "printed at the end with 95%% confidence intervals (not with --resume)"))
+    parser.add_argument("--sample-series", type=parse_count, metavar="K",
+                        help=text("各被験者のシリーズのうち K 個だけを選んで処理する",
+                                  "Process only K of the series of each subject"))
+    parser.add_argument("--sample-time", type=parse_seconds, metavar="SEC",
+                        help=text("被験者を --seed で決まる順序で処理し、SEC 秒（30m・2h のようにも書ける）たったら新しい被験者を始めない",
+                                  "Process the subjects in an order set by --seed and start no new subject after SEC "
+                                  "seconds (30m or 2h also work)"))
+    parser.add_argument("--seed", type=int, default=0,
+                        help=text("--sample-* の標本を決める seed（既定は 0。同じ seed なら何度実行しても同じ標本になる）",
+                                  "Seed that sets the --sample-* sample (default 0; the same seed gives the same sample)"))
+
+class ScanRun:
+    """
+    add_common_arguments() で加えたオプションから、各スクリプトの実行に必要なもの
+    （Sampler・Profiler・Progress・ScanCache）をまとめて用意する
+    作るときにオプションを検証し（誤りは parser.error() で報告する）、--backend auto なら読み方を決める
+    with 文の中で open_output() と series() を使い、抜けるときにキャッシュと進捗の表示を閉じる
+    """
+
+    def __init__(self, parser, args, script, english=False):
+        self.args = args
+        self.script = os.path.basename(script)
+        if args.resume and args.format != "csv":
+            parser.error("--resume can only be used with --format csv" if english else
+                         "--resume は --format csv のときだけ使えます")
+        # pyarrow がないことは、出力の .part を作り始める前にここで報告する（読み込み自体は ArrowStream で行う）
+        if args.format in ("parquet", "arrow") and importlib.util.find_spec("pyarrow") is None:
+            parser.error(f"--format {args.format} requires pyarrow (pip install pyarrow)" if english else
+                         f"--format {args.format} には pyarrow が必要です（pip install pyarrow）")
+        self.sampler = make_sampler(args)
+        if args.resume and self.sampler:
+            parser.error("--resume cannot be used with --sample-*" if english else
+                         "--resume は --sample-* と一緒には使えません")
+        # --backend auto なら数ファイルで計測して読み方を決める
+        try:
+            backend, timings = select_backend(args.backend, args.base_dir, args.shard)
+        except ValueError:
+            parser.error(f"--backend {args.backend} is not available (command or pydicom not found)" if english else
+                         f"--backend {args.backend} は使えません（コマンドまたは pydicom が見つかりません）")
+        if timings:
+            print(f"Header backend: {backend} ({format_timings(timings)})" if english else
+                  f"タグの読み方: {backend}（{format_timings(timings)}）")
+        self.profiler = Profiler(args.profile_trace) if args.profile or args.profile_trace else None
+        self.progress = None
+        self.cache = None
+
+    def __enter__(self):
+        args = self.args
+        if args.progress or args.metrics:
+            self.progress = Progress(args.base_dir, self.script, args.progress, args.metrics, args.shard)
+        if args.cache:
+            self.cache = ScanCache(args.cache, self.script)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.cache:
+            self.cache.close()
+        if self.progress:
+            self.progress.finish()
+
+    def open_output(self, path, header, target=True, series_filter=None):
+        """
+        --format・--resume・--sample-* に合わせたライターを返す（open_output() を参照）
+        """
+        return open_output(path, header, self.args.format, resume=self.args.resume, sampler=self.sampler,
+                           target=target, series_filter=series_filter)
+
+    def series(self, func, tasks):
+        """
+        --jobs・--cache・--profile・--progress に合わせて run_series() でシリーズを処理する
+        """
+        return run_series(func, tasks, get_jobs(self.args.jobs), self.cache, self.profiler, self.progress)
+
+    def report(self):
+        """
+        標本からの推定（--sample-*）と処理時間の集計（--profile）を表示する
+        """
+        if self.sampler:
+            print(self.sampler.report())
+        if self.profiler:
+            print(self.profiler.report())
+
+def get_codec(charset):
+    """
+    Specific Character Set の値から文字列のデコードに使うコーデック名を返す
+    例: "\\ISO 2022 IR 87" → "iso2022_jp"
+    """
+    codec = "latin_1"
+    for term in charset.split("\\"):
+        term = term.strip()
+        if term in CHARSETS:
+            codec = CHARSETS[term]
+    return codec
+
+
+class HeaderWindow:
+    """
+    ファイルの一部（窓）だけをメモリに読み、DicomHeaderReader に read / seek / tell を提供するクラス
+    最初は先頭の HEADER_WINDOW バイトだけを1回で読み、窓の外の要素が必要になったときだけ
+    窓を倍に広げて読み足す（読み飛ばした値の先から読む場合は、その位置から新しい窓を読む）
+    ピクセルデータや大きなプライベートタグの値は読み飛ばすだけなので、ディスクから読まれない
+    bytes_read はファイルから読んだバイト数（read_dicom_header() が HEADER_STATS に足し、--profile で報告する）
+    """
+
+    def __init__(self, f, size=HEADER_WINDOW):
+        self.f = f
+        self.size = size
+        self.buf = b""
+        self.start = 0  # 窓の先頭のファイル上の位置
+        self.pos = 0
+        self.bytes_read = 0
+
+    def fill(self, n):
+        end = self.start + len(self.buf)
+        if self.start <= self.pos <= end and self.buf:
+            # 窓の続きが必要な場合は窓を倍に広げて読み足す
+            self.size *= 2
+            self.f.seek(end)
+            more = self.f.read(max(self.size, self.pos + n - end))
+            self.buf = self.buf[self.pos - self.start:] + more
+        else:
+            self.f.seek(self.pos)
+            more = self.buf = self.f.read(max(self.size, n))
+        self.start = self.pos
+        self.bytes_read += len(more)
+
+    def read(self, n):
+        if self.pos + n > self.start + len(self.buf) or self.pos < self.start:
+            self.fill(n)
+        offset = self.pos - self.start
+        data = self.buf[offset:offset + n]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.pos = self.pos + offset if whence == os.SEEK_CUR else offset
+
+    def tell(self):
+        return self.pos
+
+
+class DicomHeaderReader:
+    """
+    DICOM ファイルのヘッダを Python だけで読むクラス
+    プリアンブルとグループ 0002 を読んだあと、転送構文に従って明示的/暗黙的 VR の要素を順に読み、
+    ピクセルデータ（グループ 7FE0）に達した時点で読み込みを止める
+    シーケンス（SQ）の中身は読み飛ばし、最上位の要素だけを取り出す
+    ただし Enhanced MR などの機能グループ（FUNCTIONAL_GROUP_SOP_CLASSES）は、最上位にないタグを補うのに読む
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.explicit = True
+        self.endian = "<"
+        self.codec = "latin_1"
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise EOFError("unexpected end of file")
+        return data
+
+    def skip(self, n):
+        self.f.seek(n, os.SEEK_CUR)
+
+    def read_element_header(self, explicit, endian):
+        """
+        要素のヘッダを読み、(group, element, VR, 値長) を返す
+        ファイル末尾に達したときは None を返す
+        """
+        raw = self.f.read(4)
+        if len(raw) < 4:
+            return None
+        group, elem = struct.unpack(endian + "HH", raw)
+        if group == 0xFFFE:
+            length, = struct.unpack(endian + "I", self.read(4))
+            return group, elem, "", length
+        if not explicit:
+            length, = struct.unpack(endian + "I", self.read(4))
+            vr = IMPLICIT_VRS.get(f"{group:04X},{elem:04X}", "UN")
+            return group, elem, vr, length
+        vr = self.read(2).decode("ascii", "replace")
+        if vr in LONG_VRS:
+            self.read(2)
+            length, = struct.unpack(endian + "I", self.read(4))
+        else:
+            length, = struct.unpack(endian + "H", self.read(2))
+        if vr == "UN" and length != UNDEFINED:
+            # 明示的 VR のファイルで UN と書かれた既知のタグは、暗黙的 VR のときと同じく辞書の VR で読む
+            known = IMPLICIT_VRS.get(f"{group:04X},{elem:04X}")
+            if known in TEXT_VRS or known in NUMBER_VRS:
+                vr = known
+        return group, elem, vr, length
+
+    def skip_sequence(self, explicit, endian):
+        """
+        値長が未定義のシーケンスを区切り（FFFE,E0DD）まで読み飛ばす
+        """
+        while True:
+            hdr = self.read_element_header(explicit, endian)
+            if hdr is None:
+                raise EOFError("unterminated sequence")
+            group, elem, _, length = hdr
+            if (group, elem) == SEQUENCE_END:
+                return
+            if (group, elem) != ITEM:
+                raise ValueError("unexpected element in sequence")
+            if length == UNDEFINED:
+                self.skip_item(explicit, endian)
+            else:
+                self.skip(length)
+
+    def skip_item(self, explicit, endian):
+        """
+        値長が未定義のアイテムを区切り（FFFE,E00D）まで読み飛ばす
+        """
+        while True:
+            hdr = self.read_element_header(explicit, endian)
+            if hdr is None:
+                raise EOFError("unterminated item")
+            group, elem, vr, length = hdr
+            if (group, elem) == ITEM_END:
+                return
+            if length == UNDEFINED:
+                # UN で値長が未定義のものは暗黙的 VR で符号化されている
+                self.skip_sequence(explicit and vr != "UN", endian)
+            else:
+                self.skip(length)
+
+    def decode_value(self, vr, raw, endian):
+        if vr in NUMBER_VRS:
+            fmt = NUMBER_VRS[vr]
+            count = len(raw) // struct.calcsize(fmt)
+            values = struct.unpack(endian + fmt * count, raw[:count * struct.calcsize(fmt)])
+            return "\\".join(f"{v:g}" if isinstance(v, float) else str(v) for v in values)
+        codec = self.codec if vr in ("LO", "LT", "PN", "SH", "ST", "UC", "UT") else "ascii"
+        return raw.decode(codec, "replace").rstrip("\x00 ").strip()
+
+    def read_elements(self, values, explicit, endian, stop_tag, wanted=None):
+        """
+        要素を順に読み、文字列・数値の値を values に格納する
+        タグ（group << 16 | element）が stop_tag 以上になったら止める
+        wanted を指定した場合はそのタグの値だけを取り出す
+        """
+        while True:
+            pos = self.f.tell()
+            hdr = self.read_element_header(explicit, endian)
+            if hdr is None:
+                return
+            group, elem, vr, length = hdr
+            if (group << 16 | elem) >= stop_tag:
+                self.f.seek(pos)
+                return
+            if length == UNDEFINED:
+                self.skip_sequence(explicit and vr != "UN", endian)
+                continue
+            tag = f"{group:04X},{elem:04X}"
+            if (vr in TEXT_VRS or vr in NUMBER_VRS) and (
+                    wanted is None or tag in wanted or tag in ("0002,0002", "0002,0010", "0008,0005", "0008,0016")):
+                values[tag] = self.decode_value(vr, self.read(length), endian)
+                if tag == "0008,0005":
+                    self.codec = get_codec(values[tag])
+            elif tag in BINARY_TAGS and wanted is not None and tag in wanted:
+                values[tag] = self.read(length)
+            else:
+                self.skip(length)
+
+    def read_sequence(self, explicit, endian, length, select, wanted=None, count=None):
+        """
+        シーケンスのアイテムを順に読む（値長が決まっていても未定義でもよい）
+        select(アイテムの番号) が辞書を返したアイテムは、中の要素（入れ子のシーケンスの中も含む）の値を
+        その辞書に入れ（同じタグは最初の値を使う）、None を返したアイテムはデコードせずに読み飛ばす
+        wanted を指定した場合はそのタグの値だけを取り出し、count を指定した場合はその数のアイテムで止める
+        """
+        end = None if length == UNDEFINED else self.f.tell() + length
+        index = 0
+        while (end is None or self.f.tell() < end) and (count is None or index < count):
+            hdr = self.read_element_header(explicit, endian)
+            if hdr is None:
+                raise EOFError("unterminated sequence")
+            group, elem, _, item_length = hdr
+            if (group, elem) == SEQUENCE_END:
+                return
+            if (group, elem) != ITEM:
+                raise ValueError("unexpected element in sequence")
+            values = select(index)
+            index += 1
+            if values is not None:
+                self.read_item(values, explicit, endian, item_length, wanted)
+            elif item_length == UNDEFINED:
+                self.skip_item(explicit, endian)
+            else:
+                self.skip(item_length)
+
+    def read_item(self, values, explicit, endian, length, wanted=None):
+        """
+        アイテムの要素を読み、文字列・数値の値を values に入れる（入れ子のシーケンスの中も同じ values に入れる）
+        """
+        end = None if length == UNDEFINED else self.f.tell() + length
+        while end is None or self.f.tell() < end:
+            hdr = self.read_element_header(explicit, endian)
+            if hdr is None:
+                raise EOFError("unterminated item")
+            group, elem, vr, value_length = hdr
+            if (group, elem) == ITEM_END:
+                return
+            tag = f"{group:04X},{elem:04X}"
+            if vr == "SQ" or value_length == UNDEFINED:
+                self.read_sequence(explicit and vr != "UN", endian, value_length, lambda index: values, wanted)
+            elif (vr in TEXT_VRS or vr in NUMBER_VRS) and (wanted is None or tag in wanted) and tag not in values:
+                values[tag] = self.decode_value(vr, self.read(value_length), endian)
+            else:
+                self.skip(value_length)
+
+    def read_functional_groups(self, values, wanted, frame_tags=None):
+        """
+        機能グループを読み、最上位で見つからなかった wanted のタグの値を補う（wanted が None なら全タグ）
+        Shared Functional Groups は全部デコードする
+        Per-Frame Functional Groups は、まだ足りないタグがあれば最初のフレームだけから補う
+        frame_tags を指定した場合は、全フレームからそのタグだけを取り出し、フレームごとの辞書のリストを
+        values["5200,9230"] に入れる（フレームのそれ以外の要素はデコードしない）
+        """
+        def fill(group_values):
+            for tag, value in group_values.items():
+                tag = FUNCTIONAL_GROUP_ALIASES.get(tag, tag)
+                if wanted is None or tag in wanted:
+                    values.setdefault(tag, value)
+
+        def missing():
+            if wanted is None:
+                return None
+            tags = {tag for tag in wanted if tag not in values}
+            return tags | {alias for alias, tag in FUNCTIONAL_GROUP_ALIASES.items() if tag in tags}
+
+        while True:
+            hdr = self.read_element_header(self.explicit, self.endian)
+            if hdr is None:
+                return
+            group, elem, vr, length = hdr
+            tag = group << 16 | elem
+            if tag >= PIXEL_DATA:
+                return
+            explicit = self.explicit and vr != "UN"
+            if tag == SHARED_GROUPS:
+                shared = {}
+                self.read_sequence(explicit, self.endian, length, lambda index: shared)
+                fill(shared)
+            elif tag == PER_FRAME_GROUPS:
+                need = missing()
+                if need is not None and not need and not frame_tags:
+                    return
+                if need is not None and frame_tags:
+                    need |= set(frame_tags)
+                frames = []
+
+                def select(index):
+                    frames.append({})
+                    return frames[-1]
+
+                # frame_tags がなければ最初のフレームだけを読む
+                self.read_sequence(explicit, self.endian, length, select, need, None if frame_tags else 1)
+                if frames:
+                    fill(frames[0])
+                if frame_tags:
+                    values["5200,9230"] = [{tag: frame[tag] for tag in frame_tags if tag in frame}
+                                           for frame in frames]
+                return
+            elif length == UNDEFINED:
+                self.skip_sequence(explicit, self.endian)
+            else:
+                self.skip(length)
+
+    def read_header(self, tags=None, frame_tags=None):
+        """
+        ヘッダを読み、{"GGGG,EEEE": 値} の辞書を返す
+        tags を指定した場合は、その中で最後のタグを読んだ時点で読み込みを止める
+        機能グループを持つマルチフレーム（Enhanced MR など）で tags の一部が最上位にない場合は、
+        機能グループから補う（frame_tags を指定した場合はフレームごとの値も読む。read_functional_groups() を参照）
+        DICOM として読めない場合は ValueError を送出する
+        """
+        wanted = None
+        stop_tag = PIXEL_DATA
+        if tags:
+            wanted = {tag.upper() for tag in tags}
+            last = max(int(tag.replace(",", ""), 16) for tag in wanted)
+            stop_tag = min(stop_tag, last + 1)
+        values = {}
+        preamble = self.f.read(132)
+        if len(preamble) == 132 and preamble[128:] == b"DICM":
+            # ファイルメタ情報（グループ 0002）は常に明示的 VR リトルエンディアン
+            self.read_elements(values, True, "<", FILE_META_END, wanted)
+        else:
+            # プリアンブルのないデータセットは先頭要素から VR の有無を判定する
+            self.f.seek(0)
+            head = self.f.read(6)
+            if len(head) < 6 or struct.unpack("<H", head[:2])[0] not in (0x0002, 0x0008):
+                raise ValueError("not a DICOM file")
+            self.explicit = head[4:6].isalpha() and head[4:6].isupper()
+            self.f.seek(0)
+            if self.explicit:
+                self.read_elements(values, True, "<", FILE_META_END, wanted)
+        syntax = values.get("0002,0010", "")
+        if syntax == IMPLICIT_VR_LE:
+            self.explicit = False
+        elif syntax == EXPLICIT_VR_BE:
+            self.endian = ">"
+        elif syntax.endswith(".99"):
+            # deflate 圧縮されたデータセットは読めない
+            raise ValueError(f"unsupported transfer syntax: {syntax}")
+        self.read_elements(values, self.explicit, self.endian, min(stop_tag, SHARED_GROUPS), wanted)
+        sop_class = values.get("0008,0016") or values.get("0002,0002")
+        if sop_class in FUNCTIONAL_GROUP_SOP_CLASSES:
+            if frame_tags or wanted is None or any(tag not in values for tag in wanted):
+                self.read_functional_groups(values, wanted, frame_tags)
+        elif stop_tag > SHARED_GROUPS:
+            self.read_elements(values, self.explicit, self.endian, stop_tag, wanted)
+        return values
+
+
+def read_dicom_header(path, tags=None, frame_tags=None):
+    """
+    DICOM ファイルのヘッダを Python だけで読み、{"GGGG,EEEE": 値} の辞書を返す
+    先頭の数 KB だけを読み、必要なタグがその先にあるときだけ読む範囲を広げる（ピクセルデータより後ろは読まない）
+    frame_tags はマルチフレームのフレームごとに読むタグ（DicomHeaderReader.read_header() を参照）
+    """
+    with TIMER.stage("header"), open_file(path) as f:
+        window = HeaderWindow(f)
+        try:
+            return DicomHeaderReader(window).read_header(tags, frame_tags)
+        finally:
+            HEADER_STATS[0] += 1
+            HEADER_STATS[1] += window.bytes_read
+
+def parse_dcmdump(dcmdump_text, tags=None):
+    """
+    dcmdump の出力を {"GGGG,EEEE": 値} の辞書に変換する（同じタグは最初の値を使う）
+    tags を指定した場合は、そのタグがすべて見つかった時点で走査を止める
+    """
+    if tags:
+        wanted = {tag.upper() for tag in tags}
+        alternatives = "|".join(re.escape(tag) for tag in sorted(wanted))
+    else:
+        wanted = None
+        alternatives = r'[0-9a-fA-F]{4},[0-9a-fA-F]{4}'
+    values = {}
+    with TIMER.stage("dcmdump_parse"):
+        for m in re.finditer(r'\((' + alternatives + r')\).*?\[(.*?)\]', dcmdump_text, re.IGNORECASE):
+            values.setdefault(m.group(1).upper(), m.group(2).strip())
+            if wanted is not None and len(values) == len(wanted):
+                break
+    return values
+
+def read_header(path, tags=None):
+    """
+    DICOM ファイルのタグを {"GGGG,EEEE": 値} の辞書で返す
+    --backend で選んだ読み方（既定は内蔵のリーダー）で読み、読めない場合（deflate 圧縮など）だけ dcmdump を使う
+    run_series() から呼ばれた場合は、dcmdump をその場では起動せずに DcmdumpDeferred を送出し、
+    後でほかのシリーズの分とまとめて読んだ出力（DCMDUMP_DUMPS）を使う
+    開けないファイル（権限がないなど）は、dcmdump が失敗したときと同じく空の辞書を返す
+    """
+    try:
+        return HEADER_BACKEND[0].read(path, tags)
+    except (ValueError, EOFError, struct.error):
+        return read_dcmdump(path, tags)
+    except OSError:
+        return {}
+
+def read_dcmdump(path, tags=None):
+    """
+    dcmdump でファイルを読み、{"GGGG,EEEE": 値} の辞書を返す
+    """
+    text = DCMDUMP_DUMPS.get(path)
+    if text is None:
+        if DCMDUMP_DEFER[0]:
+            raise DcmdumpDeferred(path)
+        text = run_command(["dcmdump", path])
+    return parse_dcmdump(text, tags)
+
+class DcmdumpDeferred(Exception):
+    """
+    read_header() が dcmdump を起動する代わりに送出する例外（path は dcmdump で読むファイル）
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.path = path
+
+def run_dcmdump_batch(paths):
+    """
+    複数のファイルを DCMDUMP_BATCH 個ずつ dcmdump +F でまとめて読み、{パス: そのファイルの出力} を返す
+    +F を付けると各ファイルの出力の前に "# dcmdump (i/n): ファイル名" の行が入るので、それで出力を分ける
+    読めなかったファイルの出力は空文字
+    """
+    dumps = dict.fromkeys(paths, "")
+    for start in range(0, len(paths), DCMDUMP_BATCH):
+        batch = paths[start:start + DCMDUMP_BATCH]
+        text = run_command(["dcmdump", "+F", *batch], partial_output=True)
+        parts = re.split(r"^# dcmdump \((\d+)/\d+\): .*$", text, flags=re.MULTILINE)
+        for number, body in zip(parts[1::2], parts[2::2]):
+            if 0 < int(number) <= len(batch):
+                dumps[batch[int(number) - 1]] = body
+    return dumps
+
+def call_deferrable(call, task, dumps=None):
+    """
+    run_series() がワーカーで call(task) を実行するときの入口
+    dumps（読んだ dcmdump の出力）が DCMDUMP_DEFER_FILES 個より少なければ、内蔵のリーダーで読めず dumps にもない
+    ファイルがあった時点で dcmdump を起動せずに DcmdumpDeferred を結果として返す
+    （run_series() がまとめて dcmdump で読み、dumps に加えて実行し直す）
+    """
+    DCMDUMP_DUMPS.update(dumps or {})
+    DCMDUMP_DEFER[0] = len(dumps or ()) < DCMDUMP_DEFER_FILES
+    try:
+        return call(task)
+    except DcmdumpDeferred as e:
+        return e
+    finally:
+        DCMDUMP_DEFER[0] = False
+        DCMDUMP_DUMPS.clear()
+
+
+class NativeBackend:
+    """
+    内蔵のリーダー（read_dicom_header()）でタグを読む --backend native
+    """
+    name = "native"
+
+    def available(self):
+        return True
+
+    def read(self, path, tags=None):
+        return read_dicom_header(path, tags)
+
+
+class DcmdumpBackend:
+    """
+    DCMTK の dcmdump の出力からタグを読む --backend dcmdump
+    run_series() の中では、ほかのシリーズの分とまとめて1回の dcmdump で読む（read_dcmdump() を参照）
+    アーカイブ内のファイルは dcmdump に渡せないので内蔵のリーダーで読む
+    """
+    name = "dcmdump"
+
+    def available(self):
+        return shutil.which(self.name) is not None
+
+    def read(self, path, tags=None):
+        if split_archive(path)[0] is not None:
+            return read_dicom_header(path, tags)
+        return read_dcmdump(path, tags)
+
+
+class GdcmdumpBackend(DcmdumpBackend):
+    """
+    GDCM の gdcmdump の出力からタグを読む --backend gdcmdump（出力の形式は dcmdump と同じく "(GGGG,EEEE) VR [値]"）
+    """
+    name = "gdcmdump"
+
+    def read(self, path, tags=None):
+        if split_archive(path)[0] is not None:
+            return read_dicom_header(path, tags)
+        return parse_dcmdump(run_command(["gdcmdump", path]), tags)
+
+
+class PydicomBackend:
+    """
+    pydicom でタグを読む --backend pydicom
+    値は内蔵のリーダーと同じ文字列（複数の値は "\\" 区切り）にそろえ、
+    最上位にないタグは Shared Functional Groups と最初のフレームの Per-Frame Functional Groups から補う
+    """
+    name = "pydicom"
+
+    def available(self):
+        return pydicom is not None
+
+    def value(self, element):
+        if element.VR in NUMBER_VRS:
+            values = element.value if element.VM > 1 else [element.value]
+            return "\\".join(f"{v:g}" if isinstance(v, float) else str(v) for v in values)
+        if isinstance(element.value, bytes):
+            if f"{element.tag.group:04X},{element.tag.element:04X}" in BINARY_TAGS:
+                return element.value
+            return element.value.decode("latin_1").rstrip("\x00 ").strip()
+        values = element.value if element.VM > 1 else [element.value]
+        return "\\".join("" if v is None else str(v) for v in values).strip()
+
+    def collect(self, values, dataset, wanted):
+        """
+        機能グループのアイテム（入れ子のシーケンスの中も含む）から、values にまだないタグの値を入れる
+        """
+        for element in dataset:
+            if element.VR == "SQ":
+                for item in element.value:
+                    self.collect(values, item, wanted)
+                continue
+            tag = f"{element.tag.group:04X},{element.tag.element:04X}"
+            tag = FUNCTIONAL_GROUP_ALIASES.get(tag, tag)
+            if (wanted is None or tag in wanted) and tag not in values:
+                values[tag] = self.value(element)
+
+    def read(self, path, tags=None):
+        wanted = {tag.upper() for tag in tags} if tags else None
+        specific = None
+        if wanted is not None:
+            specific = [int(tag.replace(",", ""), 16) for tag in wanted]
+            specific += [0x00080016, SHARED_GROUPS, PER_FRAME_GROUPS]
+        with TIMER.stage("header"), open_file(path) as f:
+            try:
+                dataset = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=specific)
+            except pydicom.errors.InvalidDicomError as e:
+                raise ValueError(str(e)) from e
+            values = {}
+            for element in dataset:
+                if element.VR != "SQ":
+                    tag = f"{element.tag.group:04X},{element.tag.element:04X}"
+                    if wanted is None or tag in wanted:
+                        values[tag] = self.value(element)
+            if dataset.get("SOPClassUID", "") in FUNCTIONAL_GROUP_SOP_CLASSES:
+                for tag in (SHARED_GROUPS, PER_FRAME_GROUPS):
+                    if tag in dataset and dataset[tag].value:
+                        self.collect(values, dataset[tag].value[0], wanted)
+        return values
+
+
+# --backend の名前と読み方、このプロセスで使う読み方（set_backend() が切り替える）
+BACKENDS = {backend.name: backend
+            for backend in (NativeBackend(), DcmdumpBackend(), GdcmdumpBackend(), PydicomBackend())}
+HEADER_BACKEND = [BACKENDS["native"]]
+
+def set_backend(name):
+    """
+    read_header() が使う読み方を設定する（run_series() がワーカープロセスにも同じ値を渡す）
+    """
+    HEADER_BACKEND[0] = BACKENDS[name]
+
+def sample_files(base_dir, shard=None, count=BACKEND_SAMPLE):
+    """
+    base_dir 以下の被験者から、--backend auto の計測に使うファイルを最大 count 個返す
+    なるべく多くの撮像装置のファイルが入るように、1つの被験者からは BACKEND_SAMPLE_PER_SUBJECT 個までにする
+    """
+    files = []
+    for _, subj_dir in find_subjects(base_dir, shard):
+        taken = []
+        stack = [subj_dir]
+        while stack and len(taken) < BACKEND_SAMPLE_PER_SUBJECT:
+            try:
+                with scan_dir(stack.pop()) as it:
+                    entries = sorted((e for e in it if not e.name.startswith(".")), key=lambda e: e.name)
+            except OSError:
+                continue
+            stack.extend(reversed([e.path for e in entries if e.is_dir()]))
+            taken += [e.path for e in entries if e.is_file()][:BACKEND_SAMPLE_PER_SUBJECT - len(taken)]
+        files += taken
+        if len(files) >= count:
+            break
+    return files[:count]
+
+def benchmark_backends(paths, tags):
+    """
+    使える読み方それぞれで paths のファイルの tags を読み、{名前: 1ファイルあたりの秒数} を返す
+    内蔵のリーダーの値と1つでも違った読み方は None にする（内蔵のリーダーで読めないファイルは使わない）
+    """
+    reference = {}
+    for path in paths:
+        try:
+            header = read_dicom_header(path, tags)
+        except (ValueError, EOFError, struct.error, OSError):
+            continue
+        reference[path] = [header.get(tag, "") for tag in tags]
+    timings = {}
+    if not reference:
+        return timings
+    for backend in BACKENDS.values():
+        if not backend.available():
+            continue
+        start = time.perf_counter()
+        try:
+            same = all([backend.read(path, tags).get(tag, "") for tag in tags] == values
+                       for path, values in reference.items())
+        except (ValueError, EOFError, struct.error, OSError):
+            same = False
+        seconds = (time.perf_counter() - start) / len(reference)
+        timings[backend.name] = seconds if same else None
+    return timings
+
+def select_backend(name, base_dir=".", shard=None):
+    """
+    --backend の値から読み方を決めて設定し、(使う読み方の名前, benchmark_backends() の結果) を返す
+    auto なら base_dir 以下の数ファイルで計測し、内蔵のリーダーと同じ値を返すものの中で最も速いものを選ぶ
+    （計測しなかった場合の結果は空の辞書）。指定した読み方が使えない場合は ValueError を送出する
+    """
+    timings = {}
+    if name == "auto":
+        tags = sorted({*SUBJECT_TAGS.values(), *SERIES_TAGS.values(), *GEOMETRY_TAGS.values()})
+        timings = benchmark_backends(sample_files(base_dir, shard), tags)
+        same = [backend for backend, seconds in timings.items() if seconds is not None]
+        name = min(same, key=timings.get) if same else "native"
+    elif not BACKENDS[name].available():
+        raise ValueError(f"backend not available: {name}")
+    set_backend(name)
+    return name, timings
+
+def format_timings(timings):
+    """
+    benchmark_backends() の結果を "native 0.12 ms, dcmdump 3.40 ms, pydicom ≠" の形にする（≠ は値が違ったもの）
+    """
+    return ", ".join(f"{name} ≠" if seconds is None else f"{name} {seconds * 1000:.2f} ms"
+                     for name, seconds in timings.items())
+
+def init_worker(probe_path, backend):
+    """
+    run_series() のワーカープロセスで、mrinfo の結果の保存先とタグの読み方を親プロセスと同じにする
+    """
+    set_probe_cache(probe_path)
+    set_backend(backend)
+
+
+class TagPlan:
+    """
+    CSV の列名とタグの対応（例：{"Manufacturer": "0008,0070"}）をまとめた抽出計画
+    タグの一覧は最初に一度だけ用意し、1つのファイルにつき1回の走査で全列の値を取り出す
+    """
+
+    def __init__(self, columns):
+        self.columns = {name: tag.upper() for name, tag in columns.items()}
+        self.tags = frozenset(self.columns.values())
+        self.last = None  # extract_cached() が直前に読んだ (パス, {列名: 値})
+
+    def values(self, header):
+        """
+        read_header() の結果から {列名: 値} の辞書を作る（見つからないタグは空文字、値は必ず文字列）
+        """
+        values = {}
+        for name, tag in self.columns.items():
+            value = header.get(tag, "")
+            if isinstance(value, bytes):
+                value = value.decode("latin_1").rstrip("\x00 ").strip()
+            values[name] = value
+        return values
+
+    def extract(self, path):
+        """
+        DICOM ファイルのヘッダを読み、{列名: 値} の辞書を返す（開けないファイルは全列が空文字）
+        """
+        return self.values(read_header(path, self.tags))
+
+    def extract_cached(self, path):
+        """
+        extract() と同じだが、このプロセスで直前に読んだのと同じファイルなら読み直さずにその値を返す
+        被験者のファイルは同じ被験者のシリーズごとにワーカーで読むので、続けて同じファイルを読むことが多い
+        """
+        if self.last is None or self.last[0] != path:
+            self.last = (path, self.extract(path))
+        return dict(self.last[1])
+
+
+def list_series_files(series_dir):
+    """
+    シリーズディレクトリ以下のファイル（隠しファイルを除く）をすべて返す
+    """
+    files = []
+    stack = [series_dir]
+    while stack:
+        try:
+            with scan_dir(stack.pop()) as it:
+                entries = [e for e in it if not e.name.startswith(".")]
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return files
+
+def read_csa_value(raw, name):
+    """
+    Siemens CSA ヘッダ（SV10 形式）から指定した項目（例："B_value"）の値のリストを返す
+    """
+    try:
+        pos = 8 if raw[:4] == b"SV10" else 0
+        ntags, = struct.unpack_from("<I", raw, pos)
+        pos += 8
+        for _ in range(ntags):
+            tag_name = raw[pos:pos + 64].split(b"\0", 1)[0].decode("latin_1")
+            nitems, = struct.unpack_from("<i", raw, pos + 76)
+            pos += 84
+            values = []
+            for _ in range(nitems):
+                item_len, = struct.unpack_from("<i", raw, pos + 4)
+                pos += 16
+                values.append(raw[pos:pos + item_len].split(b"\0", 1)[0].decode("latin_1").strip())
+                pos += (item_len + 3) // 4 * 4
+            if tag_name == name:
+                return [v for v in values if v]
+    except struct.error:
+        pass
+    return []
+
+def instance_bvalue(header):
+    """
+    1インスタンス分のヘッダから b 値を返す（見つからなければ None）
+    標準タグを優先し、なければメーカーごとのタグを見る
+    """
+    try:
+        if header.get("0018,9087"):
+            return float(header["0018,9087"].split("\\")[0])
+        manufacturer = header.get("0008,0070", "").upper()
+        if "SIEMENS" in manufacturer:
+            if header.get("0019,100C"):
+                return float(header["0019,100C"].split("\\")[0])
+            values = read_csa_value(header.get("0029,1010", b""), "B_value")
+            return float(values[0]) if values else None
+        if "GE" in manufacturer and header.get("0043,1039"):
+            # GE は b 値に 10^9 を足して記録していることがある
+            return float(int(header["0043,1039"].split("\\")[0]) % 1000000000)
+        if "PHILIPS" in manufacturer and header.get("2001,1003"):
+            return float(header["2001,1003"].split("\\")[0])
+    except (ValueError, TypeError):
+        pass
+    return None
+
+def cluster_shells(bvalues):
+    """
+    b 値をシェルに分け、[(シェルの平均 b 値, インスタンス数), ...] を b 値の昇順で返す
+    BZERO_THRESHOLD 以下は b=0 とみなし、昇順に並べて差が BVALUE_EPSILON 以下のものを同じシェルにする
+    """
+    if np is not None:
+        b = np.asarray(bvalues, dtype=float)
+        b = np.where(b <= BZERO_THRESHOLD, 0.0, b)
+        b.sort()
+        labels = np.concatenate(([0], np.cumsum(np.diff(b) > BVALUE_EPSILON)))
+        counts = np.bincount(labels)
+        means = np.bincount(labels, weights=b) / counts
+        return list(zip(means.tolist(), counts.tolist()))
+    shells = []
+    previous = None
+    for b in sorted(0.0 if b <= BZERO_THRESHOLD else b for b in bvalues):
+        if previous is None or b - previous > BVALUE_EPSILON:
+            shells.append([0.0, 0])
+        shells[-1][0] += b
+        shells[-1][1] += 1
+        previous = b
+    return [(total / count, count) for total, count in shells]
+
+def parse_position(value):
+    """
+    Image Position (Patient) の "x\\y\\z" を (x, y, z) にする（なければ None）
+    """
+    try:
+        x, y, z = (float(v) for v in value.split("\\")[:3])
+    except ValueError:
+        return None
+    return x, y, z
+
+def count_positions(positions):
+    """
+    スライス位置の数を返す（POSITION_DECIMALS 桁に丸めて同じ位置をまとめる）
+    NumPy があれば配列1つにまとめて np.unique で数える
+    位置のないインスタンスはまとめて1つの位置とみなす
+    """
+    missing = any(position is None for position in positions)
+    found = [position for position in positions if position is not None]
+    if not found:
+        return int(missing)
+    if np is not None:
+        unique = len(np.unique(np.round(np.asarray(found, dtype=float), POSITION_DECIMALS), axis=0))
+    else:
+        unique = len({tuple(round(v, POSITION_DECIMALS) for v in position) for position in found})
+    return unique + missing
+
+class SeriesScan:
+    """
+    シリーズ内の全インスタンスのヘッダ（DIFFUSION_TAGS まで）を1回だけ読んで集めた情報
+    bvalues と positions はインスタンス（マルチフレームで Per-Frame Functional Groups があればフレーム）ごとの
+    b 値（なければ None）とスライス位置、frames はマルチフレームの Number of Frames の合計、mosaic は Siemens モザイクの1ファイルあたりのスライス数、
+    temporal は Number of Temporal Positions（マルチフレームのボリューム数）
+    """
+
+    def __init__(self):
+        self.bvalues = []
+        self.positions = []
+        self.frames = 0
+        self.mosaic = 0
+        self.temporal = 0
+
+    def add(self, header):
+        bvalue = instance_bvalue(header)
+        position = parse_position(header.get("0020,0032", ""))
+        # フレームごとの値がなければ Shared Functional Groups や最上位の値を使う
+        for frame in header.get("5200,9230") or [{}]:
+            frame_bvalue = instance_bvalue(frame) if "0018,9087" in frame else None
+            self.bvalues.append(bvalue if frame_bvalue is None else frame_bvalue)
+            self.positions.append(parse_position(frame["0020,0032"]) if "0020,0032" in frame else position)
+        try:
+            self.frames += max(int(header.get("0028,0008") or 1), 1)
+            self.temporal = self.temporal or int(header.get("0020,0105") or 0)
+        except ValueError:
+            pass
+        if not self.mosaic and header.get("0029,1010"):
+            values = read_csa_value(header["0029,1010"], "NumberOfImagesInMosaic")
+            self.mosaic = int(values[0]) if values and values[0].isdigit() else 0
+
+    def shells(self):
+        """
+        [(シェルの平均 b 値, ボリューム数), ...] を返す（b 値がなければ空のリスト）
+        スライスごとにファイルが分かれている場合は、スライス位置の数でインスタンス数を割ってボリューム数にする
+        """
+        indexes = [i for i, b in enumerate(self.bvalues) if b is not None]
+        if not indexes:
+            return []
+        slices = count_positions([self.positions[i] for i in indexes])
+        return [(mean, count // slices) for mean, count in cluster_shells([self.bvalues[i] for i in indexes])]
+
+    def axis(self):
+        """
+        mrinfo の "Dimensions:" の最後の値（4D ならボリューム数、3D ならスライス数）を返す
+        ヘッダだけでは決められない場合は None
+        """
+        instances = len(self.positions)
+        if not instances:
+            return None
+        if self.frames > instances:
+            # フレームごとの位置がないマルチフレームは Number of Temporal Positions があるときだけ決められる
+            if instances != 1 or self.temporal <= 0 or self.frames % self.temporal:
+                return None
+            volumes, slices = self.temporal, self.frames // self.temporal
+        elif self.mosaic > 1:
+            # Siemens モザイクは1ファイルが1ボリューム
+            volumes, slices = instances, self.mosaic
+        else:
+            slices = count_positions(self.positions)
+            if instances % slices:
+                return None
+            volumes = instances // slices
+        if volumes > 1:
+            return volumes
+        return slices if slices > 1 else None
+
+# scan_series() の直近の結果（同じシリーズの b 値と軸数で2回読まないように使う）
+SERIES_SCANS = {}
+
+def scan_series(series_dir):
+    """
+    シリーズ内の全インスタンス（series_headers()）のヘッダを読み、SeriesScan を返す（直近のシリーズは読み直さない）
+    マルチフレームのファイルは Per-Frame Functional Groups からフレームごとの b 値と位置も読む
+    """
+    if series_dir in SERIES_SCANS:
+        return SERIES_SCANS[series_dir]
+    scan = SeriesScan()
+    with TIMER.stage("shells"):
+        for _, header in series_headers(series_dir, DIFFUSION_TAGS, FRAME_TAGS):
+            scan.add(header)
+    if len(SERIES_SCANS) >= 4:
+        del SERIES_SCANS[next(iter(SERIES_SCANS))]
+    SERIES_SCANS[series_dir] = scan
+    return scan
+
+def extract_native_shells(series_dir):
+    """
+    シリーズ内の全インスタンスの DICOM ヘッダから b 値を集め、
+    mrinfo -shell_bvalues -shell_sizes と同じ形式の (b 値, ボリューム数) の文字列を返す
+    b 値が見つからなければ ("", "") を返す
+    """
+    shells = scan_series(series_dir).shells()
+    b_values    = ", ".join(str(int(round(mean))) for mean, _ in shells)
+    shell_sizes = ", ".join(str(count) for _, count in shells)
+    return b_values, shell_sizes
+
+def extract_axis(series_dir):
+    """
+    シリーズの軸数（DTI_Axis）を返す
+    インスタンス数・スライス位置・モザイクのスライス数・マルチフレームのフレーム数から DICOM ヘッダだけで求め、
+    求められない場合だけ mrinfo を使う
+    """
+    axis = scan_series(series_dir).axis()
+    if axis is not None:
+        return str(axis)
+    return extract_mrinfo_axis(series_dir)
+
+def extract_shells(series_dir):
+    """
+    シリーズの各シェルの b 値とボリューム数を返す
+    DICOM ヘッダから求められればそれを使い、b 値が見つからない場合だけ mrinfo を使う
+    """
+    b_values, shell_sizes = extract_native_shells(series_dir)
+    if b_values:
+        return b_values, shell_sizes
+    return extract_mrinfo_shells(series_dir)
+
+def parse_dw_scheme(value):
+    """
+    mrinfo -json_all の "dw_scheme"（[[x, y, z, b], ...] か、行を改行・値を "," で区切った文字列）から
+    ボリュームごとの b 値のリストを返す
+    """
+    if isinstance(value, str):
+        value = [row.split(",") for row in value.splitlines() if row.strip()]
+    try:
+        return [float(row[3]) for row in value]
+    except (TypeError, ValueError, IndexError):
+        return []
+
+def run_mrinfo(series_dir):
+    """
+    mrinfo -json_all を1回だけ実行し、
+    {"dimensions": [...], "voxel_size": [...], "shell_bvalues": [...], "shell_sizes": [...]} を返す
+    シェルは DW スキームの b 値を cluster_shells() で分けて求める（mrinfo -shell_bvalues / -shell_sizes と同じ分け方）
+    mrinfo が失敗した場合（アーカイブ内のシリーズでメンバーが読めない場合も）は空の辞書を返す
+    """
+    try:
+        with series_input(series_dir) as path, tempfile.TemporaryDirectory(prefix="dicom2csv_") as tmp:
+            json_path = os.path.join(tmp, "mrinfo.json")
+            run_command(["mrinfo", path, "-json_all", json_path])
+            with open(json_path, encoding="utf-8") as f:
+                info = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    probe = {"dimensions": info.get("size", []), "voxel_size": info.get("spacing", []),
+             "shell_bvalues": [], "shell_sizes": []}
+    bvalues = parse_dw_scheme((info.get("keyval") or {}).get("dw_scheme"))
+    if bvalues:
+        shells = cluster_shells(bvalues)
+        probe["shell_bvalues"] = [int(round(mean)) for mean, _ in shells]
+        probe["shell_sizes"] = [count for _, count in shells]
+    return probe
+
+
+class MrinfoProbes:
+    """
+    probe_mrinfo() の結果をシリーズの指紋ごとに覚えておくクラス
+    同じプロセスでは直近 MEMORY_SIZE 個をメモリに、--cache を指定した場合は SQLite
+    （キャッシュの隣の "<キャッシュ名>_mrinfo.sqlite"）にも保存する
+    SQLite はスクリプトによらず共有し、ワーカープロセスもそれぞれ開いて読み書きするので、
+    同じシリーズに mrinfo を実行するのは、別の実行や別のスクリプト・出力を含めて1回だけになる
+    mrinfo が失敗した結果（空の辞書）は覚えないので、一時的な失敗でも次に使うときに mrinfo を実行し直す
+    """
+
+    MEMORY_SIZE = 64
+
+    def __init__(self):
+        self.path = None
+        self.db = None
+        self.pid = None
+        self.memory = {}
+
+    def connect(self):
+        if self.path is None:
+            return None
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS probes ("
+                            "series TEXT PRIMARY KEY, fingerprint TEXT, probe TEXT)")
+            self.pid = os.getpid()
+        return self.db
+
+    def remember(self, key, probe):
+        if len(self.memory) >= self.MEMORY_SIZE:
+            del self.memory[next(iter(self.memory))]
+        self.memory[key] = probe
+        return probe
+
+    def get(self, series, fingerprint):
+        """
+        覚えている結果を返す（なければ None）
+        """
+        if (series, fingerprint) in self.memory:
+            return self.memory[(series, fingerprint)]
+        db = self.connect() if fingerprint is not None else None
+        if db is None:
+            return None
+        found = db.execute("SELECT fingerprint, probe FROM probes WHERE series = ?", (series,)).fetchone()
+        if found is None or found[0] != fingerprint:
+            return None
+        probe = json.loads(found[1])
+        # 以前の版が保存した失敗の結果は使わない
+        return self.remember((series, fingerprint), probe) if probe else None
+
+    def put(self, series, fingerprint, probe):
+        if not probe:
+            return
+        self.remember((series, fingerprint), probe)
+        db = self.connect() if fingerprint is not None else None
+        if db is not None:
+            db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?)",
+                       (series, fingerprint, json.dumps(probe)))
+
+# このプロセスの mrinfo の結果の記録
+MRINFO_PROBES = MrinfoProbes()
+
+def set_probe_cache(path):
+    """
+    mrinfo の結果を保存する SQLite のパスを設定する（None なら保存しない）
+    ScanCache が設定し、run_series() がワーカープロセスにも同じ値を渡す
+    """
+    MRINFO_PROBES.path = path
+    MRINFO_PROBES.db = None
+
+def probe_mode():
+    """
+    DICOM ヘッダで足りない値を mrinfo で補えるなら "mrinfo"、ヘッダだけで求めるなら "native" を返す
+    """
+    return "mrinfo" if shutil.which("mrinfo") else "native"
+
+def probe_mrinfo(series_dir):
+    """
+    シリーズの mrinfo の結果（run_mrinfo()）を返す
+    指紋（代表ファイルとディレクトリの series_fingerprint()）が同じなら、覚えている結果を使って mrinfo は実行しない
+    """
+    # ヘッダは読まずに、シリーズのディレクトリ以下のファイルの一覧から指紋を作る
+    files = list_series_files(split_series_dir(series_dir)[0])
+    fingerprint = series_fingerprint(series_dir, min(files)) if files else None
+    if fingerprint is not None:
+        fingerprint = f"{CACHE_VERSION}|{len(files)}|{fingerprint}"
+    series = os.path.abspath(series_dir)
+    probe = MRINFO_PROBES.get(series, fingerprint)
+    if probe is None:
+        probe = run_mrinfo(series_dir)
+        MRINFO_PROBES.put(series, fingerprint, probe)
+    return probe
+
+def extract_mrinfo_axis(series_dir):
+    """
+    mrinfo で求めたシリーズの次元の最後の値（軸数）を返す
+    例: "Dimensions: 128 x 128 x 33 x 100" → "100"
+    """
+    dimensions = probe_mrinfo(series_dir).get("dimensions")
+    return str(dimensions[-1]) if dimensions else ""
+
+def extract_mrinfo_shells(series_dir):
+    """
+    mrinfo で求めた各シェルの b 値とボリューム数を ("0, 1200", "1, 64") の形で返す
+    （シェル 0 の b 値は 0 で 1 ボリューム、シェル 1 の b 値は 1200 で 64 ボリューム）
+    """
+    probe = probe_mrinfo(series_dir)
+    b_values    = ", ".join(str(b) for b in probe.get("shell_bvalues", []))
+    shell_sizes = ", ".join(str(count) for count in probe.get("shell_sizes", []))
+    return b_values, shell_sizes
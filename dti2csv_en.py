@@ -13,155 +13,106 @@
 # 20250203 Kikuko Kaneko
 
 import os
-import glob
-import csv
-import subprocess
-import re
-
-def get_tag_value(dcmdump_text, tag):
-    """
-    Extracts the value within square brackets for the specified tag (e.g., "0010,0010")
-    from the output of dcmdump.
-    """
-    pattern = re.compile(r'\(' + re.escape(tag) + r'\).*?\[(.*?)\]', re.IGNORECASE)
-    m = pattern.search(dcmdump_text)
-    return m.group(1).strip() if m else ""
-
-def run_command(cmd):
-    """
-    Executes a command and returns the output string.
+import argparse
+from dcmutils import (TagPlan, SUBJECT_TAGS, SERIES_TAGS, find_subjects, is_dir, index_subject,
+                      index_subject_by_uid, output_path, add_common_arguments, ScanRun,
+                      extract_axis, extract_shells)
+
+# Header for the output CSV (same columns as dti_results.csv)
+HEADER = [
+    "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+    "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+    "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+    "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+    "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes"
+]
+SUBJECT_PLAN = TagPlan(SUBJECT_TAGS)
+SERIES_PLAN = TagPlan(SERIES_TAGS)
+
+def process_series(task):
     """
-    try:
-        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
-        return out.decode("utf-8")
-    except Exception:
-        return ""
-
-def get_first_file(directory):
-    """
-    Recursively searches a directory and returns the path of the first file found.
+    Builds the CSV row for one series (runs in a worker process when --jobs is given).
     """
-    files = [f for f in glob.glob(os.path.join(directory, "**"), recursive=True)
-             if os.path.isfile(f)]
-    return files[0] if files else ""
-
-def extract_mrinfo_axis(series_dir):
+    subject_dir_short, subj_dcm, series_dir, rep_dcm = task
+    # Extract only the last directory name of each series
+    series_dir_short = os.path.basename(os.path.normpath(series_dir))
+    # Extract all tags in a single pass
+    row = SERIES_PLAN.extract(rep_dcm)
+    # Subject info comes from the first file of the subject directory (not re-read for the next series of the same subject)
+    row.update(SUBJECT_PLAN.extract_cached(subj_dcm))
+    row["SubjectDir"] = subject_dir_short
+    row["SeriesDir"] = series_dir_short
+
+    # Determine if the series is DTI: Skip if neither Series Description nor Protocol Name contains specific keywords (case insensitive)
+    keywords = ["dti", "diff", "ep2d", "dki", "dwi"]
+    desc_lower = row["SeriesDescription"].lower()
+    proto_lower = row["ProtocolName"].lower()
+    is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
+    if not is_dti:
+        return None
+
+    # Retrieve DTI-specific information (b-values, shells and axis count from the DICOM headers,
+    # falling back to mrinfo only when the headers are not enough)
+    row["DTI_Axis"] = extract_axis(series_dir)
+    row["DTI_bvalues"], row["DTI_ShellSizes"] = extract_shells(series_dir)
+
+    return [row[column] for column in HEADER]
+
+def find_series(base_dir, done_subjects=(), group_by_uid=False, shard=None, sampler=None):
     """
-    Extracts the last numerical value (number of axes) from the "Dimensions:" line
-    in the output of `mrinfo <series_dir>`.
-    Example: "Dimensions: 128 x 128 x 33 x 100" → "100"
-    """
-    mrinfo_text = run_command(["mrinfo", series_dir])
-    axis = ""
-    for line in mrinfo_text.splitlines():
-        if "Dimensions:" in line:
-            parts = line.split(":")[-1].strip().split("x")
-            if parts:
-                axis = re.sub(r'\D', '', parts[-1])
-            break
-    return axis
-
-def extract_mrinfo_shells(series_dir):
+    Yields (subject name, subject file, series directory, representative file) for each series under base_dir.
+    Subjects in done_subjects (already finished in a resumed run) are skipped.
+    With group_by_uid, series are grouped by SeriesInstanceUID instead of SE* directory names.
+    With shard=(i, N), only the subjects in shard i are processed.
+    With a sampler (Sampler), only the sampled subjects and series are processed.
     """
-    Extracts b-values and the number of volumes for each shell from the output of
-    `mrinfo <series_dir> -shell_sizes -shell_bvalues`.
-    Example output:
-      0 1200 
-      1 64 
-    - First line: b-values for each shell (e.g., shell 0 has b-value 0, shell 1 has b-value 1200)
-    - Second line: number of volumes for each shell (e.g., shell 0 has 1 volume, shell 1 has 64 volumes)
-    """
-    shell_text = run_command(["mrinfo", series_dir, "-shell_sizes", "-shell_bvalues"])
-    lines = [line.strip() for line in shell_text.splitlines() if re.match(r'^[0-9]', line)]
-    if len(lines) >= 2:
-        b_values    = ", ".join(lines[0].split())
-        shell_sizes = ", ".join(lines[1].split())
-        return b_values, shell_sizes
-    else:
-        return "", ""
-
-def main():
-    BASE_DIR = "."  # Top-level directory containing subject directories
-    # Header for the output CSV (same columns as dti_results.csv)
-    header = [
-        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
-        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
-        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
-        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
-        "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes"
-    ]
-    out_rows = []
-
-    # Iterate through each subdirectory under BASE_DIR, treating them as subject directories
-    for subj_dir in glob.glob(os.path.join(BASE_DIR, "*/")):
+    # Iterate through each subdirectory and zip/tar archive under base_dir, treating them as subject
+    # directories (archives are read in place without extracting them)
+    for subject_dir_short, subj_dir in find_subjects(base_dir, shard, sampler):
+        if subject_dir_short in done_subjects:
+            continue
         org_data = os.path.join(subj_dir, "org_data")
-        if not os.path.isdir(org_data):
+        if not is_dir(org_data):
             continue
         print(f"Processing subject: {subj_dir}")
-        # Retrieve information from the first DICOM file found under org_data
-        subj_dcm = get_first_file(org_data)
+
+        # Scan the org_data directory once to get the subject-level DICOM file and the series directories
+        # starting with "SE000" together with their representative files
+        if group_by_uid:
+            # With --group-by-uid, series are formed from the SeriesInstanceUID in the headers, not directory names
+            subj_dcm, series = index_subject_by_uid(org_data)
+        else:
+            subj_dcm, series = index_subject(org_data, "SE000*")
         if not subj_dcm:
             continue
-        dcmdump_text = run_command(["dcmdump", subj_dcm])
-        patient_name = get_tag_value(dcmdump_text, "0010,0010")
-        patient_age  = get_tag_value(dcmdump_text, "0010,1010")
-        patient_sex  = get_tag_value(dcmdump_text, "0010,0040")
-        study_date   = get_tag_value(dcmdump_text, "0008,0020")
-
-        # Extract only the last directory name from the subject path (e.g., "1675428")
-        subject_dir_short = os.path.basename(os.path.normpath(subj_dir))
 
-        # Recursively search the org_data directory for series directories starting with "SE000"
-        series_dirs = glob.glob(os.path.join(org_data, "**", "SE000*"), recursive=True)
-        for series_dir in series_dirs:
-            # Extract only the last directory name of each series
-            series_dir_short = os.path.basename(os.path.normpath(series_dir))
-            rep_dcm = get_first_file(series_dir)
-            if not rep_dcm:
-                continue
-            rep_dump = run_command(["dcmdump", rep_dcm])
-            # Extract relevant DICOM tags
-            manufacturer      = get_tag_value(rep_dump, "0008,0070")
-            institution       = get_tag_value(rep_dump, "0008,0080")
-            series_description= get_tag_value(rep_dump, "0008,103E")
-            model_name        = get_tag_value(rep_dump, "0008,1090")
-            ethnic_group      = get_tag_value(rep_dump, "0010,2160")
-            repetition_time   = get_tag_value(rep_dump, "0018,0080")
-            echo_time         = get_tag_value(rep_dump, "0018,0081")
-            magnetic_field    = get_tag_value(rep_dump, "0018,0087")
-            pixel_bandwidth   = get_tag_value(rep_dump, "0018,0095")
-            protocol_name     = get_tag_value(rep_dump, "0018,1030")
-            phase_encoding    = get_tag_value(rep_dump, "0018,1312")
-            flip_angle        = get_tag_value(rep_dump, "0018,1314")
+        if sampler:
+            series = sampler.series(subject_dir_short, series)
+        for series_dir, rep_dcm in series:
+            yield subject_dir_short, subj_dcm, series_dir, rep_dcm
 
-            # Determine if the series is DTI: Skip if neither Series Description nor Protocol Name contains specific keywords (case insensitive)
-            keywords = ["dti", "diff", "ep2d", "dki", "dwi"]
-            desc_lower = series_description.lower()
-            proto_lower = protocol_name.lower()
-            is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
-            if not is_dti:
-                continue
-
-            # Use mrinfo to retrieve DTI-specific information
-            dti_axis = extract_mrinfo_axis(series_dir)
-            dti_bvalues, dti_shellsizes = extract_mrinfo_shells(series_dir)
+def main():
+    parser = argparse.ArgumentParser(description="Summarize DTI DICOM information into a CSV file for each series")
+    parser.add_argument("base_dir", nargs="?", default=".",
+                        help="Top-level directory containing subject directories (default: current directory)")
+    add_common_arguments(parser, "dti_results.csv", english=True)
+    args = parser.parse_args()
 
-            row = [
-                subject_dir_short, patient_name, patient_age, patient_sex, study_date,
-                series_dir_short, manufacturer, institution, series_description,
-                model_name, ethnic_group, repetition_time, echo_time, magnetic_field,
-                pixel_bandwidth, protocol_name, phase_encoding, flip_angle,
-                dti_axis, dti_bvalues, dti_shellsizes
-            ]
-            out_rows.append(row)
+    BASE_DIR = args.base_dir  # Top-level directory containing subject directories
+    run = ScanRun(parser, args, __file__, english=True)
 
     # Output only DTI information to "dti_results.csv"
-    output_csv = "dti_results.csv"
-    with open(output_csv, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        writer.writerows(out_rows)
+    output_csv = output_path("dti_results.csv", args.format, args.shard)
+    # Rows are appended to the CSV as each series finishes, in the glob order regardless of
+    # the number of jobs; unchanged series are taken from the cache when --cache is given
+    with run, run.open_output(output_csv, HEADER) as writer:
+        tasks = (task for task in find_series(BASE_DIR, writer.done_subjects, args.group_by_uid,
+                                              args.shard, run.sampler)
+                 if task[-2] not in writer.done_series)
+        for task, row in run.series(process_series, tasks):
+            writer.add(task[0], task[-2], row)
     print(f"CSV output completed: {output_csv}")
+    run.report()
 
 if __name__ == "__main__":
     main()
@@ -8,156 +8,95 @@
 # 20250219　Kikuko Kaneko
 
 import os
-import glob
-import csv
-import subprocess
-import re
 import argparse
-
-def get_tag_value(dcmdump_text, tag):
-    """
-    dcmdump の出力から指定タグ（例："0010,0010"）の角括弧内の値を抽出する
-    """
-    pattern = re.compile(r'\(' + re.escape(tag) + r'\).*?\[(.*?)\]', re.IGNORECASE)
-    m = pattern.search(dcmdump_text)
-    return m.group(1).strip() if m else ""
-
-def run_command(cmd):
-    """
-    コマンドを実行し、出力文字列を返す
+from dcmutils import (TagPlan, SUBJECT_TAGS, SERIES_TAGS, GEOMETRY_TAGS, find_subjects,
+                      index_subject, index_subject_by_uid, output_path, add_common_arguments,
+                      ScanRun, extract_axis, extract_shells)
+
+# 出力する CSV のヘッダー
+HEADER = [
+    "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
+    "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
+    "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
+    "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
+    "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes",
+    "PixelSpacing", "SliceThickness"
+]
+SERIES_PLAN = TagPlan({**SUBJECT_TAGS, **SERIES_TAGS, **GEOMETRY_TAGS})
+
+def process_series(task):
     """
-    try:
-        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
-        return out.decode("utf-8")
-    except Exception:
-        return ""
-
-def get_first_file(directory):
-    """
-    ディレクトリ内を再帰的に検索し、最初に見つかったファイルのパスを返す
+    1シリーズ分の CSV の行を作る（--jobs を指定した場合はワーカープロセスで実行される）
     """
-    files = [f for f in glob.glob(os.path.join(directory, "**"), recursive=True)
-             if os.path.isfile(f)]
-    return files[0] if files else ""
-
-def extract_mrinfo_axis(series_dir):
+    subject_dir_short, series_dir, rep_dcm = task
+    series_dir_short = os.path.basename(os.path.normpath(series_dir))
+    # 各タグを1回の走査でまとめて抽出
+    row = SERIES_PLAN.extract(rep_dcm)
+    row["SubjectDir"] = subject_dir_short
+    row["SeriesDir"] = series_dir_short
+
+    # DTI判定：Series Description または Protocol Name に
+    # 指定のキーワードが含まれていなければスキップ
+    keywords = ["dti", "diff", "ep2d", "dki","dwi"]
+    desc_lower = row["SeriesDescription"].lower()
+    proto_lower = row["ProtocolName"].lower()
+    is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
+    if not is_dti:
+        return None
+
+    # DTI 固有の情報を取得（b 値・シェル・軸数は DICOM ヘッダから求め、求められない場合だけ mrinfo を使う）
+    row["DTI_Axis"] = extract_axis(series_dir)
+    row["DTI_bvalues"], row["DTI_ShellSizes"] = extract_shells(series_dir)
+
+    return [row[column] for column in HEADER]
+
+def find_series(base_dir, done_subjects=(), group_by_uid=False, shard=None, sampler=None):
     """
-    mrinfo <series_dir> の出力から "Dimensions:" 行の最後の数値（軸数）を抽出する
-    例: "Dimensions: 128 x 128 x 33 x 100" → "100"
+    base_dir 以下の各シリーズについて (被験者情報..., シリーズディレクトリ, 代表ファイル) を順に返す
+    done_subjects に含まれる被験者（再開時に処理済みのもの）は飛ばす
+    group_by_uid が真なら、SE* のディレクトリ名ではなく SeriesInstanceUID でシリーズを分ける
+    shard に (i, N) を指定した場合は、i 番目のシャードに入る被験者だけを処理する
+    sampler（Sampler）を指定した場合は、標本に入る被験者・シリーズだけを処理する
     """
-    mrinfo_text = run_command(["mrinfo", series_dir])
-    axis = ""
-    for line in mrinfo_text.splitlines():
-        if "Dimensions:" in line:
-            parts = line.split(":")[-1].strip().split("x")
-            if parts:
-                axis = re.sub(r'\D', '', parts[-1])
-            break
-    return axis
+    # base_dir 直下の各サブディレクトリと zip / tar ファイルを被験者ディレクトリとする（アーカイブは展開せずに読む）
+    for subject_dir_short, subj_dir in find_subjects(base_dir, shard, sampler):
+        if subject_dir_short in done_subjects:
+            continue
+        print(f"処理中の被験者: {subj_dir}")
 
-def extract_mrinfo_shells(series_dir):
-    """
-    mrinfo <series_dir> -shell_sizes -shell_bvalues の出力から、各シェルの b 値とボリューム数を抽出する
-    出力例:
-      0 1200 
-      1 64 
-    ※ 1行目：各シェルの b 値（例：シェル 0 の b 値は 0、シェル 1 の b 値は 1200）
-       2行目：各シェルのボリューム数（例：シェル 0 は 1 枚、シェル 1 は 64 枚）
-    """
-    shell_text = run_command(["mrinfo", series_dir, "-shell_sizes", "-shell_bvalues"])
-    lines = [line.strip() for line in shell_text.splitlines() if re.match(r'^[0-9]', line)]
-    if len(lines) >= 2:
-        b_values    = ", ".join(lines[0].split())
-        shell_sizes = ", ".join(lines[1].split())
-        return b_values, shell_sizes
-    else:
-        return "", ""
+        # 被験者ディレクトリ以下を1回だけ走査して "SE*" で始まるシリーズディレクトリと代表ファイルを取得
+        if group_by_uid:
+            # --group-by-uid のときはディレクトリ名によらず、ヘッダの SeriesInstanceUID でシリーズに分ける
+            _, series = index_subject_by_uid(subj_dir)
+        else:
+            _, series = index_subject(subj_dir, "SE*")
+        if sampler:
+            series = sampler.series(subject_dir_short, series)
+        for series_dir, rep_dcm in series:
+            yield subject_dir_short, series_dir, rep_dcm
 
 def main():
     parser = argparse.ArgumentParser(description="DTIのDICOMファイル情報をCSVにまとめるスクリプト")
     parser.add_argument("base_dir", help="被験者ディレクトリが存在するトップディレクトリ")
+    add_common_arguments(parser, "dti_results.csv")
     args = parser.parse_args()
     if not args.base_dir:
         parser.print_usage()
         exit(1)
-
-    # 出力する CSV のヘッダー
-    header = [
-        "SubjectDir", "PatientName", "PatientAge", "PatientSex", "StudyDate",
-        "SeriesDir", "Manufacturer", "InstitutionName", "SeriesDescription",
-        "ModelName", "EthnicGroup", "RepetitionTime", "EchoTime", "MagneticFieldStrength",
-        "PixelBandwidth", "ProtocolName", "PhaseEncoding", "FlipAngle",
-        "DTI_Axis", "DTI_bvalues", "DTI_ShellSizes",
-        "PixelSpacing", "SliceThickness"
-    ]
-    out_rows = []
-
-    # base_dir 直下の各サブディレクトリを被験者ディレクトリとする
-    base_dir = args.base_dir
-    for subj_dir in glob.glob(os.path.join(base_dir, "*/")):
-        print(f"処理中の被験者: {subj_dir}")
-
-        # 被験者ディレクトリ以下を再帰検索して "SE*" で始まるシリーズディレクトリを取得
-        series_dirs = glob.glob(os.path.join(subj_dir, "**", "SE*"), recursive=True)
-        for series_dir in series_dirs:
-            series_dir_short = os.path.basename(os.path.normpath(series_dir))
-            rep_dcm = get_first_file(series_dir)
-            if not rep_dcm:
-                continue
-            rep_dump = run_command(["dcmdump", rep_dcm])
-
-            # 患者情報および撮影条件をDTIのDICOMから取得
-            patient_name = get_tag_value(rep_dump, "0010,0010")
-            patient_age  = get_tag_value(rep_dump, "0010,1010")
-            patient_sex  = get_tag_value(rep_dump, "0010,0040")
-            study_date   = get_tag_value(rep_dump, "0008,0020")
-
-            manufacturer      = get_tag_value(rep_dump, "0008,0070")
-            institution       = get_tag_value(rep_dump, "0008,0080")
-            series_description= get_tag_value(rep_dump, "0008,103E")
-            model_name        = get_tag_value(rep_dump, "0008,1090")
-            ethnic_group      = get_tag_value(rep_dump, "0010,2160")
-            repetition_time   = get_tag_value(rep_dump, "0018,0080")
-            echo_time         = get_tag_value(rep_dump, "0018,0081")
-            magnetic_field    = get_tag_value(rep_dump, "0018,0087")
-            pixel_bandwidth   = get_tag_value(rep_dump, "0018,0095")
-            protocol_name     = get_tag_value(rep_dump, "0018,1030")
-            phase_encoding    = get_tag_value(rep_dump, "0018,1312")
-            flip_angle        = get_tag_value(rep_dump, "0018,1314")
-            pixel_spacing     = get_tag_value(rep_dump, "0028,0030")
-            slice_thickness   = get_tag_value(rep_dump, "0018,0050")
-
-            # DTI判定：Series Description または Protocol Name に
-            # 指定のキーワードが含まれていなければスキップ
-            keywords = ["dti", "diff", "ep2d", "dki","dwi"]
-            desc_lower = series_description.lower()
-            proto_lower = protocol_name.lower()
-            is_dti = any(keyword in desc_lower or keyword in proto_lower for keyword in keywords)
-            if not is_dti:
-                continue
-
-            # mrinfo を用いて DTI 固有の情報を取得
-            dti_axis = extract_mrinfo_axis(series_dir)
-            dti_bvalues, dti_shellsizes = extract_mrinfo_shells(series_dir)
-
-            subject_dir_short = os.path.basename(os.path.normpath(subj_dir))
-            row = [
-                subject_dir_short, patient_name, patient_age, patient_sex, study_date,
-                series_dir_short, manufacturer, institution, series_description,
-                model_name, ethnic_group, repetition_time, echo_time, magnetic_field,
-                pixel_bandwidth, protocol_name, phase_encoding, flip_angle,
-                dti_axis, dti_bvalues, dti_shellsizes,
-                pixel_spacing, slice_thickness
-            ]
-            out_rows.append(row)
+    run = ScanRun(parser, args, __file__)
 
     # DTI の情報のみをまとめた CSV を "dti_results.csv" として出力
-    output_csv = "dti_results.csv"
-    with open(output_csv, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(header)
-        writer.writerows(out_rows)
+    output_csv = output_path("dti_results.csv", args.format, args.shard)
+    # シリーズごとに処理が終わりしだい CSV に追記する（順序は並列数によらず glob の順序のまま）
+    # --cache を指定した場合、変更のないシリーズはキャッシュの結果を使う
+    with run, run.open_output(output_csv, HEADER) as writer:
+        tasks = (task for task in find_series(args.base_dir, writer.done_subjects, args.group_by_uid,
+                                              args.shard, run.sampler)
+                 if task[-2] not in writer.done_series)
+        for task, row in run.series(process_series, tasks):
+            writer.add(task[0], task[-2], row)
     print(f"CSV出力完了: {output_csv}")
+    run.report()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# --shard i/N で分けて実行した各スクリプトの出力 CSV を1つの CSV にまとめるスクリプト
+# 例: ./merge_shards.py results.shard-*-of-16.csv （出力は results.csv）
+# 行は SubjectDir・SeriesDir の順に並べ替え、全く同じ行が複数あれば1行だけ残す
+# 並べ替えは一時ファイルに分けて行うので、全てのシャードをメモリに読み込むことはない
+
+import sys
+import argparse
+from dcmutils import SHARD_PATTERN, MERGE_CHUNK_ROWS, merged_path, merge_csv
+
+def missing_shards(inputs):
+    """
+    入力のファイル名（"*.shard-i-of-N.*"）から、足りないシャードを "i/N" のリストで返す
+    """
+    found = {}
+    for path in inputs:
+        match = SHARD_PATTERN.search(path)
+        if match:
+            index, count = int(match.group(1)), int(match.group(2))
+            found.setdefault(count, set()).add(index)
+    return [f"{index}/{count}" for count, indexes in sorted(found.items())
+            for index in range(count) if index not in indexes]
+
+def main():
+    parser = argparse.ArgumentParser(description="--shard で分けて出力した CSV を1つにまとめるスクリプト")
+    parser.add_argument("inputs", nargs="+", help="シャードごとの CSV（例：results.shard-*-of-16.csv）")
+    parser.add_argument("-o", "--output",
+                        help="まとめた CSV の出力先（省略時は最初の入力の名前から .shard-i-of-N を除いたもの）")
+    parser.add_argument("--chunk-rows", type=int, default=MERGE_CHUNK_ROWS,
+                        help=f"一度にメモリ上で並べ替える行数（既定は {MERGE_CHUNK_ROWS}）")
+    args = parser.parse_args()
+
+    output = args.output or merged_path(args.inputs[0])
+    if output in args.inputs:
+        parser.error(f"出力先が入力と同じです: {output}（-o で指定してください）")
+    for shard in missing_shards(args.inputs):
+        print(f"警告: シャード {shard} の出力がありません", file=sys.stderr)
+    try:
+        count = merge_csv(args.inputs, output, args.chunk_rows)
+    except ValueError as e:
+        sys.exit(f"エラー: {e}")
+    print(f"CSV出力完了: {output}（{len(args.inputs)} ファイル、{count} 行）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+import csv
+import os
+import sqlite3
+import struct
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dcmutils
+from dcmutils import (FRAME_TAGS, HEADER_STATS, SERIES_TAGS, CsvStream, MrinfoProbes, Sampler, TagPlan,
+                      extract_axis, extract_shells, find_subjects, in_shard, index_subject, index_subject_by_uid,
+                      merge_csv, merged_path, probe_mrinfo, read_dicom_header, read_header, run_series, series_files)
+
+EXPLICIT_VR_LE = "1.2.840.10008.1.2.1"
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+EXPLICIT_VR_BE = "1.2.840.10008.1.2.2"
+UNDEFINED = 0xFFFFFFFF
+
+
+def element(group, elem, vr, value, endian="<", explicit=True, length=None):
+    """
+    要素を1つ作る（length を指定した場合は値長フィールドにその値を書く。UNDEFINED なら値長未定義）
+    """
+    if len(value) % 2:
+        value += b" "
+    if length is None:
+        length = len(value)
+    if not explicit:
+        return struct.pack(endian + "HHI", group, elem, length) + value
+    if vr in ("OB", "OW", "SQ", "UN", "UT"):
+        return struct.pack(endian + "HH2sxxI", group, elem, vr.encode(), length) + value
+    return struct.pack(endian + "HH2sH", group, elem, vr.encode(), length) + value
+
+
+def item(body, endian="<", length=None):
+    """
+    シーケンスのアイテムを1つ作る（length が UNDEFINED なら区切り（FFFE,E00D）で終える）
+    """
+    if length == UNDEFINED:
+        return struct.pack(endian + "HHI", 0xFFFE, 0xE000, UNDEFINED) + body + \
+            struct.pack(endian + "HHI", 0xFFFE, 0xE00D, 0)
+    return struct.pack(endian + "HHI", 0xFFFE, 0xE000, len(body)) + body
+
+
+def sequence_end(endian="<"):
+    return struct.pack(endian + "HHI", 0xFFFE, 0xE0DD, 0)
+
+
+def write_dicom(path, elements, syntax=EXPLICIT_VR_LE):
+    """
+    転送構文 syntax の最小限の DICOM ファイルを書く（ファイルメタ情報は常に明示的 VR リトルエンディアン）
+    """
+    meta = element(0x0002, 0x0010, "UI", syntax.encode() + b"\x00")
+    meta = element(0x0002, 0x0000, "UL", struct.pack("<I", len(meta))) + meta
+    with open(path, "wb") as f:
+        f.write(b"\x00" * 128 + b"DICM" + meta + b"".join(elements))
+
+
+def test_explicit_and_implicit_vr_give_the_same_values(tmp_path):
+    # 暗黙的 VR では IMPLICIT_VRS の VR で値を取り出す（文字列も数値も明示的 VR と同じ値になる）
+    for syntax, explicit in ((EXPLICIT_VR_LE, True), (IMPLICIT_VR_LE, False)):
+        path = str(tmp_path / f"{explicit}.dcm")
+        write_dicom(path, [
+            element(0x0008, 0x0070, "LO", b"SIEMENS", explicit=explicit),
+            element(0x0008, 0x103E, "LO", b"ep2d_diff ", explicit=explicit),
+            element(0x0018, 0x0087, "DS", b"3", explicit=explicit),
+            element(0x0020, 0x0105, "US", struct.pack("<H", 65), explicit=explicit),
+            element(0x2001, 0x1003, "FL", struct.pack("<f", 1000.0), explicit=explicit),
+        ], syntax)
+        header = read_dicom_header(path)
+        assert header["0008,0070"] == "SIEMENS"
+        assert header["0008,103E"] == "ep2d_diff"
+        assert header["0018,0087"] == "3"
+        assert header["0020,0105"] == "65"
+        assert header["2001,1003"] == "1000"
+
+
+def test_big_endian_numbers(tmp_path):
+    path = str(tmp_path / "be.dcm")
+    write_dicom(path, [
+        element(0x0008, 0x0070, "LO", b"GE", ">"),
+        element(0x0020, 0x0105, "US", struct.pack(">H", 258), ">"),
+        element(0x0028, 0x0008, "IS", b"12", ">"),
+    ], EXPLICIT_VR_BE)
+    header = read_dicom_header(path)
+    assert [header[tag] for tag in ("0008,0070", "0020,0105", "0028,0008")] == ["GE", "258", "12"]
+
+
+def test_undefined_length_sequences_are_skipped(tmp_path):
+    # 値長未定義のシーケンスとアイテム（入れ子も含む）、暗黙的 VR で符号化された UN を読み飛ばして後ろの要素を読む
+    nested = element(0x0009, 0x1002, "SQ", item(element(0x0009, 0x1003, "LO", b"x"), length=UNDEFINED)
+                     + sequence_end(), length=UNDEFINED)
+    un_body = item(element(0x0009, 0x1005, "LO", b"y", explicit=False), length=UNDEFINED) + sequence_end()
+    path = str(tmp_path / "sq.dcm")
+    write_dicom(path, [
+        element(0x0008, 0x0070, "LO", b"Philips"),
+        element(0x0009, 0x1001, "SQ", item(nested, length=UNDEFINED) + sequence_end(), length=UNDEFINED),
+        element(0x0009, 0x1004, "UN", un_body, length=UNDEFINED),
+        element(0x0018, 0x1030, "LO", b"DTI"),
+    ])
+    header = read_dicom_header(path, ["0008,0070", "0018,1030"])
+    assert header["0008,0070"] == "Philips"
+    assert header["0018,1030"] == "DTI"
+    assert "0009,1003" not in header
+
+
+def test_large_values_are_skipped_without_reading(tmp_path):
+    # 大きなプライベートタグやピクセルデータの値は読み飛ばすので、読むバイト数はファイルの大きさよりずっと小さい
+    path = str(tmp_path / "large.dcm")
+    write_dicom(path, [
+        element(0x0008, 0x0070, "LO", b"GE"),
+        element(0x0009, 0x1001, "OB", b"\x00" * 200000),
+        element(0x0018, 0x1030, "LO", b"DTI"),
+        element(0x7FE0, 0x0010, "OW", b"\x00" * 1000000),
+    ])
+    files, nbytes = HEADER_STATS
+    header = read_dicom_header(path, ["0008,0070", "0018,1030"])
+    assert header["0018,1030"] == "DTI"
+    assert HEADER_STATS[0] - files == 1
+    assert 0 < HEADER_STATS[1] - nbytes < 64 * 1024 < os.path.getsize(path)
+
+
+ENHANCED_MR = "1.2.840.10008.5.1.4.1.1.4.1"
+
+
+def test_enhanced_mr_functional_groups(tmp_path):
+    # Enhanced MR の TR・TE は Shared Functional Groups から、フレームごとの b 値と位置は
+    # 値長未定義の Per-Frame Functional Groups から読み、ヘッダだけで軸数とシェルを求める
+    def sequence(group, elem, body):
+        return element(group, elem, "SQ", item(body))
+
+    shared = sequence(0x0018, 0x9112, element(0x0018, 0x0080, "DS", b"2500"))
+    shared += sequence(0x0018, 0x9114, element(0x0018, 0x9082, "FD", struct.pack("<d", 89.5)))
+    frames = b""
+    for volume, b_value in enumerate((0.0, 1000.0, 1000.0)):
+        for z in range(2):
+            frame = sequence(0x0018, 0x9117, element(0x0018, 0x9087, "FD", struct.pack("<d", b_value)))
+            frame += sequence(0x0020, 0x9113, element(0x0020, 0x0032, "DS", f"0\\0\\{z * 2.5}".encode()))
+            frames += item(frame, length=UNDEFINED)
+    series_dir = tmp_path / "sub1" / "SE0001"
+    series_dir.mkdir(parents=True)
+    path = str(series_dir / "IM0001")
+    write_dicom(path, [
+        element(0x0008, 0x0016, "UI", ENHANCED_MR.encode()),
+        element(0x0008, 0x0070, "LO", b"Philips"),
+        element(0x0028, 0x0008, "IS", b"6"),
+        element(0x5200, 0x9229, "SQ", item(shared)),
+        element(0x5200, 0x9230, "SQ", frames + sequence_end(), length=UNDEFINED),
+        element(0x7FE0, 0x0010, "OW", b"\x00" * 64),
+    ])
+    header = read_dicom_header(path, ["0008,0070", "0018,0080", "0018,0081"])
+    assert [header[tag] for tag in ("0008,0070", "0018,0080", "0018,0081")] == ["Philips", "2500", "89.5"]
+
+    frames = read_dicom_header(path, ["0018,0080"], FRAME_TAGS)["5200,9230"]
+    assert [frame["0018,9087"] for frame in frames] == ["0", "0", "1000", "1000", "1000", "1000"]
+    assert [frame["0020,0032"] for frame in frames[:2]] == ["0\\0\\0.0", "0\\0\\2.5"]
+    assert extract_axis(str(series_dir)) == "3"
+    assert extract_shells(str(series_dir)) == ("0, 1000", "1, 2")
+
+
+def test_un_encoded_text_tags_are_decoded(tmp_path):
+    # 匿名化ツールなどで VR が UN になった標準タグも、文字列として取り出す
+    path = str(tmp_path / "un.dcm")
+    write_dicom(path, [
+        element(0x0008, 0x0070, "LO", b"SIEMENS"),
+        element(0x0008, 0x103E, "UN", b"ep2d_diff"),
+        element(0x0018, 0x0087, "UN", b"3"),
+        element(0x0018, 0x1030, "UN", b"DTI 64dir"),
+        element(0x0029, 0x1010, "UN", b"SV10\x04\x03\x02\x01"),
+    ])
+    values = TagPlan(SERIES_TAGS).extract(path)
+    assert values["SeriesDescription"] == "ep2d_diff"
+    assert values["ProtocolName"] == "DTI 64dir"
+    assert values["MagneticFieldStrength"] == "3"
+    assert all(isinstance(value, str) for value in values.values())
+    # Siemens CSA ヘッダは UN でもバイト列のまま返す
+    assert read_header(path, ["0029,1010"])["0029,1010"] == b"SV10\x04\x03\x02\x01"
+
+
+def test_unknown_un_tags_are_dropped(tmp_path):
+    # 辞書にない UN のタグは VR が分からないので、列に指定しても値はバイト列にならず空文字になる
+    path = str(tmp_path / "private.dcm")
+    write_dicom(path, [element(0x0019, 0x10AA, "UN", b"abc")])
+    values = TagPlan({"Private": "0019,10AA"}).extract(path)
+    assert values == {"Private": ""}
+
+
+def test_unreadable_files_give_empty_values(tmp_path):
+    # 開けないファイルは dcmdump が失敗したときと同じく空の値になり、処理は止まらない
+    path = str(tmp_path / "missing.dcm")
+    assert read_header(path, ["0008,0070"]) == {}
+    assert TagPlan(SERIES_TAGS).extract(path) == dict.fromkeys(SERIES_TAGS, "")
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+
+def test_csv_stream_renames_only_on_success(tmp_path):
+    # 行は .part に書き、正常に終わったときだけ出力名に rename する（途中で止まれば .part が残る）
+    path = str(tmp_path / "results.csv")
+    with CsvStream(path, ["SubjectDir", "SeriesDir"]) as writer:
+        writer.add("sub1", "sub1/SE0001", ["sub1", "SE0001"])
+        assert read_csv(path + ".part") == [["SubjectDir", "SeriesDir"], ["sub1", "SE0001"]]
+        assert not os.path.exists(path)
+    assert read_csv(path) == [["SubjectDir", "SeriesDir"], ["sub1", "SE0001"]]
+    assert not os.path.exists(path + ".part") and not os.path.exists(path + ".journal")
+
+    failed = str(tmp_path / "failed.csv")
+    with pytest.raises(KeyboardInterrupt):
+        with CsvStream(failed, ["SubjectDir", "SeriesDir"]) as writer:
+            writer.add("sub1", "sub1/SE0001", ["sub1", "SE0001"])
+            raise KeyboardInterrupt
+    assert not os.path.exists(failed)
+    assert read_csv(failed + ".part")[1:] == [["sub1", "SE0001"]]
+
+
+def test_csv_stream_resume_appends_without_duplicates(tmp_path):
+    # 中断した出力を --resume で引き継ぐと、記録済みのシリーズは残し、書きかけの行は捨てて続きを追記する
+    path = str(tmp_path / "results.csv")
+    header = ["SubjectDir", "SeriesDir"]
+    with pytest.raises(KeyboardInterrupt):
+        with CsvStream(path, header) as writer:
+            writer.add("sub1", "sub1/SE0001", ["sub1", "SE0001"])
+            writer.add("sub1", "sub1/SE0002", None)
+            writer.add("sub2", "sub2/SE0001", ["sub2", "SE0001"])
+            raise KeyboardInterrupt
+    with open(path + ".part", "a", encoding="utf-8") as f:
+        f.write("sub2,SE00")  # ジャーナルに記録される前に止まった行
+
+    with CsvStream(path, header, resume=True) as writer:
+        assert writer.done_subjects == {"sub1"}
+        assert writer.done_series == {"sub1/SE0001", "sub1/SE0002", "sub2/SE0001"}
+        # スクリプトと同じく、処理済みの被験者とシリーズは飛ばす
+        for subject, series_dir in [("sub1", "sub1/SE0001"), ("sub2", "sub2/SE0001"),
+                                    ("sub2", "sub2/SE0002"), ("sub3", "sub3/SE0001")]:
+            if subject not in writer.done_subjects and series_dir not in writer.done_series:
+                writer.add(subject, series_dir, [subject, os.path.basename(series_dir)])
+    assert read_csv(path) == [header, ["sub1", "SE0001"], ["sub2", "SE0001"], ["sub2", "SE0002"],
+                              ["sub3", "SE0001"]]
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows(rows)
+
+
+def test_shards_are_disjoint_and_complete():
+    # どの被験者もちょうど1つのシャードに入る
+    subjects = [f"sub-{i:03d}" for i in range(200)] + ["患者1", "sub.zip"]
+    for count in (1, 2, 3, 16):
+        shards = [[subject for subject in subjects if in_shard(subject, (index, count))] for index in range(count)]
+        assert sorted(sum(shards, [])) == sorted(subjects)
+        if count > 1:
+            assert all(shards)
+    assert all(in_shard(subject, None) for subject in subjects)
+
+
+def test_merge_csv_sorts_and_drops_duplicates(tmp_path):
+    # シャードの CSV を SubjectDir・SeriesDir の順にまとめ、全く同じ行は1行だけ残す（chunk_rows ごとに一時ファイルに分ける）
+    header = ["SubjectDir", "SeriesDir", "Value"]
+    write_csv(tmp_path / "r.shard-0-of-2.csv", [header, ["sub3", "SE0001", "c"], ["sub1", "SE0002", "b"],
+                                               ["sub1", "SE0001", "a"]])
+    write_csv(tmp_path / "r.shard-1-of-2.csv", [header, ["sub2", "SE0001", "x"], ["sub1", "SE0002", "b"]])
+    inputs = [str(tmp_path / f"r.shard-{i}-of-2.csv") for i in (0, 1, 0)]
+    output = merged_path(inputs[0])
+    assert output == str(tmp_path / "r.csv")
+    assert merge_csv(inputs, output, chunk_rows=2) == 4
+    assert read_csv(output) == [header, ["sub1", "SE0001", "a"], ["sub1", "SE0002", "b"], ["sub2", "SE0001", "x"],
+                                ["sub3", "SE0001", "c"]]
+
+    write_csv(tmp_path / "other.csv", [["SubjectDir", "Value"], ["sub4", "d"]])
+    with pytest.raises(ValueError):
+        merge_csv(inputs + [str(tmp_path / "other.csv")], output)
+
+
+def write_uid_file(path, study, series):
+    write_dicom(str(path), [
+        element(0x0008, 0x0070, "LO", b"SIEMENS"),
+        element(0x0020, 0x000D, "UI", study.encode() + b"\x00"),
+        element(0x0020, 0x000E, "UI", series.encode() + b"\x00"),
+    ])
+
+
+def test_group_by_uid_buckets(tmp_path):
+    # --group-by-uid では SeriesInstanceUID ごとに代表ファイルとファイル数だけを持ち、
+    # シリーズのファイルは必要になったときにそのシリーズだけ探し直す
+    dump = tmp_path / "sub1" / "dump"
+    (dump / "more").mkdir(parents=True)
+    for name, series in [("a1", "1.2.3"), ("b1", "1.2.4"), ("a2", "1.2.3"), ("more/a3", "1.2.3")]:
+        write_uid_file(dump / name, "1.2", series)
+    (dump / "notes.txt").write_text("not a DICOM file")
+
+    first_file, series = index_subject_by_uid(str(tmp_path / "sub1"))
+    assert os.path.basename(first_file) in ("a1", "b1", "a2", "a3")
+    series = {os.path.basename(series_dir): (series_dir, rep) for series_dir, rep in series}
+    assert sorted(series) == ["UID=1.2.3", "UID=1.2.4"]
+
+    series_dir, rep = series["UID=1.2.3"]
+    # ファイルが複数のディレクトリにあれば共通の親ディレクトリになる
+    assert os.path.dirname(series_dir) == str(dump)
+    assert series_dir.count == 3
+    assert os.path.basename(rep) in ("a1", "a2", "a3")
+    assert sorted(os.path.relpath(path, dump) for path in series_files(series_dir)) == ["a1", "a2", "more/a3"]
+
+    series_dir, rep = series["UID=1.2.4"]
+    assert series_dir.count == 1
+    assert [os.path.basename(path) for path in (rep, *series_files(series_dir))] == ["b1", "b1"]
+
+
+def test_archive_subjects(tmp_path):
+    # zip ファイルは展開せずに被験者ディレクトリとして読み、壊れたメンバーはそのファイルだけ空の値になる
+    source = tmp_path / "source.dcm"
+    write_dicom(str(source), [
+        element(0x0008, 0x0070, "LO", b"SIEMENS"),
+        element(0x0008, 0x103E, "LO", b"t1_mprage"),
+        element(0x0009, 0x1001, "OB", b"\x00" * 4096),
+    ])
+    archive = str(tmp_path / "base" / "sub1.zip")
+    os.mkdir(os.path.dirname(archive))
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        z.write(source, "sub1/dicom/SE0001/IM0001")
+        z.write(source, "sub1/dicom/SE0002/IM0001")
+    with zipfile.ZipFile(archive) as z:
+        info = z.getinfo("sub1/dicom/SE0002/IM0001")
+        # ローカルファイルヘッダ（30 バイト + 名前 + 拡張フィールド）の後ろが圧縮されたデータ
+        with open(archive, "rb") as f:
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+        start = info.header_offset + 30 + name_length + extra_length
+    with open(archive, "r+b") as f:
+        f.seek(start)
+        f.write(b"\xff" * info.compress_size)
+
+    subjects = list(find_subjects(str(tmp_path / "base")))
+    assert [name for name, _ in subjects] == ["sub1"]
+    first_file, series = index_subject(subjects[0][1], "SE000*")
+    assert [os.path.basename(series_dir) for series_dir, _ in series] == ["SE0001", "SE0002"]
+    plan = TagPlan(SERIES_TAGS)
+    good = plan.extract(series[0][1])
+    assert good["Manufacturer"] == "SIEMENS" and good["SeriesDescription"] == "t1_mprage"
+    assert plan.extract(series[1][1]) == dict.fromkeys(SERIES_TAGS, "")
+
+
+def read_manufacturers(task):
+    return [read_header(path, ["0008,0070"]).get("0008,0070", "") for path in task]
+
+
+def test_dcmdump_reads_are_batched(monkeypatch):
+    # --backend dcmdump では、タスクごとに dcmdump を起動せず、被験者のファイルも代表ファイルも
+    # ほかのシリーズの分とまとめて読む
+    batches = []
+
+    def dcmdump_batch(paths):
+        batches.append(paths)
+        return {path: f"(0008,0070) LO [{path.split('/')[2]}]   #   4, 1 Manufacturer" for path in paths}
+
+    monkeypatch.setattr(dcmutils, "run_dcmdump_batch", dcmdump_batch)
+    monkeypatch.setattr(dcmutils, "run_command", lambda *args, **kwargs: pytest.fail("dcmdump started for one file"))
+    monkeypatch.setattr(dcmutils, "HEADER_BACKEND", [dcmutils.BACKENDS["dcmdump"]])
+    tasks = [("/data/sub1/IM0001", f"/data/SE{i}/IM0001") for i in range(3)]
+    results = [result for _, result in run_series(read_manufacturers, tasks)]
+    assert results == [["sub1", f"SE{i}"] for i in range(3)]
+    assert batches == [["/data/sub1/IM0001"], [f"/data/SE{i}/IM0001" for i in range(3)]]
+
+
+def test_failed_mrinfo_probes_are_not_stored(tmp_path, monkeypatch):
+    # mrinfo が失敗した結果（空の辞書）は覚えずに次も実行し直し、成功した結果だけを SQLite に保存して使い回す
+    series_dir = tmp_path / "sub1" / "SE0001"
+    series_dir.mkdir(parents=True)
+    (series_dir / "IM0001").write_bytes(b"")
+    probe = {"dimensions": [2, 2, 1, 3], "voxel_size": [], "shell_bvalues": [0, 1000], "shell_sizes": [1, 2]}
+    results = [{}, probe]
+    calls = []
+
+    def run_mrinfo(path):
+        calls.append(path)
+        return results.pop(0)
+
+    probes = MrinfoProbes()
+    probes.path = str(tmp_path / "cache_mrinfo.sqlite")
+    monkeypatch.setattr(dcmutils, "MRINFO_PROBES", probes)
+    monkeypatch.setattr(dcmutils, "run_mrinfo", run_mrinfo)
+    assert probe_mrinfo(str(series_dir)) == {}
+    with sqlite3.connect(probes.path) as db:
+        assert db.execute("SELECT COUNT(*) FROM probes").fetchone() == (0,)
+    assert probe_mrinfo(str(series_dir)) == probe
+    assert probe_mrinfo(str(series_dir)) == probe
+    assert len(calls) == 2
+
+    # 別のプロセス（ワーカーや次の実行）でも保存した結果を使う
+    other = MrinfoProbes()
+    other.path = probes.path
+    monkeypatch.setattr(dcmutils, "MRINFO_PROBES", other)
+    assert probe_mrinfo(str(series_dir)) == probe
+    assert len(calls) == 2
+
+
+def test_sampler_weights():
+    # --sample-subjects と --sample-series の標本の各行は、それが代表するシリーズ数で重み付けする
+    subjects = [(f"sub{i:02d}", f"/data/sub{i:02d}/") for i in range(40)]
+    sampler = Sampler(fraction=0.5, per_subject=2, seed=1)
+    selected = list(sampler.subjects(subjects))
+    assert 0 < len(selected) < 40
+    assert selected == list(Sampler(fraction=0.5, seed=1).subjects(subjects))
+    assert sampler.subject_weight() == 40 / len(selected)
+
+    # 層（推定に使う出力の対象かどうか）ごとに per_subject 個ずつ、元の順序のまま選ぶ
+    sampler.target(["SubjectDir", "SeriesDir"], lambda series_dir: "DTI" in series_dir)
+    series = [(f"/data/sub01/{name}", f"/data/sub01/{name}/IM0001")
+              for name in ("DTI1", "T1", "DTI2", "DTI3", "FLAIR")]
+    chosen = sampler.series("sub01", series)
+    names = [os.path.basename(series_dir) for series_dir, _ in chosen]
+    assert [name for name in names if "DTI" in name] in (["DTI1", "DTI2"], ["DTI1", "DTI3"], ["DTI2", "DTI3"])
+    assert [name for name in names if "DTI" not in name] == ["T1", "FLAIR"]
+    assert [entry for entry in series if entry in chosen] == chosen
+    assert sampler.series_weight("sub01", "/data/sub01/DTI1") == 1.5
+    assert sampler.series_weight("sub01", "/data/sub01/T1") == 1.0
+    assert sampler.series_weight("sub02", "/data/sub02/DTI1") == 1.0
+    assert sampler.weight("sub01", "/data/sub01/DTI1") == 1.5 * 40 / len(selected)
+
+    # 重み付きの行数は被験者の全シリーズ数に戻る
+    for series_dir, _ in chosen:
+        sampler.observe("sub01", series_dir, ["sub01", os.path.basename(series_dir)])
+    assert sampler.stats["sub01"][None] == len(series)
+
+
+def test_sampler_census_estimate_is_exact():
+    # 標本抽出をしなければ、推定値は実際のシリーズ数で、有限母集団修正により信頼区間の幅は 0 になる
+    sampler = Sampler()
+    subjects = list(sampler.subjects([(f"sub{i}", f"/data/sub{i}/") for i in range(3)]))
+    for count, (subject, _) in zip((1, 2, 4), subjects):
+        for i in range(count):
+            sampler.observe(subject, f"/data/{subject}/SE{i}", [subject, f"SE{i}"])
+    assert sampler.estimate(None) == (7, 0.0)